@@ -8,7 +8,9 @@ import os.path
 import itertools
 
 from mrtarget.modules.Evidences import process_evidences_pipeline
-from mrtarget.common.connection import new_es_client
+from mrtarget.common.connection import new_es_client, configure_transport
+from mrtarget.common.esutil import configure_finalization, configure_aliases, \
+    configure_bulk_routing, configure_folder, load_folder, wait_for_indexes, wait_for_all_indexes, rollback_alias
 from mrtarget.modules.Association import ScoringProcess
 from mrtarget.modules.DataDrivenRelation import DataDrivenRelationProcess
 from mrtarget.modules.ECO import EcoProcess
@@ -16,6 +18,7 @@ from mrtarget.modules.EFO import EfoProcess
 from mrtarget.modules.GeneData import GeneManager
 from mrtarget.modules.HPA import HPAProcess
 from mrtarget.modules.QC import QCMetrics
+from mrtarget.modules.RawScores import ReweightProcess
 from mrtarget.modules.Reactome import ReactomeProcess
 from mrtarget.modules.SearchObjects import SearchObjectProcess
 from mrtarget.modules.Drug import DrugProcess
@@ -53,8 +56,37 @@ def main():
     #read the es configuration
     es_config = mrtarget.cfg.get_config(args.es_config)
 
+    #applies to every client created from here on, including in child processes
+    configure_transport(args.elasticsearch_connection, not args.elasticsearch_no_compress)
+    #stages only wait for the finalization of the indexes they read
+    configure_finalization(args.elasticsearch_finalize == 'async')
+    configure_aliases(args.elasticsearch_aliases, args.elasticsearch_keep_builds)
+    configure_bulk_routing(args.elasticsearch_route_shards)
+    configure_folder(args.elasticsearch_folder)
+
     #es clients can't be pased around to multiple processs!
-    es = new_es_client(args.elasticseach_nodes)
+    #this one is only used for qc
+    es = new_es_client(args.elasticseach_nodes, "scan")
+
+    for alias in args.elasticsearch_rollback:
+        index = rollback_alias(es, alias)
+        logger.info("rolled %s back to %s", alias, index)
+
+    if args.elasticsearch_load:
+        es_write = new_es_client(args.elasticseach_nodes, "bulk-write", args.load_workers_writer)
+        _, failcount = load_folder(es_write, args.elasticsearch_load,
+            args.load_workers_writer, args.load_queue_write, args.elasticsearch_dead_letter)
+        if failcount:
+            raise RuntimeError("%s documents failed to load" % failcount)
+
+    #a folder is loaded as a new index, so it can't update the existing one
+    if args.elasticsearch_folder and (args.as_incremental or args.as_diff_hashes):
+        raise ValueError("incremental scoring and the diff writer can't write to a folder")
+
+    if args.elasticsearch_folder and not args.skip_qc:
+        #the qc reads the indexes from elasticsearch
+        logger.info("skipping qc of indexes written to %s", args.elasticsearch_folder)
+        args.skip_qc = True
 
     #create something to accumulate qc metrics into over various steps
     qc_metrics = QCMetrics()
@@ -64,10 +96,11 @@ def main():
         process = ReactomeProcess(args.elasticseach_nodes, es_config.rea.name, 
             es_config.rea.mapping, es_config.rea.setting,
             data_config.reactome_pathway_data, data_config.reactome_pathway_relation,
-            args.rea_workers_writer, args.rea_queue_write)
+            args.rea_workers_writer, args.rea_queue_write, args.elasticsearch_dead_letter)
         if not args.qc_only:
             process.process_all(args.dry_run)
         if not args.skip_qc:
+            wait_for_indexes([es_config.rea.name])
             qc_metrics.update(process.qc(es, es_config.rea.name))
 
     if args.gen:
@@ -75,10 +108,12 @@ def main():
             es_config.gen.mapping, es_config.gen.setting, 
             args.gen_plugin_places, data_config.gene_data_plugin_names,
             data_config, es_config,
-            args.gen_workers_writer, args.gen_queue_write )
+            args.gen_workers_writer, args.gen_queue_write, args.elasticsearch_dead_letter)
         if not args.qc_only:
+            wait_for_indexes([es_config.rea.name])
             process.merge_all(args.dry_run)
         if not args.skip_qc:
+            wait_for_indexes([es_config.gen.name])
             qc_metrics.update(process.qc(es, es_config.gen.name))     
 
     if args.efo:
@@ -86,22 +121,25 @@ def main():
             es_config.efo.mapping, es_config.efo.setting, 
             data_config.ontology_efo, data_config.ontology_hpo, 
             data_config.ontology_mp, data_config.disease_phenotype,
-            args.efo_workers_writer, args.efo_queue_write)
+            args.efo_workers_writer, args.efo_queue_write, args.elasticsearch_dead_letter)
         if not args.qc_only:
             process.process_all(args.dry_run)
         if not args.skip_qc:
+            wait_for_indexes([es_config.efo.name])
             qc_metrics.update(process.qc(es, es_config.efo.name))
     if args.eco:
         process = EcoProcess(args.elasticseach_nodes, es_config.eco.name, 
             es_config.eco.mapping, es_config.eco.setting,
             data_config.ontology_eco, data_config.ontology_so,
-            args.eco_workers_writer, args.eco_queue_write)
+            args.eco_workers_writer, args.eco_queue_write, args.elasticsearch_dead_letter)
         if not args.qc_only:
             process.process_all(args.dry_run)
         if not args.skip_qc:
+            wait_for_indexes([es_config.eco.name])
             qc_metrics.update(process.qc(es, es_config.eco.name))
 
     if args.val:
+        wait_for_indexes([es_config.gen.name, es_config.eco.name, es_config.efo.name])
         process_evidences_pipeline(data_config.input_file, args.val_first_n,
             args.elasticseach_nodes, es_config.val_right.name, es_config.val_wrong.name, 
             es_config.val_right.mapping, es_config.val_wrong.mapping, 
@@ -114,7 +152,8 @@ def main():
             args.val_cache_target, args.val_cache_target_u2e, args.val_cache_target_contains,
             args.val_cache_eco, args.val_cache_efo, args.val_cache_efo_contains,
             data_config.eco_scores, data_config.schema,
-            data_config.excluded_biotypes, data_config.datasources_to_datatypes)
+            data_config.excluded_biotypes, data_config.datasources_to_datatypes,
+            args.elasticsearch_dead_letter)
 
         #TODO qc
 
@@ -124,10 +163,11 @@ def main():
                 data_config.tissue_translation_map, data_config.tissue_curation_map,
                 data_config.hpa_normal_tissue, data_config.hpa_rna_level, 
                 data_config.hpa_rna_value, data_config.hpa_rna_zscore,
-                args.hpa_workers_writer, args.hpa_queue_write)
+                args.hpa_workers_writer, args.hpa_queue_write, args.elasticsearch_dead_letter)
         if not args.qc_only:
             process.process_all(args.dry_run)
         if not args.skip_qc:
+            wait_for_indexes([es_config.hpa.name])
             qc_metrics.update(process.qc(es, es_config.hpa.name))     
 
     if args.assoc:
@@ -138,12 +178,35 @@ def main():
                 args.as_queue_score, args.as_queue_production, args.as_queue_write,
                 args.as_cache_hpa, args.as_cache_efo, args.as_cache_target, 
                 data_config.scoring_weights, data_config.is_direct_do_not_propagate,
-                data_config.datasources_to_datatypes)
-        if not args.qc_only:
+                data_config.datasources_to_datatypes, args.as_evidence_reader,
+                args.as_engine, args.as_scoring_methods, args.as_skip_zero_scores,
+                args.as_manifest, args.as_incremental, args.as_diff_hashes,
+                args.as_spill_threshold, args.as_schedule, args.as_split_threshold,
+                args.as_split_parts, args.as_shard,
+                args.as_raw_scores, args.as_raw_scores_buffer,
+                args.elasticsearch_dead_letter)
+        wait_for_indexes([es_config.gen.name, es_config.val_right.name, 
+            es_config.hpa.name, es_config.efo.name])
+        if args.as_prepare_shards:
+            process.prepare_shards(args.dry_run)
+        elif args.as_verify_shards:
+            if process.verify_shards(es):
+                logger.error("associations are incomplete")
+                return 1
+        elif not args.qc_only:
             process.process_all(args.dry_run)
-        if not args.skip_qc:
+        #the index is only complete once the shards are verified
+        if not args.skip_qc and not args.as_prepare_shards and args.as_shard is None:
+            wait_for_indexes([es_config.asc.name])
             qc_metrics.update(process.qc(es, es_config.asc.name))
         
+    if args.reweight:
+        process = ReweightProcess(args.as_raw_scores, args.reweight_out,
+                data_config.datasources_to_datatypes, data_config.scoring_weights,
+                args.reweight_buffer)
+        if not args.qc_only:
+            process.process_all(args.dry_run)
+
     if args.ddr:
         process = DataDrivenRelationProcess(args.elasticseach_nodes, 
                 es_config.ddr.name, 
@@ -156,8 +219,10 @@ def main():
                 args.ddr_queue_score_result,
                 args.ddr_queue_write,
                 data_config.ddr["score-threshold"],
-                data_config.ddr["evidence-count"])
+                data_config.ddr["evidence-count"],
+                args.elasticsearch_dead_letter)
         if not args.qc_only:
+            wait_for_indexes([es_config.efo.name, es_config.gen.name, es_config.asc.name])
             process.process_all(args.dry_run)
         #TODO qc
 
@@ -173,8 +238,11 @@ def main():
                 data_config.chembl_mechanism, 
                 data_config.chembl_component, 
                 data_config.chembl_protein, 
-                data_config.chembl_molecule)
+                data_config.chembl_molecule,
+                args.elasticsearch_dead_letter)
         if not args.qc_only:
+            wait_for_indexes([es_config.gen.name, es_config.efo.name, 
+                es_config.val_right.name, es_config.asc.name])
             process.process_all(args.dry_run)
         #TODO qc
 
@@ -192,12 +260,18 @@ def main():
                 data_config.chembl_molecule,
                 data_config.chembl_indication,
                 data_config.adverse_events,
-                data_config.drugbank)
+                data_config.drugbank,
+                args.elasticsearch_dead_letter)
         if not args.qc_only:
+            wait_for_indexes([es_config.gen.name, es_config.efo.name])
             process.process_all(args.dry_run)
         if not args.skip_qc:
+            wait_for_indexes([es_config.drg.name])
             qc_metrics.update(process.qc(es, es_config.drg.name))
 
+    #don't exit while indexes are still being finalized
+    wait_for_all_indexes()
+
     if args.qc_in:
         #handle reading in previous qc from filename provided, and adding comparitive metrics
         qc_metrics.compare_with(args.qc_in)
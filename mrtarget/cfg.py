@@ -3,6 +3,7 @@ import yaml
 import configargparse
 import addict
 import mrtarget.common.connection
+from mrtarget.common.scheduling import parse_shard
 from opentargets_urlzsource import URLZSource
 
 def setup_ops_parser():
@@ -36,14 +37,32 @@ def setup_ops_parser():
         env_var="SKIP_QC", action="store_true", default=False)
 
     # elasticsearch
-    p.add("--elasticseach-nodes", help="elasticsearch host(s)",
+    p.add("--elasticseach-nodes", help="elasticsearch host(s), or sqlite:///path/to/file.db for an in-process stand-in",
         action='append',
         env_var='ELASTICSEARCH_NODES')
         # To handle a default that is *only* used if *nothing* is specified, we have
         # to do it ourselves later. Otherwise the "default" is always present and
         # values are appended to it.
-    p.add("--elasticsearch-folder", help="write to files instead of a live elasticsearch server",
-        action='store') #this only applies to --val at the moment
+    p.add("--elasticsearch-folder", help="write indexes to gzipped NDJSON files in a folder instead of a live elasticsearch server, see --elasticsearch-load. Stages still read their inputs from elasticsearch",
+        env_var="ELASTICSEARCH_FOLDER", action='store', default=None)
+    p.add("--elasticsearch-load", help="bulk load the indexes in a folder written with --elasticsearch-folder into elasticsearch, before running any stage",
+        env_var="ELASTICSEARCH_LOAD", action='store', default=None)
+    p.add("--elasticsearch-connection", help="http library of the elasticsearch clients",
+        env_var="ELASTICSEARCH_CONNECTION", action='store', default='requests', choices=['requests', 'urllib3'])
+    p.add("--elasticsearch-no-compress", help="do not gzip bulk requests to elasticsearch",
+        env_var="ELASTICSEARCH_NO_COMPRESS", action='store_true', default=False)
+    p.add("--elasticsearch-finalize", help="force merge and wait for written indexes before the next stage, or in the background until a stage reads them",
+        env_var="ELASTICSEARCH_FINALIZE", action='store', default='sync', choices=['sync', 'async'])
+    p.add("--elasticsearch-aliases", help="build each index into a new timestamped index, and point an alias with the index name at it once it is finalized, runs that add to an index start from a copy of the current build",
+        env_var="ELASTICSEARCH_ALIASES", action='store_true', default=False)
+    p.add("--elasticsearch-keep-builds", help="# of previous builds to keep behind each alias, e.g. for --elasticsearch-rollback",
+        env_var="ELASTICSEARCH_KEEP_BUILDS", action='store', default=1, type=int)
+    p.add("--elasticsearch-rollback", help="point an alias back at its previous build, before running any stage",
+        action='append', default=[])
+    p.add("--elasticsearch-route-shards", help="send each bulk request to a single shard, by the _id of the documents",
+        env_var="ELASTICSEARCH_ROUTE_SHARDS", action='store_true', default=False)
+    p.add("--elasticsearch-dead-letter", help="directory to write documents that could not be stored in elasticsearch to, one NDJSON file per index",
+        env_var="ELASTICSEARCH_DEAD_LETTER", action='store', default=None)
 
     # process handling
     #note this is the number of workers for each parallel operation
@@ -52,6 +71,10 @@ def setup_ops_parser():
 
     # if 0 use main thread for writing
     # if >0 use that many threads for writing
+    p.add("--load-workers-writer", help="# of procs for --elasticsearch-load writers",
+        env_var="LOAD_WORKERS_WRITER", action='store', default=4, type=int)
+    p.add("--load-queue-write", help="size of --elasticsearch-load writer queue (in chunks)",
+        env_var="LOAD_QUEUE_WRITE", action='store', default=8, type=int)
     p.add("--rea-workers-writer", help="# of procs for rea writers",
         env_var="REA_WORKERS_WRITER", action='store', default=4, type=int)
     p.add("--rea-queue-write", help="size of rea writer queue (in chunks)",
@@ -130,6 +153,42 @@ def setup_ops_parser():
         env_var="AS_CACHE_EFO", action='store', default=1024*1024*4, type=int)
     p.add("--as-cache-target", help="size of association cache for target (bytes)",
         env_var="AS_CACHE_TARGET", action='store', default=1024*512, type=int)
+    p.add("--as-evidence-reader", help="read evidence in a single pass grouped by target, or separately for each target",
+        env_var="AS_EVIDENCE_READER", action='store', default='single-pass', choices=['single-pass', 'per-target'])
+    p.add("--as-engine", help="score each target-disease pair as objects, all the evidence of a target as columns, or direct scores rolled up the ontology",
+        env_var="AS_ENGINE", action='store', default='objects', choices=['objects', 'columnar', 'rollup'])
+    p.add("--as-scoring-methods", help="scoring methods to include in associations, harmonic-sum is required (default all)",
+        env_var="AS_SCORING_METHODS", action='append', choices=['harmonic-sum', 'sum', 'max'])
+    p.add("--as-skip-zero-scores", help="do not write datasources, datatypes and scoring methods without scores in associations",
+        env_var="AS_SKIP_ZERO_SCORES", action='store_true', default=False)
+    p.add("--as-manifest", help="file to write the digest of the evidence of each target to, for later incremental runs",
+        env_var="AS_MANIFEST", action='store', default=None)
+    p.add("--as-incremental", help="manifest of a previous run, only rescore the targets whose evidence changed since then into the existing index",
+        env_var="AS_INCREMENTAL", action='store', default=None)
+    p.add("--as-diff-hashes", help="file of association content hashes, if it exists only changed associations are written into the existing index, then it is updated",
+        env_var="AS_DIFF_HASHES", action='store', default=None)
+    p.add("--as-spill-threshold", help="# of evidence expanded to diseases for a target before spilling to disk (0 to never spill)",
+        env_var="AS_SPILL_THRESHOLD", action='store', default=1000000, type=int)
+    p.add("--as-schedule", help="order of targets for the per-target evidence reader, as in the gene index or by amount of evidence",
+        env_var="AS_SCHEDULE", action='store', default='index', choices=['index', 'heaviest-first'])
+    p.add("--as-split-threshold", help="# of evidence for a target to be split into parts by disease with heaviest-first schedule",
+        env_var="AS_SPLIT_THRESHOLD", action='store', default=100000, type=int)
+    p.add("--as-split-parts", help="# of parts to split a target into with heaviest-first schedule (1 to never split)",
+        env_var="AS_SPLIT_PARTS", action='store', default=1, type=int)
+    p.add("--as-prepare-shards", help="instead of scoring, create the empty index for --as-shard runs to write into, once before them",
+        env_var="AS_PREPARE_SHARDS", action='store_true', default=False)
+    p.add("--as-shard", help="only score the i-th of N partitions of the targets given as i/N, into the index made by --as-prepare-shards",
+        env_var="AS_SHARD", action='store', default=None, type=parse_shard)
+    p.add("--as-verify-shards", help="instead of scoring, check that every target with scored evidence has associations after all the --as-shard runs, and if so finalize the index",
+        env_var="AS_VERIFY_SHARDS", action='store_true', default=False)
+    p.add("--as-raw-scores", help="directory to keep the raw scores of each target, disease and datasource in for --reweight",
+        env_var="AS_RAW_SCORES", action='store', default=None)
+    p.add("--as-raw-scores-buffer", help="# of top raw scores to keep for each target, disease and datasource",
+        env_var="AS_RAW_SCORES_BUFFER", action='store', default=100, type=int)
+    p.add("--reweight-out", help="file to write associations recomputed by --reweight to",
+        env_var="REWEIGHT_OUT", action='store', default="reweighted.tsv.gz")
+    p.add("--reweight-buffer", help="# of top scores in harmonic sums for --reweight, at most --as-raw-scores-buffer",
+        env_var="REWEIGHT_BUFFER", action='store', default=100, type=int)
 
         
     # if 0 use main thread for writing
@@ -204,6 +263,8 @@ def setup_ops_parser():
     # this has to be stored as "assoc" instead of "as" because "as" is a reserved name when accessing it later e.g. `args.as`
     p.add("--as", help="compute association scores, store in elasticsearch",
         action="store_true", dest="assoc")
+    p.add("--reweight", help="recompute association scores from --as-raw-scores with the current weights, store in --reweight-out",
+        action="store_true")
 
     # these are related to generated in a search index
     p.add("--sea", help="compute search results, store in elasticsearch",
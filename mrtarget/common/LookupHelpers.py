@@ -26,13 +26,15 @@ class LookUpDataRetriever(object):
             gene_cache_size = 0,
             gene_cache_u2e_size = 0,
             gene_cache_contains_size = 0, 
+            gene_source_includes = None,
             eco_index = None,
             eco_cache_size = 0,
             hpa_index = None, 
             hpa_cache_size = 0,
             efo_index = None,
             efo_cache_size = 0,
-            efo_cache_contains_size = 0
+            efo_cache_contains_size = 0,
+            efo_source_includes = None
             ):
 
         self.es = es
@@ -41,11 +43,12 @@ class LookUpDataRetriever(object):
 
         if gene_index is not None:
             self.lookup.available_genes = GeneLookUpTable(self.es, gene_index,
-                gene_cache_size, gene_cache_u2e_size, gene_cache_contains_size)
+                gene_cache_size, gene_cache_u2e_size, gene_cache_contains_size,
+                gene_source_includes)
             self._get_non_reference_gene_mappings()
         if efo_index is not None:
             self.lookup.available_efos = EFOLookUpTable(self.es, efo_index,
-            efo_cache_size, efo_cache_contains_size)
+            efo_cache_size, efo_cache_contains_size, efo_source_includes)
         if eco_index is not None:
             self.lookup.available_ecos = ECOLookUpTable(self.es, eco_index, 
             eco_cache_size)
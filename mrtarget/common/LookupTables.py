@@ -53,9 +53,16 @@ class HPALookUpTable(object):
 
 class GeneLookUpTable(object):
 
-    def __init__(self, es, es_index, cache_gene_size, cache_u2e_size, cache_contains_size):
+    def __init__(self, es, es_index, cache_gene_size, cache_u2e_size, cache_contains_size,
+            source_includes=None):
+        """source_includes is an optional list of fields to fetch for get_gene
+
+        If specified, only those fields are requested from elasticsearch and
+        stored in the cache, instead of the full gene document
+        """
         self._es = es
         self._es_index = es_index
+        self._source_includes = source_includes
 
         self.cache_gene = cachetools.LRUCache(cache_gene_size, getsizeof=sys.getsizeof)
         self.cache_gene.hits = 0
@@ -75,7 +82,10 @@ class GeneLookUpTable(object):
             self.cache_gene.hits += 1
             return self.cache_gene[gene_id]
 
-        response = Search().using(self._es).index(self._es_index).extra(track_total_hits=True).query(Match(_id=gene_id))[0:1].execute()
+        search = Search().using(self._es).index(self._es_index).extra(track_total_hits=True).query(Match(_id=gene_id))[0:1]
+        if self._source_includes is not None:
+            search = search.source(includes=self._source_includes)
+        response = search.execute()
         #see https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-request-track-total-hits.html
         if response.hits.total.value == 0:
             #no hit, return None
@@ -209,9 +219,16 @@ class ECOLookUpTable(object):
 
 class EFOLookUpTable(object):
 
-    def __init__(self, es, index, cache_efo_size, cache_contains_size):
+    def __init__(self, es, index, cache_efo_size, cache_contains_size,
+            source_includes=None):
+        """source_includes is an optional list of fields to fetch for get_efo
+
+        If specified, only those fields are requested from elasticsearch and
+        stored in the cache, instead of the full disease document
+        """
         self._es = es
         self._es_index = index
+        self._source_includes = source_includes
         #TODO configure size
         self.cache_efo = cachetools.LRUCache(cache_efo_size, getsizeof=sys.getsizeof)
         self.cache_efo.hits = 0
@@ -238,7 +255,10 @@ class EFOLookUpTable(object):
             self.cache_efo.hits += 1
             return self.cache_efo[efo_id]
 
-        response = Search().using(self._es).index(self._es_index).extra(track_total_hits=True).query(Match(_id=efo_id))[0:1].execute()
+        search = Search().using(self._es).index(self._es_index).extra(track_total_hits=True).query(Match(_id=efo_id))[0:1]
+        if self._source_includes is not None:
+            search = search.source(includes=self._source_includes)
+        response = search.execute()
         #see https://www.elastic.co/guide/en/elasticsearch/reference/7.x/search-request-track-total-hits.html
         if response.hits.total.value == 0:
             #no hit, return None
@@ -1,6 +1,7 @@
 from __future__ import division
 from past.utils import old_div
 from builtins import object
+import heapq
 import numpy as np
 
 
@@ -9,6 +10,8 @@ class ScoringMethods(object):
     SUM = 'sum'
     MAX = 'max'
 
+ALL_SCORING_METHODS = [ScoringMethods.HARMONIC_SUM, ScoringMethods.SUM, ScoringMethods.MAX]
+
 
 class HarmonicSumScorer(object):
 
@@ -16,12 +19,25 @@ class HarmonicSumScorer(object):
         """
         An HarmonicSumScorer will ingest any number of numeric score, keep in memory the top max number
         defined by the buffer and calculate an harmonic sum of those
+
+        The pool of values is kept as a bounded min-heap so the smallest value
+        to be replaced is always at the front
         Args:
             buffer: number of element to keep in memory to compute the harmonic sum
         """
         self.buffer = buffer
         self.data = []
-        self.refresh()
+
+    @property
+    def min(self):
+        """
+        The minimum value of the pool, or 0 if empty
+
+        """
+        if self.data:
+            return self.data[0]
+        else:
+            return 0.
 
     def add(self, score):
         """
@@ -33,22 +49,29 @@ class HarmonicSumScorer(object):
         score = float(score)
         if len(self.data)>= self.buffer:
             if score >self.min:
-                self.data[self.data.index(self.min)] = score
-                self.refresh()
+                heapq.heapreplace(self.data, score)
         else:
-            self.data.append(score)
-            self.refresh()
+            heapq.heappush(self.data, score)
 
-
-    def refresh(self):
+    def add_many(self, scores):
         """
-        Store the minimum value of the pool
+        add several scores to the pool of values at once
+
+        Equivalent to calling add for each score, but uses a partial sort to
+        select the values to keep
+        Args:
+            scores (iterable): numbers to add to the pool of values. are converted to float
 
         """
-        if self.data:
-            self.min = min(self.data)
+        pool = np.fromiter(scores, dtype=float)
+        if len(self.data) + len(pool) > self.buffer:
+            pool = np.concatenate((np.array(self.data, dtype=float), pool))
+            #top buffer values, in no particular order
+            pool = -np.partition(-pool, self.buffer - 1)[:self.buffer]
+            self.data = pool.tolist()
         else:
-            self.min = 0.
+            self.data.extend(pool.tolist())
+        heapq.heapify(self.data)
 
     def score(self, *args,**kwargs):
         """
@@ -60,7 +83,8 @@ class HarmonicSumScorer(object):
         Returns:
             harmonic_sum (float): the harmonic sum of the pool of values
         """
-        return self.harmonic_sum(self.data, *args, **kwargs)
+        #harmonic_sum sorts in place, so give it a copy to keep the heap intact
+        return self.harmonic_sum(list(self.data), *args, **kwargs)
 
     @staticmethod
     def harmonic_sum(data,
@@ -83,6 +107,35 @@ class HarmonicSumScorer(object):
             return cap
         return harmonic_sum
 
+    @staticmethod
+    def grouped_harmonic_sum(groups, data, groups_count,
+                             buffer = 100,
+                             scale_factor = 1):
+        """
+        Returns the harmonic sums of many pools of values at once
+        Args:
+            groups (numpy.ndarray): integer index of the pool of each value
+            data (numpy.ndarray): floats to compute the harmonic sums from
+            groups_count (int): total number of pools
+            buffer (int): number of highest values of each pool to use
+            scale_factor (float): a scaling factor to multiply to each datapoint. Defaults to 1
+
+        Returns:
+            harmonic_sums (numpy.ndarray): the harmonic sum of each pool, indexed by pool.
+                Pools without values have a harmonic sum of 0
+        """
+        #sort by pool then by decreasing value within each pool
+        order = np.lexsort((-data, groups))
+        groups = groups[order]
+        data = data[order]
+        #rank of each value within its own pool
+        ranks = np.arange(len(groups)) - np.searchsorted(groups, groups, side='left')
+        keep = ranks < buffer
+        #bincount adds in array order, so each pool is summed highest value first
+        return np.bincount(groups[keep],
+                           weights=data[keep] / ((ranks[keep] + 1.) ** scale_factor),
+                           minlength=groups_count)
+
     @staticmethod
     def sigmoid_scaling(value,mid_value=100, precision=3):
         center = 1
@@ -1,17 +1,81 @@
 import logging
 import time
 import os
+import requests
 from elasticsearch import Elasticsearch
-from elasticsearch import RequestsHttpConnection
+from elasticsearch import RequestsHttpConnection, Urllib3HttpConnection
+from mrtarget.common.eslocal import LocalElasticsearch, is_local_hosts, get_local_path
 
-def new_es_client(hosts):
+
+class PooledRequestsHttpConnection(RequestsHttpConnection):
+    """RequestsHttpConnection that keeps up to maxsize connections alive, as
+    Urllib3HttpConnection does"""
+
+    def __init__(self, maxsize=10, **kwargs):
+        super(PooledRequestsHttpConnection, self).__init__(**kwargs)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+
+CONNECTION_CLASSES = {
+    "requests": PooledRequestsHttpConnection,
+    "urllib3": Urllib3HttpConnection,
+}
+
+#settings of the client for each kind of use
+#  timeout is in seconds for each request
+#  maxsize is the number of connections kept alive, unless given by workers
+#  compress gzips request bodies, and asks for gzipped responses
+TRANSPORT_PROFILES = {
+    #as all the clients were before there were profiles
+    "default": dict(timeout=1800, maxsize=50, compress=False),
+    #bulk requests, and managing the index being written e.g. force merging it
+    "bulk-write": dict(timeout=1800, maxsize=10, compress=True),
+    #many small searches and gets, e.g. from LookUpDataRetriever
+    "lookup": dict(timeout=60, maxsize=4, compress=False),
+    #scrolling through whole indexes and aggregations over them
+    "scan": dict(timeout=600, maxsize=4, compress=False),
+}
+
+#set once from the command line by configure_transport, before any client is
+#created, and inherited by the forked worker processes
+_connection_class = "requests"
+_compress = True
+
+
+def configure_transport(connection_class="requests", compress=True):
+    """
+    Set the connection class of all clients, as a key of CONNECTION_CLASSES,
+    and whether the profiles that compress are allowed to
+    """
+    global _connection_class, _compress
+    if connection_class not in CONNECTION_CLASSES:
+        raise ValueError("unknown connection class %s" % connection_class)
+    _connection_class = connection_class
+    _compress = compress
+
+
+def new_es_client(hosts, profile="default", workers=None):
+    """
+    Create a client with the settings of one of TRANSPORT_PROFILES. If workers
+    is given, the client keeps enough connections alive for that many threads
+
+    A host of sqlite:///path/to/file.db or sqlite:// creates a
+    LocalElasticsearch instead, in a file or in memory
+    """
+    if is_local_hosts(hosts):
+        return LocalElasticsearch(get_local_path(hosts))
+    settings = TRANSPORT_PROFILES[profile]
+    maxsize = settings["maxsize"] if workers is None else max(workers, 1) + 1
     return Elasticsearch(hosts=hosts,
-                         maxsize=50,
-                         timeout=1800,
+                         maxsize=maxsize,
+                         timeout=settings["timeout"],
+                         http_compress=settings["compress"] and _compress,
                          # sniff_on_connection_fail=True,
                          # sniff_on_start=True,
                          # sniffer_timeout=60,
                          retry_on_timeout=True,
                          max_retries=10,
-                         connection_class=RequestsHttpConnection,
+                         connection_class=CONNECTION_CLASSES[_connection_class],
                          verify_certs=True)
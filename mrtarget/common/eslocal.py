@@ -0,0 +1,942 @@
+"""
+An in-process stand-in for the subset of the Elasticsearch 7 API that the
+pipeline uses, backed by sqlite, to test and benchmark stages without a cluster.
+
+new_es_client returns a LocalElasticsearch when it is given a host of
+sqlite:///path/to/file.db, which is shared by all the clients and processes
+using the same file, or of sqlite:// for a database in memory, which is only
+shared by the clients of one process.
+
+Queries are evaluated in python over the stored documents. Fields are compared
+by their exact values, as for keyword fields, so match queries are not
+analyzed, and documents are not scored.
+"""
+from builtins import object
+import fnmatch
+import functools
+import itertools
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+import simplejson as json
+from elasticsearch import TransportError, NotFoundError, RequestError
+
+LOCAL_SCHEME = "sqlite://"
+#number of documents read from sqlite at once
+PAGE_SIZE = 1000
+#number of hits of a search that does not set the size
+DEFAULT_SIZE = 10
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS indexes (name TEXT PRIMARY KEY, settings TEXT, mappings TEXT);
+CREATE TABLE IF NOT EXISTS aliases (alias TEXT, name TEXT, PRIMARY KEY (alias, name));
+CREATE TABLE IF NOT EXISTS docs (name TEXT, id TEXT, source TEXT, PRIMARY KEY (name, id));
+CREATE INDEX IF NOT EXISTS docs_name ON docs (name);
+"""
+
+#arguments of search that can be given in the body, or on their own
+BODY_PARAMS = ("query", "sort", "_source", "aggs", "aggregations", "size", "from_",
+    "track_total_hits")
+SHARDS = {"total": 1, "successful": 1, "skipped": 0, "failed": 0}
+
+Hit = namedtuple("Hit", ["index", "id", "source"])
+
+#stores by path, shared by the clients of this process
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def is_local_hosts(hosts):
+    """whether hosts, as given to new_es_client, are a LocalElasticsearch database"""
+    if isinstance(hosts, (list, tuple)):
+        hosts = hosts[0] if hosts else None
+    return hosts is not None and str(hosts).startswith(LOCAL_SCHEME)
+
+
+def get_local_path(hosts):
+    """path of the sqlite database of hosts, or None for one in memory"""
+    if isinstance(hosts, (list, tuple)):
+        hosts = hosts[0]
+    return str(hosts)[len(LOCAL_SCHEME):] or None
+
+
+def get_store(path):
+    """the store of a database, shared by all the clients of this process"""
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = SqliteStore(path)
+        return _stores[path]
+
+
+class SqliteStore(object):
+    """
+    The indexes, aliases and documents in a sqlite database. Each process has
+    its own connection, which is used by one thread at a time
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self._connection = None
+        self._pid = None
+
+    @property
+    def connection(self):
+        #connections can't be used by forked processes
+        if self._pid != os.getpid():
+            #a new connection would silently be to an empty database
+            if self.path is None and self._pid is not None:
+                raise RuntimeError("an in-memory store can't be used by a child process, "
+                    "use a sqlite:///path file instead")
+            if self.path is None:
+                connection = sqlite3.connect(":memory:", check_same_thread=False)
+            else:
+                connection = sqlite3.connect(self.path, timeout=600, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                #a stand-in doesn't need to survive a crash
+                connection.execute("PRAGMA synchronous=OFF")
+            connection.executescript(SCHEMA)
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def fetch(self, sql, args=()):
+        with self.lock:
+            return self.connection.execute(sql, args).fetchall()
+
+    def execute(self, statements):
+        """run (sql, args) tuples in a single transaction"""
+        with self.lock:
+            with self.connection as connection:
+                for sql, args in statements:
+                    connection.execute(sql, args)
+
+
+def ignorable(method):
+    """
+    Accept the transport arguments of the elasticsearch client, and return
+    the body of errors with a status in ignore instead of raising them
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        ignore = kwargs.pop("ignore", ())
+        if isinstance(ignore, int):
+            ignore = (ignore,)
+        for key in ("params", "request_timeout", "headers"):
+            kwargs.pop(key, None)
+        try:
+            return method(*args, **kwargs)
+        except TransportError as e:
+            if e.status_code in ignore:
+                return e.info
+            raise
+    return wrapper
+
+
+def index_not_found(name):
+    return NotFoundError(404, "index_not_found_exception",
+        {"error": {"type": "index_not_found_exception", "index": name}, "status": 404})
+
+
+def as_list(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [value]
+
+
+def flatten_settings(settings, prefix=""):
+    """settings as a dict of dotted names starting with index. to strings"""
+    flat = {}
+    for key, value in settings.items():
+        key = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten_settings(value, key + "."))
+        else:
+            if not key.startswith("index."):
+                key = "index." + key
+            flat[key] = None if value is None else json.dumps(value).strip('"')
+    return flat
+
+
+def nest_settings(flat):
+    """flat settings as nested dicts, as returned by elasticsearch"""
+    nested = {}
+    for key in sorted(flat):
+        parts = key.split(".")
+        node = nested
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = flat[key]
+    return nested
+
+
+def get_values(hit, field):
+    """the values of a dotted field of a hit, through lists of objects"""
+    if field == "_id":
+        return [hit.id]
+    if field == "_index":
+        return [hit.index]
+    #keyword multi-fields of text fields have the same values here
+    if field.endswith(".keyword"):
+        field = field[:-len(".keyword")]
+    values = [hit.source]
+    for key in field.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and key in value:
+                found.extend(as_list(value[key]))
+        values = found
+    return [value for value in values if value is not None]
+
+
+def normalize(value):
+    """compare booleans as elasticsearch does, as their strings"""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return value
+
+
+def is_equal(value, other):
+    value = normalize(value)
+    other = normalize(other)
+    if value == other:
+        return True
+    #e.g. a number queried with a string
+    return type(value) != type(other) and str(value) == str(other)
+
+
+def get_query_ids(query):
+    """the ids a query is limited to, if it is a lookup by id, to read only them"""
+    if not query:
+        return None
+    kind, args = list(query.items())[0]
+    if kind == "ids":
+        return as_list(args["values"])
+    if kind in ("term", "match") and list(args) == ["_id"]:
+        value = args["_id"]
+        if isinstance(value, dict):
+            value = value.get("query", value.get("value"))
+        return [value]
+    if kind == "terms" and "_id" in args:
+        return as_list(args["_id"])
+    if kind == "constant_score":
+        return get_query_ids(args["filter"])
+    if kind == "bool":
+        for clause in as_list(args.get("must")) + as_list(args.get("filter")):
+            ids = get_query_ids(clause)
+            if ids is not None:
+                return ids
+    return None
+
+
+def matches(query, hit):
+    """whether a hit matches a query"""
+    if not query:
+        return True
+    kind, args = list(query.items())[0]
+    if kind == "match_all":
+        return True
+    if kind == "match_none":
+        return False
+    if kind in ("match", "match_phrase", "term"):
+        field, value = list(args.items())[0]
+        if isinstance(value, dict):
+            value = value.get("query", value.get("value"))
+        return any(is_equal(v, value) for v in get_values(hit, field))
+    if kind == "terms":
+        field, values = [(k, v) for k, v in args.items() if k != "boost"][0]
+        return any(is_equal(v, t) for v in get_values(hit, field) for t in values)
+    if kind == "ids":
+        return hit.id in args["values"]
+    if kind == "exists":
+        return len(get_values(hit, args["field"])) > 0
+    if kind == "range":
+        field, bounds = list(args.items())[0]
+        return any(in_range(v, bounds) for v in get_values(hit, field))
+    if kind == "constant_score":
+        return matches(args["filter"], hit)
+    if kind == "bool":
+        required = as_list(args.get("must")) + as_list(args.get("filter"))
+        if not all(matches(clause, hit) for clause in required):
+            return False
+        if any(matches(clause, hit) for clause in as_list(args.get("must_not"))):
+            return False
+        should = as_list(args.get("should"))
+        if should:
+            minimum = int(args.get("minimum_should_match", 0 if required else 1))
+            return sum(1 for clause in should if matches(clause, hit)) >= minimum
+        return True
+    raise RequestError(400, "parsing_exception", "unsupported query %s" % kind)
+
+
+def in_range(value, bounds):
+    try:
+        return all(check(value, bounds[key]) for key, check in (
+            ("gt", lambda v, b: v > b), ("gte", lambda v, b: v >= b),
+            ("lt", lambda v, b: v < b), ("lte", lambda v, b: v <= b)) if key in bounds)
+    except TypeError:
+        return False
+
+
+def parse_sort(sort):
+    """(field, descending) tuples of a sort, without the orders of documents"""
+    fields = []
+    for item in as_list(sort):
+        if isinstance(item, dict):
+            field, order = list(item.items())[0]
+            if isinstance(order, dict):
+                order = order.get("order", "asc")
+        else:
+            field, order = item, "asc"
+        if field.startswith("-"):
+            field, order = field[1:], "desc"
+        if field not in ("_doc", "_score"):
+            fields.append((field, order == "desc"))
+    return fields
+
+
+def sort_hits(hits, sort):
+    """sort hits by the lowest value of each field, or highest when descending,
+    with the hits without a value last"""
+    for field, descending in reversed(sort):
+        keyed = [(get_values(hit, field), hit) for hit in hits]
+        present = [(values, hit) for values, hit in keyed if values]
+        missing = [hit for values, hit in keyed if not values]
+        pick = max if descending else min
+        present.sort(key=lambda item: pick(normalize(v) for v in item[0]), reverse=descending)
+        hits = [hit for values, hit in present] + missing
+    return hits
+
+
+def make_source_tree(paths):
+    """nested dicts of the parts of dotted paths, with None for a whole field"""
+    tree = {}
+    for path in paths:
+        node = tree
+        parts = path.split(".")
+        for part in parts[:-1]:
+            if part in node and node[part] is None:
+                break
+            node = node.setdefault(part, {})
+        else:
+            node[parts[-1]] = None
+    return tree
+
+
+def include_source(value, tree):
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [include_source(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for pattern, subtree in tree.items():
+        for key in fnmatch.filter(list(value), pattern):
+            if key in result and isinstance(result[key], dict):
+                result[key].update(include_source(value[key], subtree))
+            else:
+                result[key] = include_source(value[key], subtree)
+    return result
+
+
+def exclude_source(value, tree):
+    if isinstance(value, list):
+        return [exclude_source(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for key in value:
+        subtrees = [tree[pattern] for pattern in tree if fnmatch.fnmatchcase(key, pattern)]
+        if any(subtree is None for subtree in subtrees):
+            continue
+        result[key] = value[key]
+        for subtree in subtrees:
+            result[key] = exclude_source(result[key], subtree)
+    return result
+
+
+def filter_source(source, spec):
+    """the parts of a source selected by the _source of a search, or None"""
+    if spec is None or spec is True:
+        return source
+    if spec is False:
+        return None
+    includes, excludes = spec, []
+    if isinstance(spec, dict):
+        includes = spec.get("includes", spec.get("include", []))
+        excludes = spec.get("excludes", spec.get("exclude", []))
+    includes = as_list(includes)
+    if includes:
+        source = include_source(source, make_source_tree(includes))
+    if excludes:
+        source = exclude_source(source, make_source_tree(as_list(excludes)))
+    return source
+
+
+def format_hit(hit, source_spec, sort):
+    result = {"_index": hit.index, "_type": "_doc", "_id": hit.id,
+        "_score": None if sort else 1.0}
+    source = filter_source(hit.source, source_spec)
+    if source is not None:
+        result["_source"] = source
+    if sort:
+        result["sort"] = [(max if descending else min)(get_values(hit, field) or [None])
+            for field, descending in sort]
+    return result
+
+
+def bucket_key(value):
+    """the key of a bucket, and its string for booleans as elasticsearch does"""
+    if isinstance(value, bool):
+        return dict(key=1 if value else 0, key_as_string=normalize(value))
+    return dict(key=value)
+
+
+def aggregate(aggs, hits):
+    """the results of aggregations over a list of hits"""
+    results = {}
+    for name, spec in aggs.items():
+        sub_aggs = spec.get("aggs", spec.get("aggregations", {}))
+        kind, args = [(k, v) for k, v in spec.items()
+            if k not in ("aggs", "aggregations", "meta")][0]
+
+        if kind == "terms":
+            groups = group_hits(hits, lambda hit: set(normalize_key(v)
+                for v in get_values(hit, args["field"])))
+            ordered = sorted(groups.items(), key=lambda g: (-len(g[1]), str(g[0])))
+            size = args.get("size", 10)
+            buckets = []
+            for key, group in ordered[:size]:
+                bucket = bucket_key(key)
+                bucket["doc_count"] = len(group)
+                bucket.update(aggregate(sub_aggs, group))
+                buckets.append(bucket)
+            results[name] = {"doc_count_error_upper_bound": 0,
+                "sum_other_doc_count": sum(len(g) for k, g in ordered[size:]),
+                "buckets": buckets}
+
+        elif kind == "composite":
+            sources = [list(source.items())[0] for source in args["sources"]]
+            fields = [(source_name, list(source_spec.values())[0]["field"])
+                for source_name, source_spec in sources]
+
+            def get_keys(hit):
+                values = [set(normalize_key(v) for v in get_values(hit, field))
+                    for _, field in fields]
+                return set(itertools.product(*values))
+
+            groups = group_hits(hits, get_keys)
+            keys = sorted(groups)
+            if "after" in args:
+                after = tuple(args["after"][source_name] for source_name, _ in fields)
+                keys = [key for key in keys if key > after]
+            keys = keys[:args.get("size", 10)]
+            buckets = []
+            for key in keys:
+                bucket = {"key": dict(zip([n for n, _ in fields], key)),
+                    "doc_count": len(groups[key])}
+                bucket.update(aggregate(sub_aggs, groups[key]))
+                buckets.append(bucket)
+            results[name] = {"buckets": buckets}
+            if buckets:
+                results[name]["after_key"] = buckets[-1]["key"]
+
+        elif kind == "filter":
+            matched = [hit for hit in hits if matches(args, hit)]
+            results[name] = {"doc_count": len(matched)}
+            results[name].update(aggregate(sub_aggs, matched))
+
+        elif kind == "top_hits":
+            sort = parse_sort(args.get("sort"))
+            start = args.get("from", 0)
+            top = sort_hits(hits, sort)[start:start + args.get("size", 3)]
+            results[name] = {"hits": {"total": {"value": len(hits), "relation": "eq"},
+                "max_score": None,
+                "hits": [format_hit(hit, args.get("_source"), sort) for hit in top]}}
+
+        elif kind in ("min", "max", "sum", "avg", "value_count", "cardinality"):
+            values = [v for hit in hits for v in get_values(hit, args["field"])]
+            if kind == "value_count":
+                value = len(values)
+            elif kind == "cardinality":
+                value = len(set(normalize_key(v) for v in values))
+            elif kind == "sum":
+                value = sum(values)
+            elif not values:
+                value = None
+            elif kind == "avg":
+                value = float(sum(values)) / len(values)
+            else:
+                value = min(values) if kind == "min" else max(values)
+            results[name] = {"value": value}
+
+        else:
+            raise RequestError(400, "parsing_exception", "unsupported aggregation %s" % kind)
+    return results
+
+
+def normalize_key(value):
+    #keys have to be hashable
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, sort_keys=True)
+    return value
+
+
+def group_hits(hits, get_keys):
+    groups = {}
+    for hit in hits:
+        for key in get_keys(hit):
+            groups.setdefault(key, []).append(hit)
+    return groups
+
+
+def merge_doc(source, doc):
+    """merge a partial document into a source, as an update does"""
+    for key, value in doc.items():
+        if isinstance(value, dict) and isinstance(source.get(key), dict):
+            merge_doc(source[key], value)
+        else:
+            source[key] = value
+    return source
+
+
+class LocalElasticsearch(object):
+    """
+    A client with the methods of elasticsearch.Elasticsearch that the pipeline
+    uses, storing the indexes in a sqlite database at path, or in memory
+    """
+
+    def __init__(self, path=None):
+        self.store = get_store(path)
+        self.indices = LocalIndicesClient(self)
+        self.cat = LocalCatClient(self)
+        #iterators of the hits of open scrolls, and their page sizes, by id
+        self.scrolls = {}
+        self.scrolls_lock = threading.Lock()
+
+    def get_index_names(self):
+        return [row[0] for row in self.store.fetch("SELECT name FROM indexes ORDER BY name")]
+
+    def get_aliases(self):
+        """names of the indexes of each alias"""
+        aliases = {}
+        for alias, name in self.store.fetch("SELECT alias, name FROM aliases ORDER BY name"):
+            aliases.setdefault(alias, []).append(name)
+        return aliases
+
+    def resolve(self, index=None, allow_missing=False):
+        """names of the indexes of a comma separated list of names, aliases,
+        and wildcard patterns, as given to the index argument"""
+        names = self.get_index_names()
+        aliases = self.get_aliases()
+        expressions = index if isinstance(index, (list, tuple)) else \
+            (index or "_all").split(",")
+        resolved = []
+        for expression in expressions:
+            if expression in ("_all", "*"):
+                resolved.extend(names)
+            elif "*" in expression or "?" in expression:
+                resolved.extend(fnmatch.filter(names, expression))
+                for alias in fnmatch.filter(list(aliases), expression):
+                    resolved.extend(aliases[alias])
+            elif expression in aliases:
+                resolved.extend(aliases[expression])
+            elif expression in names:
+                resolved.append(expression)
+            elif not allow_missing:
+                raise index_not_found(expression)
+        #each index once, in order
+        return sorted(set(resolved), key=resolved.index)
+
+    def get_write_index(self, index):
+        """the index to write documents of a name or alias to, created if missing"""
+        aliases = self.get_aliases()
+        if index in aliases:
+            if len(aliases[index]) != 1:
+                raise RequestError(400, "illegal_argument_exception",
+                    "alias %s has more than one index to write to" % index)
+            return aliases[index][0]
+        if index not in self.get_index_names():
+            self.indices.create(index=index)
+        return index
+
+    def iter_hits(self, names, ids=None):
+        """the stored documents of indexes, only those with ids if given"""
+        for name in names:
+            if ids is not None:
+                ids = [str(i) for i in ids]
+                for start in range(0, len(ids), PAGE_SIZE):
+                    chunk = ids[start:start + PAGE_SIZE]
+                    rows = self.store.fetch("SELECT id, source FROM docs WHERE name = ? AND id IN (%s)"
+                        % ",".join("?" * len(chunk)), [name] + chunk)
+                    for doc_id, source in rows:
+                        yield Hit(name, doc_id, json.loads(source))
+                continue
+            #page through the documents so no read is kept open while writing
+            last = 0
+            while True:
+                rows = self.store.fetch("SELECT rowid, id, source FROM docs WHERE name = ? "
+                    "AND rowid > ? ORDER BY rowid LIMIT ?", (name, last, PAGE_SIZE))
+                if not rows:
+                    break
+                for rowid, doc_id, source in rows:
+                    yield Hit(name, doc_id, json.loads(source))
+                last = rows[-1][0]
+
+    def iter_matching(self, index, query):
+        names = self.resolve(index)
+        hits = self.iter_hits(names, get_query_ids(query))
+        return (hit for hit in hits if matches(query, hit))
+
+    @ignorable
+    def ping(self, **params):
+        return True
+
+    @ignorable
+    def info(self, **params):
+        return {"name": "local", "cluster_name": "local", "version": {"number": "7.10.2"},
+            "tagline": "You Know, for Search"}
+
+    @ignorable
+    def search(self, index=None, body=None, scroll=None, **params):
+        body = dict(body or {})
+        for key in BODY_PARAMS:
+            if key in params:
+                body["from" if key == "from_" else key] = params.pop(key)
+        size = body.get("size", DEFAULT_SIZE)
+        start = body.get("from", 0)
+        sort = parse_sort(body.get("sort"))
+        aggs = body.get("aggs", body.get("aggregations"))
+        source_spec = body.get("_source")
+        hits = self.iter_matching(index, body.get("query"))
+
+        start_time = time.time()
+        response = {"timed_out": False, "_shards": SHARDS}
+        if scroll and not sort and not aggs:
+            #scroll through the documents as they are read
+            hits = (format_hit(hit, source_spec, sort) for hit in hits)
+            page = list(itertools.islice(hits, size))
+            relation = "gte" if len(page) == size else "eq"
+            total = {"value": len(page), "relation": relation}
+        else:
+            hits = sort_hits(list(hits), sort)
+            if aggs:
+                response["aggregations"] = aggregate(aggs, hits)
+            total = {"value": len(hits), "relation": "eq"}
+            page = [format_hit(hit, source_spec, sort) for hit in hits[start:start + size]]
+            hits = (format_hit(hit, source_spec, sort) for hit in hits[start + size:])
+        if scroll:
+            scroll_id = uuid.uuid4().hex
+            with self.scrolls_lock:
+                self.scrolls[scroll_id] = (hits, size)
+            response["_scroll_id"] = scroll_id
+
+        response["took"] = int((time.time() - start_time) * 1000)
+        response["hits"] = {"total": total, "max_score": None if sort else 1.0, "hits": page}
+        return response
+
+    @ignorable
+    def scroll(self, body=None, scroll_id=None, **params):
+        if scroll_id is None:
+            scroll_id = body["scroll_id"]
+        with self.scrolls_lock:
+            if scroll_id not in self.scrolls:
+                raise NotFoundError(404, "search_context_missing_exception",
+                    {"error": {"type": "search_context_missing_exception"}, "status": 404})
+            hits, size = self.scrolls[scroll_id]
+        page = list(itertools.islice(hits, size))
+        return {"_scroll_id": scroll_id, "took": 0, "timed_out": False, "_shards": SHARDS,
+            "hits": {"total": {"value": len(page), "relation": "gte"}, "max_score": None,
+                "hits": page}}
+
+    @ignorable
+    def clear_scroll(self, body=None, scroll_id=None, **params):
+        if scroll_id is None and body is not None:
+            scroll_id = body.get("scroll_id")
+        scroll_ids = as_list(scroll_id)
+        with self.scrolls_lock:
+            if not scroll_ids or scroll_ids == ["_all"]:
+                scroll_ids = list(self.scrolls)
+            for i in scroll_ids:
+                self.scrolls.pop(i, None)
+        return {"succeeded": True, "num_freed": len(scroll_ids)}
+
+    @ignorable
+    def count(self, index=None, body=None, query=None, **params):
+        if query is None and body is not None:
+            query = body.get("query")
+        return {"count": sum(1 for _ in self.iter_matching(index, query)), "_shards": SHARDS}
+
+    @ignorable
+    def get(self, index, id, **params):
+        for name in self.resolve(index):
+            for hit in self.iter_hits([name], [id]):
+                return {"_index": name, "_type": "_doc", "_id": hit.id, "_version": 1,
+                    "found": True, "_source": filter_source(hit.source, params.get("_source"))}
+        raise NotFoundError(404, "not_found", {"_index": index, "_id": id, "found": False})
+
+    @ignorable
+    def delete_by_query(self, index, body=None, query=None, **params):
+        if query is None and body is not None:
+            query = body.get("query")
+        hits = list(self.iter_matching(index, query))
+        self.store.execute(("DELETE FROM docs WHERE name = ? AND id = ?", (hit.index, hit.id))
+            for hit in hits)
+        return {"took": 0, "timed_out": False, "total": len(hits), "deleted": len(hits),
+            "failures": []}
+
+    @ignorable
+    def reindex(self, body, **params):
+        dest = self.get_write_index(body["dest"]["index"])
+        hits = list(self.iter_matching(body["source"]["index"], body["source"].get("query")))
+        self.store.execute(("INSERT OR REPLACE INTO docs (name, id, source) VALUES (?, ?, ?)",
+            (dest, hit.id, json.dumps(hit.source))) for hit in hits)
+        return {"took": 0, "timed_out": False, "total": len(hits), "created": len(hits),
+            "updated": 0, "deleted": 0, "failures": []}
+
+    @ignorable
+    def bulk(self, body, index=None, **params):
+        if isinstance(body, bytes):
+            body = body.decode("utf-8")
+        if not isinstance(body, str):
+            body = "\n".join(json.dumps(line) for line in body)
+        lines = iter(line for line in body.split("\n") if line.strip())
+
+        start_time = time.time()
+        items = []
+        statements = []
+        #ids written by this request, as they are not in sqlite yet
+        written = {}
+        write_indexes = {}
+        for line in lines:
+            op_type, meta = list(json.loads(line).items())[0]
+            source = None if op_type == "delete" else next(lines)
+            name = meta.get("_index", index)
+            if name not in write_indexes:
+                write_indexes[name] = self.get_write_index(name)
+            name = write_indexes[name]
+            doc_id = meta.get("_id")
+            if doc_id is None:
+                doc_id = uuid.uuid4().hex
+            doc_id = str(doc_id)
+
+            if (name, doc_id) in written:
+                current = written[(name, doc_id)]
+            else:
+                rows = self.store.fetch("SELECT source FROM docs WHERE name = ? AND id = ?",
+                    (name, doc_id))
+                current = rows[0][0] if rows else None
+
+            item = {"_index": name, "_type": "_doc", "_id": doc_id, "_version": 1}
+            if op_type == "delete":
+                if current is None:
+                    item.update(result="not_found", status=404)
+                else:
+                    item.update(result="deleted", status=200)
+                    statements.append(("DELETE FROM docs WHERE name = ? AND id = ?", (name, doc_id)))
+                source = None
+            elif op_type == "create" and current is not None:
+                item.update(status=409, error={"type": "version_conflict_engine_exception",
+                    "reason": "[%s]: version conflict, document already exists" % doc_id})
+                source = current
+            elif op_type == "update":
+                update = json.loads(source)
+                if current is not None:
+                    source = json.dumps(merge_doc(json.loads(current), update.get("doc", {})))
+                    item.update(result="updated", status=200)
+                elif update.get("doc_as_upsert") or "upsert" in update:
+                    source = json.dumps(update.get("upsert", update.get("doc", {})))
+                    item.update(result="created", status=201)
+                else:
+                    item.update(status=404, error={"type": "document_missing_exception",
+                        "reason": "[%s]: document missing" % doc_id})
+                    source = current
+            else:
+                item.update(result="created" if current is None else "updated",
+                    status=201 if current is None else 200)
+
+            if source is not None and source is not current:
+                statements.append(("INSERT OR REPLACE INTO docs (name, id, source) VALUES (?, ?, ?)",
+                    (name, doc_id, source)))
+            written[(name, doc_id)] = source
+            items.append({op_type: item})
+
+        self.store.execute(statements)
+        return {"took": int((time.time() - start_time) * 1000),
+            "errors": any("error" in list(item.values())[0] for item in items),
+            "items": items}
+
+
+class LocalIndicesClient(object):
+    """the methods of elasticsearch.client.IndicesClient that the pipeline uses"""
+
+    def __init__(self, client):
+        self.client = client
+        self.store = client.store
+
+    def get_index(self, name):
+        settings, mappings = self.store.fetch(
+            "SELECT settings, mappings FROM indexes WHERE name = ?", (name,))[0]
+        return json.loads(settings), json.loads(mappings)
+
+    @ignorable
+    def create(self, index, body=None, **params):
+        body = body or {}
+        if index in self.client.get_index_names() or index in self.client.get_aliases():
+            raise RequestError(400, "resource_already_exists_exception",
+                {"error": {"type": "resource_already_exists_exception", "index": index},
+                    "status": 400})
+        settings = {"index.number_of_shards": "1", "index.number_of_replicas": "1"}
+        settings.update(flatten_settings(body.get("settings", {})))
+        statements = [("INSERT INTO indexes (name, settings, mappings) VALUES (?, ?, ?)",
+            (index, json.dumps(settings), json.dumps(body.get("mappings", {}))))]
+        for alias in body.get("aliases", {}):
+            statements.append(("INSERT INTO aliases (alias, name) VALUES (?, ?)", (alias, index)))
+        self.store.execute(statements)
+        return {"acknowledged": True, "shards_acknowledged": True, "index": index}
+
+    @ignorable
+    def delete(self, index, **params):
+        names = self.client.resolve(index)
+        statements = []
+        for name in names:
+            for table in ("indexes", "aliases", "docs"):
+                statements.append(("DELETE FROM %s WHERE name = ?" % table, (name,)))
+        self.store.execute(statements)
+        return {"acknowledged": True}
+
+    @ignorable
+    def exists(self, index, **params):
+        return len(self.client.resolve(index, allow_missing=True)) > 0
+
+    @ignorable
+    def get(self, index, **params):
+        aliases = self.client.get_aliases()
+        result = {}
+        for name in self.client.resolve(index):
+            settings, mappings = self.get_index(name)
+            result[name] = {"aliases": dict((alias, {}) for alias in aliases
+                    if name in aliases[alias]),
+                "mappings": mappings, "settings": nest_settings(settings)}
+        return result
+
+    @ignorable
+    def get_settings(self, index=None, **params):
+        return dict((name, {"settings": nest_settings(self.get_index(name)[0])})
+            for name in self.client.resolve(index))
+
+    @ignorable
+    def put_settings(self, body, index=None, **params):
+        statements = []
+        for name in self.client.resolve(index):
+            settings = self.get_index(name)[0]
+            for key, value in flatten_settings(body).items():
+                if value is None:
+                    settings.pop(key, None)
+                else:
+                    settings[key] = value
+            statements.append(("UPDATE indexes SET settings = ? WHERE name = ?",
+                (json.dumps(settings), name)))
+        self.store.execute(statements)
+        return {"acknowledged": True}
+
+    @ignorable
+    def get_mapping(self, index=None, **params):
+        return dict((name, {"mappings": self.get_index(name)[1]})
+            for name in self.client.resolve(index))
+
+    @ignorable
+    def refresh(self, index=None, **params):
+        self.client.resolve(index)
+        return {"_shards": SHARDS}
+
+    @ignorable
+    def flush(self, index=None, **params):
+        self.client.resolve(index)
+        return {"_shards": SHARDS}
+
+    @ignorable
+    def forcemerge(self, index=None, **params):
+        self.client.resolve(index)
+        return {"_shards": SHARDS}
+
+    @ignorable
+    def exists_alias(self, name, index=None, **params):
+        aliases = self.client.get_aliases()
+        names = self.client.resolve(index, allow_missing=True) if index else None
+        return any(names is None or set(names) & set(aliases[alias])
+            for alias in fnmatch.filter(list(aliases), name))
+
+    @ignorable
+    def get_alias(self, name=None, index=None, **params):
+        aliases = self.client.get_aliases()
+        if name is not None:
+            matched = fnmatch.filter(list(aliases), name)
+            if not matched:
+                raise NotFoundError(404, "alias [%s] missing" % name,
+                    {"error": "alias [%s] missing" % name, "status": 404})
+            aliases = dict((alias, aliases[alias]) for alias in matched)
+        names = self.client.resolve(index) if index else None
+        result = {}
+        for alias in aliases:
+            for index_name in aliases[alias]:
+                if names is None or index_name in names:
+                    result.setdefault(index_name, {"aliases": {}})["aliases"][alias] = {}
+        return result
+
+    @ignorable
+    def update_aliases(self, body, **params):
+        statements = []
+        for action in body["actions"]:
+            kind, args = list(action.items())[0]
+            if kind == "remove_index":
+                for name in self.client.resolve(args["index"]):
+                    for table in ("indexes", "aliases", "docs"):
+                        statements.append(("DELETE FROM %s WHERE name = ?" % table, (name,)))
+                continue
+            names = self.client.resolve(as_list(args.get("index")) + as_list(args.get("indices")))
+            for name in names:
+                for alias in as_list(args.get("alias")) + as_list(args.get("aliases")):
+                    if kind == "add":
+                        statements.append(("INSERT OR IGNORE INTO aliases (alias, name) "
+                            "VALUES (?, ?)", (alias, name)))
+                    elif kind == "remove":
+                        statements.append(("DELETE FROM aliases WHERE alias = ? AND name = ?",
+                            (alias, name)))
+        #all the actions are applied at once
+        self.store.execute(statements)
+        return {"acknowledged": True}
+
+    @ignorable
+    def put_alias(self, index, name, **params):
+        return self.update_aliases({"actions": [{"add": {"index": index, "alias": name}}]})
+
+    @ignorable
+    def delete_alias(self, index, name, **params):
+        return self.update_aliases({"actions": [{"remove": {"index": index, "alias": name}}]})
+
+
+class LocalCatClient(object):
+    """the methods of elasticsearch.client.CatClient that the pipeline uses"""
+
+    def __init__(self, client):
+        self.client = client
+        self.store = client.store
+
+    @ignorable
+    def indices(self, index=None, **params):
+        lines = []
+        for name in self.client.resolve(index):
+            settings = self.client.indices.get_index(name)[0]
+            count = self.store.fetch("SELECT COUNT(*) FROM docs WHERE name = ?", (name,))[0][0]
+            lines.append("green open %s %s %s %s %d 0 0b 0b" % (name, name,
+                settings.get("index.number_of_shards", "1"),
+                settings.get("index.number_of_replicas", "1"), count))
+        return "\n".join(lines) + "\n"
@@ -1,14 +1,364 @@
 
 from builtins import object
+import glob
+import gzip
 import logging
+import os
+import re
+import shutil
+import threading
 import time
-from elasticsearch import RequestError
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import simplejson as json
+from elasticsearch import RequestError, TransportError
+from elasticsearch.helpers import expand_action
+from elasticsearch.serializer import JSONSerializer
+
+#bytes of serialized actions to start each bulk request at, adjusted while writing
+BULK_TARGET_BYTES = 5 * 1024 * 1024
+#limits of the adjusted size, a single larger document is still sent on its own
+BULK_MIN_BYTES = 256 * 1024
+BULK_MAX_BYTES = 50 * 1024 * 1024
+#seconds a bulk request should take, larger requests are sent while they are faster
+BULK_TARGET_LATENCY = 10
+#number of times to retry documents that were rejected because the cluster is busy
+BULK_MAX_RETRIES = 8
+#seconds to wait before the first retry, doubling for each one after
+BULK_INITIAL_BACKOFF = 2
+BULK_MAX_BACKOFF = 600
+#compressed bytes of each file of an index written to a folder
+FOLDER_PART_BYTES = 256 * 1024 * 1024
+#seconds to wait for the current build of an alias to be copied into a new one
+REINDEX_TIMEOUT = 4 * 60 * 60
+
+_serializer = JSONSerializer()
+
+#whether ElasticsearchBulkIndexManager finalizes indexes in the background
+_finalize_async = False
+#background finalizations that have not been waited for, by index name
+_finalizing = {}
+_finalizing_lock = threading.Lock()
+#whether ElasticsearchBulkIndexManager builds indexes behind aliases
+_use_alias = False
+#number of previous builds to keep behind each alias
+_keep_builds = 1
+#whether BulkWriter sends each bulk request to a single shard
+_route_shards = False
+#folder to write indexes to instead of elasticsearch, if any
+_folder = None
+
+
+def configure_finalization(finalize_async):
+    """Set whether indexes are force merged and waited for in the background
+    after they are written, so that the next stage can start meanwhile"""
+    global _finalize_async
+    _finalize_async = finalize_async
+
+
+def wait_for_indexes(index_names):
+    """
+    Wait for any background finalization of the given indexes, e.g. before
+    reading them. Once they have all ended, logs the error of every
+    finalization that failed and raises the first one
+    """
+    logger = logging.getLogger(__name__)
+    failures = []
+    for index_name in index_names:
+        with _finalizing_lock:
+            pending = _finalizing.pop(index_name, None)
+        if pending is None:
+            continue
+        thread, errors = pending
+        if thread.is_alive():
+            logger.info("waiting for %s to be finalized", index_name)
+            thread.join()
+        for error in errors:
+            failures.append((index_name, error))
+    for index_name, error in failures:
+        logger.error("finalizing %s failed: %s", index_name, error)
+    if failures:
+        raise failures[0][1]
+
+
+def wait_for_all_indexes():
+    """wait for all the background finalizations, e.g. before exiting"""
+    with _finalizing_lock:
+        index_names = list(_finalizing)
+    wait_for_indexes(index_names)
+
+
+def configure_aliases(use_alias, keep_builds=1):
+    """Set whether indexes are built behind aliases, and how many previous
+    builds are kept after the alias is moved to a new one, e.g. to roll back"""
+    global _use_alias, _keep_builds
+    _use_alias = use_alias
+    _keep_builds = keep_builds
+
+
+def new_build_name(alias):
+    return "%s-%s" % (alias, time.strftime("%Y%m%d%H%M%S"))
+
+
+def get_builds(client, alias):
+    """names of the timestamped builds of an alias, oldest first"""
+    pattern = re.compile(r"^%s-\d{14}$" % re.escape(alias))
+    indexes = client.indices.get(index="%s-*" % alias, ignore=[404])
+    return sorted(index for index in indexes if pattern.match(index))
+
+
+def get_alias_indexes(client, alias):
+    """names of the indexes an alias points to, if any"""
+    if not client.indices.exists_alias(name=alias):
+        return []
+    return sorted(client.indices.get_alias(name=alias))
+
+
+def swap_alias(client, alias, index):
+    """atomically point alias at index instead of whatever it was before"""
+    logger = logging.getLogger(__name__)
+    actions = [{"remove": {"index": current, "alias": alias}}
+        for current in get_alias_indexes(client, alias)]
+    if not actions and client.indices.exists(index=alias):
+        #an index from before aliases were used has the name
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": index, "alias": alias}})
+    logger.info("pointing %s at %s", alias, index)
+    client.indices.update_aliases(body={"actions": actions})
+
+
+def delete_old_builds(client, alias, keep_builds):
+    """delete all but the keep_builds most recent builds from before the ones
+    alias points to, newer builds may still be being written"""
+    logger = logging.getLogger(__name__)
+    current = get_alias_indexes(client, alias)
+    previous = [index for index in get_builds(client, alias)
+        if not current or index < min(current)]
+    for index in previous[:max(0, len(previous) - keep_builds)]:
+        logger.info("deleting old build %s of %s", index, alias)
+        client.indices.delete(index=index, ignore=[404])
+
+
+def rollback_alias(client, alias):
+    """
+    Point alias back at the most recent build before the current one,
+    which is kept. Returns the index it now points at
+    """
+    current = get_alias_indexes(client, alias)
+    previous = [index for index in get_builds(client, alias)
+        if not current or index < min(current)]
+    if not previous:
+        raise ValueError("no previous build of %s to roll back to" % alias)
+    swap_alias(client, alias, previous[-1])
+    return previous[-1]
+
+
+def configure_bulk_routing(route_shards):
+    """Set whether BulkWriter groups documents by the shard they are routed
+    to, so that each bulk request goes to one primary instead of all of them"""
+    global _route_shards
+    _route_shards = route_shards
+
+
+def configure_folder(folder):
+    """Set a folder for open_index and new_bulk_writer to write indexes to as
+    files, for load_folder, instead of to elasticsearch. None to stop"""
+    global _folder
+    _folder = folder
+
+
+def open_index(client, index_name, settings={}, mappings={}, append_data=False,
+        force_merge=True, shared=False):
+    """
+    Context manager to open an index for bulk loading, in elasticsearch with
+    an ElasticsearchBulkIndexManager, or in the folder set by configure_folder
+    with a FolderIndexManager
+    """
+    if _folder is not None:
+        if shared:
+            raise ValueError("%s can't be shared when writing to a folder" % index_name)
+        return FolderIndexManager(_folder, index_name, settings, mappings, append_data)
+    return ElasticsearchBulkIndexManager(client, index_name, settings, mappings,
+        append_data=append_data, force_merge=force_merge, shared=shared)
+
+
+def flatten_index_settings(settings, prefix=""):
+    """index settings as given to create an index, nested or not, as a flat
+    dict of dotted names without the index. prefix"""
+    flat = {}
+    for key, value in settings.items():
+        key = prefix + key
+        if isinstance(value, dict):
+            flat.update(flatten_index_settings(value, key + "."))
+        else:
+            if key.startswith("index."):
+                key = key[len("index."):]
+            flat[key] = value
+    return flat
+
+
+def prepare_shared_index(client, index_name, settings={}, mappings={}, use_alias=None):
+    """
+    Create an empty index, or a new build behind an alias, for several 
+    processes to write into at once with ElasticsearchBulkIndexManager(shared=True),
+    and change its settings for bulk loading. Returns the name of the index
+    created, which is finalized by finish_shared_index once they are all done
+    """
+    index_manager = ElasticsearchBulkIndexManager(client, index_name, settings, mappings,
+        use_alias=use_alias)
+    index_manager.prepare()
+    return index_manager.write_index
+
+
+def get_shared_index(client, index_name, use_alias=None):
+    """
+    The name of the index created by prepare_shared_index that has not been
+    finished yet, raising ValueError if there is none
+    """
+    if _use_alias if use_alias is None else use_alias:
+        current = get_alias_indexes(client, index_name)
+        builds = [index for index in get_builds(client, index_name)
+            if not current or index > max(current)]
+        write_index = builds[-1] if builds else None
+    else:
+        write_index = index_name if client.indices.exists(index=index_name) else None
+    if write_index is not None:
+        index_settings = client.indices.get_settings(index=write_index)[write_index]
+        #only an index prepared for bulk loading is never refreshed
+        refresh_interval = index_settings["settings"]["index"].get("refresh_interval")
+        if str(refresh_interval) == "-1":
+            return write_index
+    raise ValueError("%s has not been prepared for shared writing" % index_name)
+
+
+def finish_shared_index(client, index_name, settings={}, force_merge=True, use_alias=None):
+    """
+    Restore the settings of an index from prepare_shared_index to the ones it
+    was created with, and finalize it as ElasticsearchBulkIndexManager does on
+    exit, e.g. moving the alias to it
+    """
+    index_manager = ElasticsearchBulkIndexManager(client, index_name, settings,
+        force_merge=force_merge, use_alias=use_alias)
+    index_manager.write_index = get_shared_index(client, index_name, use_alias)
+    index_manager.new_build = index_manager.write_index != index_name
+    flat_settings = flatten_index_settings(settings)
+    index_manager.old_number_of_replicas = flat_settings.get("number_of_replicas")
+    index_manager.old_refresh_interval = flat_settings.get("refresh_interval")
+    index_manager.old_translog_durability = flat_settings.get("translog.durability")
+    index_manager.finish()
+
+
+def new_bulk_writer(client, workers=0, queue_size=8, dead_letter=None, **kwargs):
+    """
+    A BulkWriter to write actions to elasticsearch, or a FolderWriter to
+    write them to the folder set by configure_folder. Other arguments are
+    passed on to BulkWriter
+    """
+    if _folder is not None:
+        return FolderWriter(_folder, workers, queue_size)
+    return BulkWriter(client, workers, queue_size, dead_letter, **kwargs)
+
+
+def murmur3_32(data, seed=0):
+    """the unsigned 32 bit murmur3 (x86) hash of a byte string"""
+    data = bytearray(data)
+    length = len(data)
+    rounded = length & ~3
+    h = seed
+
+    def mix(k):
+        k = (k * 0xcc9e2d51) & 0xffffffff
+        k = (k << 15 | k >> 17) & 0xffffffff
+        return (k * 0x1b873593) & 0xffffffff
+
+    for i in range(0, rounded, 4):
+        h ^= mix(data[i] | data[i + 1] << 8 | data[i + 2] << 16 | data[i + 3] << 24)
+        h = (h << 13 | h >> 19) & 0xffffffff
+        h = (h * 5 + 0xe6546b64) & 0xffffffff
+    k = 0
+    for i in reversed(range(rounded, length)):
+        k = k << 8 | data[i]
+    if length & 3:
+        h ^= mix(k)
+
+    h ^= length
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & 0xffffffff
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+
+def get_shard(routing, number_of_shards, number_of_routing_shards=None):
+    """
+    The shard a document with the given routing, by default its _id, is
+    stored in, as calculated by Elasticsearch 7 for an index without a
+    routing partition size
+    """
+    if number_of_routing_shards is None:
+        #indexes are created so they can be split up to 1024 shards
+        splits = max(1, 10 - (number_of_shards - 1).bit_length())
+        number_of_routing_shards = number_of_shards << splits
+    #the hash of the UTF-16 code units as a java int
+    routing_hash = murmur3_32(routing.encode("utf-16-le"))
+    if routing_hash & 0x80000000:
+        routing_hash -= 1 << 32
+    #python modulo of a negative number is the same as java Math.floorMod
+    return (routing_hash % number_of_routing_shards) // \
+        (number_of_routing_shards // number_of_shards)
+
+
+def get_action_meta(item):
+    """the op type and metadata of an encoded action"""
+    return list(json.loads(item[:item.index(b"\n")].decode("utf-8")).items())[0]
+
+
+class EncodedAction(bytes):
+    """
+    The NDJSON lines of an action from encode_action, with the index and
+    routing of its document so that BulkWriter can route it to its shard
+    without parsing the lines again
+    """
+
+    def __new__(cls, lines, index_name=None, routing=None):
+        encoded = super(EncodedAction, cls).__new__(cls, lines)
+        #not index, which is a method of bytes
+        encoded.index_name = index_name
+        encoded.routing = routing
+        return encoded
+
+    def __reduce__(self):
+        #keep the index and routing when sent between processes
+        return (EncodedAction, (bytes(self), self.index_name, self.routing))
+
+
+def encode_action(action):
+    """Encode an action as the NDJSON lines of a bulk request body, as an
+    EncodedAction
+
+    A source that is already a JSON string or bytes, e.g. from to_json(), is
+    added by concatenation without being serialized again. Workers can call
+    this so that the writer only has to join the encoded actions.
+    """
+    action, data = expand_action(action)
+    lines = _serializer.dumps(action).encode("utf-8") + b"\n"
+    if isinstance(data, bytes):
+        lines += data + b"\n"
+    elif data is not None:
+        lines += _serializer.dumps(data).encode("utf-8") + b"\n"
+    meta = list(action.values())[0]
+    return EncodedAction(lines, meta.get("_index"),
+        meta.get("routing", meta.get("_routing", meta.get("_id"))))
 
 
 class ElasticsearchBulkIndexManager(object):
     """Context manager to open an an Elasticsearch index for bulk loading."""
 
-    def __init__(self, client, index_name, settings={}, mappings={}, append_data=False):
+    def __init__(self, client, index_name, settings={}, mappings={}, append_data=False,
+            force_merge=True, finalize_async=None, use_alias=None, shared=False):
         """Set the index to load to, and define initial state for it.
 
         Parameters
@@ -22,6 +372,24 @@ class ElasticsearchBulkIndexManager(object):
             set this to True if you want the data to be appended to the
             existing index with name index_name instead of replacing
             this index with an empty index first.
+        force_merge
+            set this to False to skip merging the index into a single segment
+            on exit, e.g. when only a small part of an existing index changed.
+        finalize_async
+            set this to True to force merge and wait for the index in a
+            background thread on exit, see wait_for_indexes. Defaults to
+            what was set by configure_finalization.
+        use_alias
+            set this to True to make index_name an alias. A new build is
+            written into a timestamped index, and the alias is only moved to
+            it once it is finalized, so readers keep the previous build until
+            then. Defaults to what was set by configure_aliases.
+        shared
+            set this to True when several processes write into the index at
+            once, e.g. shards of the associations. The index must have been
+            created by prepare_shared_index, and is only finalized by
+            finish_shared_index once they are all done, so this only finds 
+            the index to write to.
         """
         self.logger = logging.getLogger(__name__)
         self.client = client
@@ -34,12 +402,35 @@ class ElasticsearchBulkIndexManager(object):
         self.settings = settings
         self.mappings = mappings
         self.append_data = append_data
+        self.force_merge = force_merge
+        self.finalize_async = _finalize_async if finalize_async is None else finalize_async
+        self.use_alias = _use_alias if use_alias is None else use_alias
+        self.shared = shared
+        #the index actually written to, which is set on entry
+        self.write_index = index_name
+        #the current build to copy into a new one when appending, set on entry
+        self.copy_from = None
+        #set on entry if the alias is to be moved on exit
+        self.new_build = False
 
     def __enter__(self):
+        if self.shared:
+            self.write_index = get_shared_index(self.client, self.index_name, self.use_alias)
+            self.logger.info("writing %s into shared %s", self.index_name, self.write_index)
+        else:
+            self.prepare()
+        return self
+
+    def prepare(self):
         #setup
+        #a previous build of this index might still be finalizing
+        wait_for_indexes([self.index_name])
+
+        if self.use_alias:
+            self.enter_alias()
         #ensure the index exists and is empty and ready
         #ignore if index doesn't exist
-        if self.client.indices.exists(index=self.index_name):
+        elif self.client.indices.exists(index=self.index_name):
             # if append_data is False, it means index needs to be replaced instead of appended to,
             # so delete existing index and create again:
             if not self.append_data:
@@ -50,73 +441,140 @@ class ElasticsearchBulkIndexManager(object):
             self.create_index()
 
         #store old settings to restore later, if present
-        self.logger.debug("saving old settings for %s", self.index_name)
-        old_settings = self.client.indices.get_settings(self.index_name)
-        if self.index_name in old_settings:
-            if "settings" in old_settings[self.index_name]:
-                if "index" in old_settings[self.index_name]["settings"]:
-                    if "number_of_replicas" in old_settings[self.index_name]["settings"]["index"]:
+        self.logger.debug("saving old settings for %s", self.write_index)
+        old_settings = self.client.indices.get_settings(self.write_index)
+        if self.write_index in old_settings:
+            if "settings" in old_settings[self.write_index]:
+                if "index" in old_settings[self.write_index]["settings"]:
+                    if "number_of_replicas" in old_settings[self.write_index]["settings"]["index"]:
                         #store number of replicas
-                        self.old_number_of_replicas = old_settings[self.index_name]["settings"]["index"]["number_of_replicas"]
-                    if "refresh_interval" in old_settings[self.index_name]["settings"]["index"]:
+                        self.old_number_of_replicas = old_settings[self.write_index]["settings"]["index"]["number_of_replicas"]
+                    if "refresh_interval" in old_settings[self.write_index]["settings"]["index"]:
                         #store index interval
-                        self.old_refresh_interval = old_settings[self.index_name]["settings"]["index"]["refresh_interval"]
-                    if "translog.durability" in old_settings[self.index_name]["settings"]["index"]:
+                        self.old_refresh_interval = old_settings[self.write_index]["settings"]["index"]["refresh_interval"]
+                    if "translog.durability" in old_settings[self.write_index]["settings"]["index"]:
                         #store transaction log durability setting
-                        self.old_translog_durability = old_settings[self.index_name]["settings"]["index"]["translog.durability"]
+                        self.old_translog_durability = old_settings[self.write_index]["settings"]["index"]["translog.durability"]
 
 
         #set replicas to zero
         #set update interval to "never"
         #set transaction log durability to "async"
-        self.logger.debug("changing settings for bulk into %s", self.index_name)
-        self.client.indices.put_settings(index=self.index_name, body={
+        self.logger.debug("changing settings for bulk into %s", self.write_index)
+        self.client.indices.put_settings(index=self.write_index, body={
             "index" : {
                 "number_of_replicas" : 0,
                 "refresh_interval" : -1,
                 "translog.durability" : "async"
             }
         })
-        return self
+
+        if self.copy_from is not None:
+            self.copy_build()
         
     def __exit__(self, type, value, traceback):
         #teardown
+        #a shared index is finished by finish_shared_index
+        if self.shared:
+            return None
+
+        #a failed build is dropped, and readers keep the previous one
+        if self.new_build and type is not None:
+            self.logger.error("dropping failed build %s of %s", self.write_index, self.index_name)
+            self.client.indices.delete(index=self.write_index, ignore=[404])
+            return None
+
+        self.finish()
 
+        #don't return True to indicate any exceptions have been handled
+        #this contex manager is only for cleanup
+        return None
+
+    def finish(self):
         #restore old settings
-        self.logger.debug("Restoring old settings for %s", self.index_name)
-        self.client.indices.put_settings(index=self.index_name, body={
+        self.logger.debug("Restoring old settings for %s", self.write_index)
+        self.client.indices.put_settings(index=self.write_index, body={
             "index" : {
                 "number_of_replicas" : self.old_number_of_replicas,
                 "refresh_interval" : self.old_refresh_interval,
                 "translog.durability" : self.old_translog_durability
             }
         })
-        
 
+        if self.finalize_async:
+            self.logger.debug("finalizing %s in the background", self.write_index)
+            errors = []
+            thread = threading.Thread(target=self._finalize_background, args=(errors,),
+                name="finalize-%s" % self.index_name)
+            #readers wait for the name they read, not the build behind it
+            with _finalizing_lock:
+                _finalizing[self.index_name] = (thread, errors)
+            thread.start()
+        else:
+            self.finalize()
+
+    def finalize(self):
         #run force-merge
         #this will compress everyhting into a single "segment"
         #temporarily, will use more disk as things are copied around
         #but in the end should be smaller and more performant
-        self.logger.debug("Force merging %s", self.index_name)
-        self.client.indices.forcemerge(index=self.index_name, max_num_segments=1)
+        if self.force_merge:
+            self.logger.debug("Force merging %s", self.write_index)
+            self.client.indices.forcemerge(index=self.write_index, max_num_segments=1)
 
         #wait for everthing to sort itself out
         #self.wait_for_status(u"yellow")
         self.wait_for_status(u"green")
 
-        #don't return True to indicate any exceptions have been handled
-        #this contex manager is only for cleanup
-        return None
+        if self.new_build:
+            swap_alias(self.client, self.index_name, self.write_index)
+            delete_old_builds(self.client, self.index_name, _keep_builds)
+
+    def _finalize_background(self, errors):
+        try:
+            self.finalize()
+            self.logger.info("finalized %s", self.index_name)
+        except Exception as e:
+            self.logger.exception("failed to finalize %s", self.index_name)
+            errors.append(e)
+
+    def enter_alias(self):
+        """Set the index to write to behind the alias
+
+        Appending never writes into the build readers see, the current build
+        is copied into the new one first, see copy_build"""
+        current = get_alias_indexes(self.client, self.index_name)
+        if self.append_data and len(current) == 1:
+            #add to a copy of the current build
+            self.copy_from = current[0]
+        elif self.append_data and not current \
+                and self.client.indices.exists(index=self.index_name):
+            #add to a copy of an index from before aliases were used
+            self.copy_from = self.index_name
+        self.write_index = new_build_name(self.index_name)
+        self.new_build = True
+        self.create_index()
+        self.logger.info("writing %s into %s", self.index_name, self.write_index)
+
+    def copy_build(self):
+        """copy the documents of the current build into the new one"""
+        self.logger.info("copying %s into %s", self.copy_from, self.write_index)
+        response = self.client.reindex(body={"source": {"index": self.copy_from},
+                "dest": {"index": self.write_index}},
+            wait_for_completion=True, request_timeout=REINDEX_TIMEOUT)
+        if response.get("failures"):
+            raise RuntimeError("failed to copy %s into %s: %s" % (self.copy_from,
+                self.write_index, response["failures"][0]))
 
     def create_index(self):
         """Tell the Elasticsearch client to create the index as configured."""
-        self.logger.debug("creating index %s", self.index_name)
+        self.logger.debug("creating index %s", self.write_index)
         body = {
             "settings": self.settings,
             "mappings": self.mappings
         }
         try:
-            self.client.indices.create(index=self.index_name, body=body)
+            self.client.indices.create(index=self.write_index, body=body)
         except RequestError as e:
             if u'resource_already_exists_exception' == e.error:
                 self.logger.debug("swallowing index exists exception")
@@ -126,9 +584,426 @@ class ElasticsearchBulkIndexManager(object):
 
     def wait_for_status(self, desired):
         #TODO implement a timeout?
-        self.logger.debug("Checking index status %s", self.index_name)
+        self.logger.debug("Checking index status %s", self.write_index)
         status = None
         while status != desired:
             time.sleep(1)
-            status = self.client.cat.indices(index=self.index_name).strip().split()[0]
-            self.logger.debug("Status of %s is %s", self.index_name, status)
+            status = self.client.cat.indices(index=self.write_index).strip().split()[0]
+            self.logger.debug("Status of %s is %s", self.write_index, status)
+
+
+class BulkWriter(object):
+    """Write actions to Elasticsearch in bulk, retrying rejected documents."""
+
+    def __init__(self, client, workers=0, queue_size=8, dead_letter=None,
+            ignore_status=(), target_bytes=BULK_TARGET_BYTES, min_bytes=BULK_MIN_BYTES,
+            max_bytes=BULK_MAX_BYTES, target_latency=BULK_TARGET_LATENCY,
+            max_retries=BULK_MAX_RETRIES, initial_backoff=BULK_INITIAL_BACKOFF,
+            max_backoff=BULK_MAX_BACKOFF, route_shards=None):
+        """Set how to write bulk actions.
+
+        Parameters
+        ----------
+        client
+            is an elasticsearch client object
+        workers
+            number of threads sending bulk requests, or 0 to send them
+            from the calling thread
+        queue_size
+            number of chunks waiting for the worker threads
+        dead_letter
+            directory to append documents that could not be written to, as
+            one NDJSON file per index, or None to only count them
+        ignore_status
+            HTTP statuses of documents to count as written, e.g. 404 when
+            deleting documents that may not exist
+        target_bytes
+            serialized size of the first bulk requests. It is halved when a
+            request takes more than target_latency seconds or documents are
+            rejected, and grows while requests take less than half of that,
+            between min_bytes and max_bytes
+        max_retries
+            number of times to retry documents rejected with a 429 status,
+            waiting initial_backoff seconds then twice as long each time,
+            up to max_backoff seconds
+        route_shards
+            set this to True to fill a chunk for each shard, by the routing or
+            _id of the documents, and send each one when it reaches the target
+            size. This holds up to a chunk per shard in memory. Defaults to
+            what was set by configure_bulk_routing.
+        """
+        self.logger = logging.getLogger(__name__)
+        self.client = client
+        self.workers = workers
+        self.queue_size = queue_size
+        self.dead_letter = dead_letter
+        self.ignore_status = ignore_status
+        self.target_bytes = target_bytes
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.route_shards = _route_shards if route_shards is None else route_shards
+        #shard counts of each index written to, or None if not routed
+        self.shards = {}
+        #totals over all the calls to write
+        self.written = 0
+        self.failed = 0
+        self.retried = 0
+        self.lock = threading.Lock()
+
+    def write(self, actions):
+        """Write an iterable of actions, as for elasticsearch.helpers.bulk, or
+        already encoded by encode_action
+
+        Returns a tuple of the number of documents written and failed
+        """
+        written = 0
+        failed = 0
+        chunks = self._chunks(action if isinstance(action, bytes) else encode_action(action)
+            for action in actions)
+        if self.workers > 0:
+            #don't read all the actions at once, only up to queue_size chunks
+            #are waiting for or being sent by the workers
+            slots = threading.BoundedSemaphore(max(self.queue_size, self.workers))
+
+            def send_chunk(chunk):
+                try:
+                    return self._send_chunk(chunk)
+                finally:
+                    slots.release()
+
+            pending = deque()
+            with ThreadPoolExecutor(self.workers) as executor:
+                for chunk in chunks:
+                    slots.acquire()
+                    pending.append(executor.submit(send_chunk, chunk))
+                    while pending and pending[0].done():
+                        chunk_written, chunk_failed = pending.popleft().result()
+                        written += chunk_written
+                        failed += chunk_failed
+                for future in pending:
+                    chunk_written, chunk_failed = future.result()
+                    written += chunk_written
+                    failed += chunk_failed
+        else:
+            for chunk in chunks:
+                chunk_written, chunk_failed = self._send_chunk(chunk)
+                written += chunk_written
+                failed += chunk_failed
+
+        if failed:
+            self.logger.error("wrote %d documents, %d failed%s", written, failed,
+                " see %s" % self.dead_letter if self.dead_letter else "")
+        else:
+            self.logger.info("wrote %d documents", written)
+        self.logger.debug("bulk requests ended at %d bytes", self.target_bytes)
+        return written, failed
+
+    def _chunks(self, items):
+        """
+        group encoded actions into chunks of up to the current target size,
+        one being filled for each shard if they are routed
+        """
+        #chunk and size being filled by shard
+        filling = {}
+        for item in items:
+            key = self._get_shard(item) if self.route_shards else None
+            chunk, size = filling.get(key, ([], 0))
+            item_size = len(item)
+            if chunk and size + item_size > self.target_bytes:
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append(item)
+            filling[key] = (chunk, size + item_size)
+        for chunk, size in filling.values():
+            if chunk:
+                yield chunk
+
+    def _get_shard(self, item):
+        """the index and shard an encoded action is routed to, if known"""
+        if isinstance(item, EncodedAction):
+            index, routing = item.index_name, item.routing
+        else:
+            #encoded some other way, e.g. read back from a folder
+            op_type, meta = get_action_meta(item)
+            index = meta.get("_index")
+            routing = meta.get("routing", meta.get("_routing", meta.get("_id")))
+        if index not in self.shards:
+            self.shards[index] = self._get_number_of_shards(index)
+        if routing is None or self.shards[index] is None:
+            #auto generated ids are spread by elasticsearch
+            return index, None
+        number_of_shards, number_of_routing_shards = self.shards[index]
+        return index, get_shard(routing, number_of_shards, number_of_routing_shards)
+
+    def _get_number_of_shards(self, index):
+        """number of shards and routing shards of an index, or None if unknown"""
+        if index is None:
+            return None
+        try:
+            response = self.client.indices.get_settings(index=index)
+        except TransportError as e:
+            self.logger.warning("not routing documents of %s, failed to get its shards: %s",
+                index, e.error)
+            return None
+        #the index could be an alias of one other index
+        settings = list(response.values())[0]["settings"]["index"]
+        number_of_routing_shards = settings.get("number_of_routing_shards")
+        self.logger.debug("routing documents of %s to %s shards", index,
+            settings["number_of_shards"])
+        return (int(settings["number_of_shards"]),
+            int(number_of_routing_shards) if number_of_routing_shards else None)
+
+    def _adapt(self, seconds, rejected):
+        """change the target size of requests after one took seconds"""
+        with self.lock:
+            target_bytes = self.target_bytes
+            if rejected or seconds > self.target_latency:
+                target_bytes = max(self.min_bytes, target_bytes // 2)
+            elif seconds < self.target_latency / 2.:
+                target_bytes = min(self.max_bytes, target_bytes + target_bytes // 4)
+            if target_bytes != self.target_bytes:
+                self.logger.debug("bulk request of %.1fs%s, changing size from %d to %d bytes",
+                    seconds, " with rejections" if rejected else "",
+                    self.target_bytes, target_bytes)
+                self.target_bytes = target_bytes
+
+    def _backoff(self, attempt):
+        return min(self.max_backoff, self.initial_backoff * 2 ** attempt)
+
+    def _send_chunk(self, chunk):
+        """
+        Send a list of encoded actions in one bulk request, retrying
+        rejected ones, and returns a tuple of how many were written and failed
+        """
+        written = 0
+        failures = []
+        attempt = 0
+        while chunk:
+            body = b"".join(chunk)
+
+            start = time.time()
+            try:
+                response = self.client.bulk(body=body)
+            except TransportError as e:
+                self._adapt(time.time() - start, e.status_code == 429)
+                if e.status_code == 429 and attempt < self.max_retries:
+                    self._retry(len(chunk), attempt)
+                    attempt += 1
+                    continue
+                failures.extend((item, e.status_code, e.error) for item in chunk)
+                break
+
+            retries = []
+            rejected = False
+            for item, result in zip(chunk, response["items"]):
+                _, info = result.popitem()
+                status = info.get("status", 500)
+                rejected = rejected or status == 429
+                if 200 <= status < 300 or status in self.ignore_status:
+                    written += 1
+                elif status == 429 and attempt < self.max_retries:
+                    retries.append(item)
+                else:
+                    failures.append((item, status, info.get("error")))
+            self._adapt(time.time() - start, rejected)
+            if retries:
+                self._retry(len(retries), attempt)
+                attempt += 1
+            chunk = retries
+
+        self._dead_letter(failures)
+        with self.lock:
+            self.written += written
+            self.failed += len(failures)
+        return written, len(failures)
+
+    def _retry(self, count, attempt):
+        backoff = self._backoff(attempt)
+        self.logger.warning("%d documents rejected, retrying in %ds", count, backoff)
+        with self.lock:
+            self.retried += count
+        time.sleep(backoff)
+
+    def _dead_letter(self, failures):
+        """append failed documents to a file per index in the dead letter directory"""
+        if not failures or not self.dead_letter:
+            return
+        by_index = {}
+        for item, status, error in failures:
+            #only split on newlines, sources can have other line separators in strings
+            lines = item.rstrip(b"\n").split(b"\n")
+            op_type, meta = list(json.loads(lines[0].decode("utf-8")).items())[0]
+            data = json.loads(lines[1].decode("utf-8")) if len(lines) > 1 else None
+            by_index.setdefault(meta.get("_index"), []).append(json.dumps(
+                dict(op_type=op_type, action=meta, source=data, status=status, error=error)))
+        with self.lock:
+            if not os.path.isdir(self.dead_letter):
+                os.makedirs(self.dead_letter)
+            for index in by_index:
+                filename = os.path.join(self.dead_letter, "%s.ndjson" % index)
+                with open(filename, "a") as dead_letter_file:
+                    for line in by_index[index]:
+                        dead_letter_file.write(line + "\n")
+
+
+class FolderIndexManager(object):
+    """
+    Context manager to open a folder for an index, with the settings and
+    mappings of the index, for a FolderWriter to write its documents into
+    """
+
+    def __init__(self, folder, index_name, settings={}, mappings={}, append_data=False):
+        self.logger = logging.getLogger(__name__)
+        self.index_name = index_name
+        #for compatibility with ElasticsearchBulkIndexManager
+        self.write_index = index_name
+        self.folder = os.path.join(folder, index_name)
+        self.settings = settings
+        self.mappings = mappings
+        self.append_data = append_data
+
+    def __enter__(self):
+        if os.path.isdir(self.folder) and not self.append_data:
+            self.logger.debug("deleting folder %s", self.folder)
+            shutil.rmtree(self.folder)
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        self.logger.info("writing %s into %s", self.index_name, self.folder)
+        for name, content in (("settings", self.settings), ("mappings", self.mappings)):
+            with open(os.path.join(self.folder, "%s.json" % name), "w") as sidecar:
+                json.dump(content, sidecar)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return None
+
+
+class FolderWriter(BulkWriter):
+    """
+    Write actions as gzipped NDJSON bulk request bodies into a folder per
+    index, opened by a FolderIndexManager, instead of to elasticsearch.
+
+    Each chunk is compressed by a worker thread on its own, and appended to
+    the current file of its index, starting a new one when it is larger than
+    part_bytes
+    """
+
+    def __init__(self, folder, workers=0, queue_size=8, part_bytes=FOLDER_PART_BYTES,
+            compress_level=6):
+        super(FolderWriter, self).__init__(None, workers, queue_size, route_shards=False)
+        self.folder = folder
+        self.part_bytes = part_bytes
+        self.compress_level = compress_level
+        #number and size of the file being appended to by index
+        self.parts = {}
+
+    def _send_chunk(self, chunk):
+        by_index = {}
+        for item in chunk:
+            _, meta = get_action_meta(item)
+            by_index.setdefault(meta.get("_index"), []).append(item)
+        for index in by_index:
+            #gzip members can be concatenated
+            compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED, 31)
+            data = compressor.compress(b"".join(by_index[index])) + compressor.flush()
+            with self.lock:
+                with open(self._get_part(index, len(data)), "ab") as part_file:
+                    part_file.write(data)
+        with self.lock:
+            self.written += len(chunk)
+        return len(chunk), 0
+
+    def _get_part(self, index, size):
+        """the file to append size bytes of index to"""
+        folder = os.path.join(self.folder, index)
+        if index not in self.parts:
+            #don't append to files of a previous writer
+            self.parts[index] = [len(get_folder_parts(folder)), 0]
+        part = self.parts[index]
+        if part[1] and part[1] + size > self.part_bytes:
+            part[0] += 1
+            part[1] = 0
+        part[1] += size
+        return os.path.join(folder, "part-%05d.ndjson.gz" % part[0])
+
+
+def get_folder_parts(folder):
+    """names of the files of an index written by FolderWriter, in order"""
+    return sorted(glob.glob(os.path.join(folder, "part-*.ndjson.gz")))
+
+
+def _read_folder_parts(filenames, index):
+    """tuples of the _id, or None, and encoded action in files written by
+    FolderWriter, for index"""
+    for filename in filenames:
+        with gzip.open(filename, "rb") as part_file:
+            action = None
+            for line in part_file:
+                if action is not None:
+                    yield action[0], action[1] + line
+                    action = None
+                    continue
+                op_type, meta = get_action_meta(line)
+                #the index could be an alias
+                meta["_index"] = index
+                encoded = _serializer.dumps({op_type: meta}).encode("utf-8") + b"\n"
+                if op_type == "delete":
+                    yield meta.get("_id"), encoded
+                else:
+                    action = (meta.get("_id"), encoded)
+
+
+def read_folder_actions(filenames, index):
+    """
+    Encoded actions in files written by FolderWriter, for index, keeping only
+    the last one of each _id so they can be sent by several workers in any 
+    order. Files are read twice, to hold only the position of each _id.
+
+    Writers append after the files of previous ones, but a writer with workers 
+    can write its own chunks in any order, so it should not write an _id twice
+    """
+    last = {}
+    for position, (doc_id, _) in enumerate(_read_folder_parts(filenames, index)):
+        if doc_id is not None:
+            last[doc_id] = position
+    for position, (doc_id, action) in enumerate(_read_folder_parts(filenames, index)):
+        if doc_id is None or last[doc_id] == position:
+            yield action
+
+
+def load_folder(client, folder, workers=0, queue_size=8, dead_letter=None):
+    """
+    Load each index written into folder by a FolderWriter into elasticsearch,
+    replacing it with the last action of each document. Returns a tuple of 
+    the number of documents written and failed
+
+    client also force merges the indexes, so should be a bulk-write client
+    """
+    logger = logging.getLogger(__name__)
+    written = 0
+    failed = 0
+    for index_name in sorted(os.listdir(folder)):
+        index_folder = os.path.join(folder, index_name)
+        if not os.path.isfile(os.path.join(index_folder, "settings.json")):
+            continue
+        with open(os.path.join(index_folder, "settings.json")) as settings_file:
+            settings = json.load(settings_file)
+        with open(os.path.join(index_folder, "mappings.json")) as mappings_file:
+            mappings = json.load(mappings_file)
+        filenames = get_folder_parts(index_folder)
+
+        logger.info("loading %d files of %s", len(filenames), index_name)
+        with ElasticsearchBulkIndexManager(client, index_name, settings, mappings) as index_manager:
+            #deletes replayed into a new index have nothing to delete
+            writer = BulkWriter(client, workers, queue_size, dead_letter,
+                ignore_status=(404,))
+            index_written, index_failed = writer.write(
+                read_folder_actions(filenames, index_manager.write_index))
+        written += index_written
+        failed += index_failed
+    return written, failed
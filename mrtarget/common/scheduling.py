@@ -0,0 +1,79 @@
+import zlib
+
+from elasticsearch_dsl import Search
+
+#number of entities to get in each page of a composite aggregation
+COMPOSITE_PAGE_SIZE = 10000
+
+
+def in_part(key, part, parts):
+    """stable partition of string keys, the same in every process"""
+    return zlib.crc32(key.encode("utf-8")) % parts == part
+
+
+def get_keys(es, index, field, query=None, page_size=COMPOSITE_PAGE_SIZE):
+    """
+    Yield all the distinct values of field in index, optionally only of the
+    documents matching query, paging through a composite aggregation
+    """
+    for key, count in get_key_counts(es, index, field, query, page_size):
+        yield key
+
+
+def get_key_counts(es, index, field, query=None, page_size=COMPOSITE_PAGE_SIZE):
+    """
+    Yield (value, count) tuples of all the distinct values of field in index and
+    the number of documents with them, optionally only of the documents
+    matching query, paging through a composite aggregation
+    """
+    after = None
+    while True:
+        s = Search().using(es).index(index).extra(size=0)
+        if query is not None:
+            s = s.query(query)
+        composite = dict(sources=[{"entity": {"terms": {"field": field}}}], size=page_size)
+        if after is not None:
+            composite["after"] = after
+        s.aggs.bucket("entities", "composite", **composite)
+        response = s.execute()
+
+        entities = response.aggregations["entities"]
+        for bucket in entities.buckets:
+            yield bucket.key["entity"], bucket.doc_count
+
+        after = entities.to_dict().get("after_key")
+        if after is None or len(entities.buckets) < page_size:
+            break
+
+
+def log_progress(counts, logger, name, every=1000):
+    """
+    Yield (entity, count) tuples from a list of them, logging how many of the 
+    entities and of their total count have been passed on so far
+    """
+    total_entities = len(counts)
+    total = sum(count for _, count in counts)
+    done_entities = 0
+    done = 0
+    for entity, count in counts:
+        yield entity, count
+        done_entities += 1
+        done += count
+        if done_entities % every == 0 or done_entities == total_entities:
+            logger.info("dispatched %d of %d %s (%d of %d documents)",
+                done_entities, total_entities, name, done, total)
+
+
+def parse_shard(value):
+    """
+    Parse a shard as "i/N" into a tuple of integers (i, N) where 0 <= i < N
+
+    Intended for use as an argparse type
+    """
+    try:
+        part, parts = [int(v) for v in value.split("/")]
+    except ValueError:
+        raise ValueError("shard must be i/N, not %s" % value)
+    if parts < 1 or part < 0 or part >= parts:
+        raise ValueError("shard must be i/N with 0 <= i < N, not %s" % value)
+    return part, parts
@@ -0,0 +1,110 @@
+from __future__ import division
+from builtins import object
+import math
+
+import numpy as np
+
+
+class TDigest(object):
+
+    def __init__(self, compression=100, buffer_size=1000):
+        """
+        A t-digest sketch of a stream of numbers, to estimate its quantiles in
+        bounded memory
+
+        Values are buffered and then merged into at most about compression
+        centroids, which are smaller near the extremes so that the tails are
+        more accurate than the middle. See Dunning and Ertl, "Computing
+        extremely accurate quantiles using t-digests"
+        Args:
+            compression: the number of centroids to aim for
+            buffer_size: number of values to buffer before merging them
+        """
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        self.buffer = []
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        value = float(value)
+        self.buffer.append(value)
+        self.count += 1
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self.buffer) >= self.buffer_size:
+            self._merge(np.array(self.buffer), np.ones(len(self.buffer)))
+            self.buffer = []
+
+    def update(self, other):
+        """add all the values of another TDigest to this one"""
+        other._flush()
+        if other.count == 0:
+            return
+        self._flush()
+        self._merge(other.means, other.weights)
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def _flush(self):
+        if self.buffer:
+            self._merge(np.array(self.buffer), np.ones(len(self.buffer)))
+            self.buffer = []
+
+    def _q_limit(self, q):
+        #inverse of the k1 scale function, one step of k after q
+        k = math.asin(2. * q - 1.) + 2. * math.pi / self.compression
+        return (math.sin(min(k, math.pi / 2.)) + 1.) / 2.
+
+    def _merge(self, means, weights):
+        means = np.concatenate((self.means, means))
+        weights = np.concatenate((self.weights, weights))
+        order = np.argsort(means, kind='mergesort')
+        means = means[order]
+        weights = weights[order]
+        total = weights.sum()
+
+        new_means = []
+        new_weights = []
+        mean, weight = means[0], weights[0]
+        before = 0.
+        limit = self._q_limit(0.) * total
+        for m, w in zip(means[1:], weights[1:]):
+            if before + weight + w <= limit:
+                #merge into the current centroid
+                weight += w
+                mean += (m - mean) * w / weight
+            else:
+                new_means.append(mean)
+                new_weights.append(weight)
+                before += weight
+                limit = self._q_limit(before / total) * total
+                mean, weight = m, w
+        new_means.append(mean)
+        new_weights.append(weight)
+
+        self.means = np.array(new_means)
+        self.weights = np.array(new_weights)
+
+    def quantile(self, q):
+        """
+        Estimate the value at quantile q, between 0 and 1, or None if no
+        values have been added
+        """
+        self._flush()
+        if self.count == 0:
+            return None
+        if len(self.means) == 1:
+            return float(self.means[0])
+
+        #interpolate between the centers of the centroids, and the extremes
+        centers = np.cumsum(self.weights) - self.weights / 2.
+        positions = np.concatenate(([0.], centers, [self.count]))
+        values = np.concatenate(([self.min], self.means, [self.max]))
+        return float(np.interp(q * self.count, positions, values))
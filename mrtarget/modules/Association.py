@@ -2,29 +2,59 @@ from builtins import str
 from builtins import object
 import logging
 import copy
+import os
 
 import functools
+import glob
+import gzip
+import hashlib
+import heapq
 import itertools
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
-from mrtarget.common.DataStructure import JSONSerializable
+from mrtarget.common.esutil import open_index, new_bulk_writer, prepare_shared_index, \
+    get_shared_index, finish_shared_index, get_alias_indexes
+from mrtarget.common.DataStructure import JSONSerializable, PipelineEncoder, json_serialize
 from mrtarget.common.connection import new_es_client
 from mrtarget.common.LookupHelpers import LookUpDataRetriever
-from mrtarget.common.Scoring import ScoringMethods, HarmonicSumScorer
+from mrtarget.common.scheduling import get_keys, get_key_counts, in_part, log_progress
+from mrtarget.common.tdigest import TDigest
+from mrtarget.common.Scoring import ScoringMethods, HarmonicSumScorer, ALL_SCORING_METHODS
 from mrtarget.modules.EFO import EFO
 from mrtarget.common.EvidenceString import Evidence, ExtendedInfoGene, ExtendedInfoEFO
 from mrtarget.modules.GeneData import Gene
 from mrtarget.modules.HPA import HPAExpression, hpa2tissues
+from mrtarget.modules.RawScores import get_raw_scores, open_raw_scores, write_raw_scores
 from opentargets_urlzsource import URLZSource
 
-import elasticsearch
-from elasticsearch import helpers
 from elasticsearch_dsl import Search
-from elasticsearch_dsl.query import MatchAll, ConstantScore, Q
+from elasticsearch_dsl.query import MatchAll, ConstantScore, Q, Range
 import pypeln.process as pr
+import cachetools
+import sys
+import tempfile
 import simplejson as json
+import numpy as np
+
+#fields of the gene and disease documents read when building an association
+#only these are fetched and cached by the lookup tables
+GENE_SOURCE_INCLUDES = ['id', 'approved_symbol', 'approved_name', 
+    'ensembl_external_name', 'ensembl_description', 'tractability', 
+    '_private.facets.reactome', 'go', 'uniprot_keywords', 'protein_classification']
+EFO_SOURCE_INCLUDES = ['code', 'label', 'path_codes', 
+    'therapeutic_codes', 'therapeutic_labels']
+#fields of the evidence documents read when scoring
+EVIDENCE_SOURCE_INCLUDES = ['target.id', 'private.efo_codes', 'disease.id',
+    'scores.association_score','sourceID','id']
+#number of target blocks kept by each AssociationEnricher
+TARGET_BLOCK_CACHE_SIZE = 16
+#quantiles of the scores reported by AssociationQC
+QC_QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+#number of targets to remove associations for at once in incremental runs
+INCREMENTAL_BATCH_SIZE = 100
+#number of targets to read evidence for in each query, below the max_terms_count of indexes
+TARGETS_BATCH_SIZE = 10000
 
 
 class AssociationScore(JSONSerializable):
@@ -38,17 +68,159 @@ class AssociationScore(JSONSerializable):
             self.datatypes[datatype] = 0.0
 
 
+def _tractability_facets(gene_obj):
+    def _create_facet(categories_dict):
+        if isinstance(categories_dict, dict):
+            result = []
+            for e in categories_dict.items():
+                if e[1] > 0:
+                    result.append(e[0])
+            return result
+        else:
+            return []
+
+    def _merge_facets(the_dict):
+        if isinstance(the_dict, dict):
+            result = []
+            for e in the_dict.items():
+                for el in e[1]:
+                    result.append(e[0] + '_' + el)
+            return result
+        else:
+            return []
+
+    # inject tractability data from the gene into the assoc
+    trac_fields = ["smallmolecule", "antibody"]
+    # trac_subfields = ["buckets", "categories"]
+
+    tractability = \
+        {cat: _create_facet(gene_obj.tractability[cat]['categories']) for cat in trac_fields}
+    tractability['combined'] = _merge_facets(tractability)
+    return tractability
+
+def get_target_block(gene, hpa=None):
+    """build the target side of an association from a Gene and an optional
+    HPAExpression
+
+    returns a tuple of the extra target fields, the facets and the free text 
+    search terms. It is the same for all the associations of a target so it 
+    only needs to be built once per target"""
+    target_data = {}
+    facets = {}
+    free_text_search = []
+
+    pathway_data = dict(pathway_type_code=[],
+                        pathway_code=[])
+
+    GO_terms = dict(biological_process=[],
+                    cellular_component=[],
+                    molecular_function=[],
+                    )
+
+    target_class = dict(level1=[],
+                        level2=[])
+
+    uniprot_keywords = []
+
+    #TODO: handle domains
+    genes_info=ExtendedInfoGene(gene)
+
+    if gene and gene.tractability:
+        # we do have tractability data
+        target_data['tractability'] = copy.deepcopy(gene.tractability)
+        # build facet for the types
+        facets['tractability'] = _tractability_facets(gene)
+
+    '''collect data to use for free text search'''
+    for el in ['geneid', 'name', 'symbol']:
+        free_text_search.append(genes_info.data[el])
+
+    if 'facets' in gene._private and 'reactome' in gene._private['facets']:
+        pathway_data['pathway_type_code'].extend(gene._private['facets']['reactome']['pathway_type_code'])
+        pathway_data['pathway_code'].extend(gene._private['facets']['reactome']['pathway_code'])
+    if gene.go:
+        for item in gene.go:
+            go_code, data = item['id'], item['value']
+            try:
+                category,term = data['term'][0], data['term'][2:]
+                if category =='P':
+                    GO_terms['biological_process'].append(dict(code=go_code,
+                                                               term=term))
+                elif category =='F':
+                    GO_terms['molecular_function'].append(dict(code=go_code,
+                                                               term=term))
+                elif category =='C':
+                    GO_terms['cellular_component'].append(dict(code=go_code,
+                                                               term=term))
+            except:
+                pass
+
+    if gene.uniprot_keywords:
+        uniprot_keywords = gene.uniprot_keywords
+
+    if genes_info:
+        target_data[ExtendedInfoGene.root] = genes_info.data
+
+    if pathway_data['pathway_code']:
+        pathway_data['pathway_type_code']=sorted(set(pathway_data['pathway_type_code']))
+        pathway_data['pathway_code']=sorted(set(pathway_data['pathway_code']))
+    if 'chembl' in gene.protein_classification and gene.protein_classification['chembl']:
+        target_class['level1'].append([i['l1'] for i in gene.protein_classification['chembl'] if 'l1' in i])
+        target_class['level2'].append([i['l2'] for i in gene.protein_classification['chembl'] if 'l2' in i])
+
+    '''Add private objects used just for indexing'''
+
+    if pathway_data['pathway_code']:
+        facets['reactome']= pathway_data
+    if uniprot_keywords:
+        facets['uniprot_keywords'] = uniprot_keywords
+    if GO_terms['biological_process'] or \
+        GO_terms['molecular_function'] or \
+        GO_terms['cellular_component'] :
+        facets['go'] = GO_terms
+    if target_class['level1']:
+        facets['target_class'] = target_class
+
+    if hpa is not None:
+        try:
+            filteredHPA = hpa2tissues(hpa)
+            if filteredHPA is not None and len(filteredHPA) > 0:
+                facets['expression_tissues'] = filteredHPA
+        except KeyError:
+            pass
+
+    return target_data, facets, free_text_search
+
+def get_disease_block(efo):
+    """build the disease side of an association from an EFO
+
+    returns a tuple of the extra disease fields and the free text search terms"""
+    disease_data = {}
+    efo_info=ExtendedInfoEFO(efo)
+    '''collect data to use for free text search'''
+    free_text_search = [efo_info.data['efo_id'], efo_info.data['label']]
+    free_text_search.extend(efo_info.data['therapeutic_area']['labels'])
+
+    if efo_info:
+        disease_data[ExtendedInfoEFO.root] = efo_info.data
+    return disease_data, free_text_search
+
+
 class Association(JSONSerializable):
 
-    def __init__(self, target, disease, is_direct, datasources, datatypes):
+    def __init__(self, target, disease, is_direct, datasources, datatypes,
+            scoring_methods=None):
+        """scoring_methods is an optional list of the ScoringMethods to include, 
+        by default all of them are included"""
         self.target = {'id': target}
         self.disease = {'id': disease}
         self.is_direct = is_direct
         self.set_id()
 
-        for method_key, method in list(ScoringMethods.__dict__.items()):
-            if not method_key.startswith('_'):
-                self.set_scoring_method(method, AssociationScore(datasources, datatypes))
+        if scoring_methods is None:
+            scoring_methods = ALL_SCORING_METHODS
+        for method in scoring_methods:
+            self.set_scoring_method(method, AssociationScore(datasources, datatypes))
 
         self.evidence_count = dict(total=0.0,
                                    datatypes={},
@@ -87,113 +259,9 @@ class Association(JSONSerializable):
     def set_id(self):
         self.id = '%s-%s' % (self.target['id'], self.disease['id'])
 
-    def _inject_tractability_in_target(self, gene_obj):
-        def _create_facet(categories_dict):
-            if isinstance(categories_dict, dict):
-                result = []
-                for e in categories_dict.items():
-                    if e[1] > 0:
-                        result.append(e[0])
-                return result
-            else:
-                return []
-
-        def _merge_facets(the_dict):
-            if isinstance(the_dict, dict):
-                result = []
-                for e in the_dict.items():
-                    for el in e[1]:
-                        result.append(e[0] + '_' + el)
-                return result
-            else:
-                return []
-
-        if gene_obj:
-            # inject tractability data from the gene into the assoc
-            trac_fields = ["smallmolecule", "antibody"]
-            # trac_subfields = ["buckets", "categories"]
-
-            if gene_obj.tractability:
-                # we do have tractability data
-                self.target['tractability'] = copy.deepcopy(gene_obj.tractability)
-
-                # build facet for the types
-                self.private['facets']['tractability'] = \
-                    {cat: _create_facet(gene_obj.tractability[cat]['categories']) for cat in trac_fields}
-
-                self.private['facets']['tractability']['combined'] = \
-                    _merge_facets(self.private['facets']['tractability'])
-
     def set_target_data(self, gene):
         """get generic gene info"""
-        pathway_data = dict(pathway_type_code=[],
-                            pathway_code=[])
-
-        GO_terms = dict(biological_process=[],
-                        cellular_component=[],
-                        molecular_function=[],
-                        )
-
-        target_class = dict(level1=[],
-                            level2=[])
-
-        uniprot_keywords = []
-
-        #TODO: handle domains
-        genes_info=ExtendedInfoGene(gene)
-
-        self._inject_tractability_in_target(gene)
-
-        '''collect data to use for free text search'''
-        for el in ['geneid', 'name', 'symbol']:
-            self.private['facets']['free_text_search'].append(
-                genes_info.data[el])
-
-        if 'facets' in gene._private and 'reactome' in gene._private['facets']:
-            pathway_data['pathway_type_code'].extend(gene._private['facets']['reactome']['pathway_type_code'])
-            pathway_data['pathway_code'].extend(gene._private['facets']['reactome']['pathway_code'])
-        if gene.go:
-            for item in gene.go:
-                go_code, data = item['id'], item['value']
-                try:
-                    category,term = data['term'][0], data['term'][2:]
-                    if category =='P':
-                        GO_terms['biological_process'].append(dict(code=go_code,
-                                                                   term=term))
-                    elif category =='F':
-                        GO_terms['molecular_function'].append(dict(code=go_code,
-                                                                   term=term))
-                    elif category =='C':
-                        GO_terms['cellular_component'].append(dict(code=go_code,
-                                                                   term=term))
-                except:
-                    pass
-
-        if gene.uniprot_keywords:
-            uniprot_keywords = gene.uniprot_keywords
-
-        if genes_info:
-            self.target[ExtendedInfoGene.root] = genes_info.data
-
-        if pathway_data['pathway_code']:
-            pathway_data['pathway_type_code']=list(set(pathway_data['pathway_type_code']))
-            pathway_data['pathway_code']=list(set(pathway_data['pathway_code']))
-        if 'chembl' in gene.protein_classification and gene.protein_classification['chembl']:
-            target_class['level1'].append([i['l1'] for i in gene.protein_classification['chembl'] if 'l1' in i])
-            target_class['level2'].append([i['l2'] for i in gene.protein_classification['chembl'] if 'l2' in i])
-
-        '''Add private objects used just for indexing'''
-
-        if pathway_data['pathway_code']:
-            self.private['facets']['reactome']= pathway_data
-        if uniprot_keywords:
-            self.private['facets']['uniprot_keywords'] = uniprot_keywords
-        if GO_terms['biological_process'] or \
-            GO_terms['molecular_function'] or \
-            GO_terms['cellular_component'] :
-            self.private['facets']['go'] = GO_terms
-        if target_class['level1']:
-            self.private['facets']['target_class'] = target_class
+        self.set_target_block(get_target_block(gene))
 
     def set_hpa_data(self, hpa):
         '''set a compat hpa expression data into the score object'''
@@ -203,14 +271,23 @@ class Association(JSONSerializable):
 
     def set_disease_data(self, efo):
         """get generic efo info"""
-        efo_info=ExtendedInfoEFO(efo)
-        '''collect data to use for free text search'''
-        self.private['facets']['free_text_search'].append(efo_info.data['efo_id'])
-        self.private['facets']['free_text_search'].append(efo_info.data['label'])
-        self.private['facets']['free_text_search'].extend(efo_info.data['therapeutic_area']['labels'])
+        self.set_disease_block(get_disease_block(efo))
+
+    def set_target_block(self, block):
+        """attach a block from get_target_block
 
-        if efo_info:
-            self.disease[ExtendedInfoEFO.root] = efo_info.data
+        the block is shared by reference between all the associations of a 
+        target, so it must not be changed afterwards"""
+        target_data, facets, free_text_search = block
+        self.target.update(target_data)
+        self.private['facets'].update(facets)
+        self.private['facets']['free_text_search'].extend(free_text_search)
+
+    def set_disease_block(self, block):
+        """attach a block from get_disease_block, shared by reference"""
+        disease_data, free_text_search = block
+        self.disease.update(disease_data)
+        self.private['facets']['free_text_search'].extend(free_text_search)
 
     def set_available_datasource(self, ds):
         if ds not in self.private['facets']['datasource']:
@@ -221,6 +298,44 @@ class Association(JSONSerializable):
             self.private['facets']['datatype'].append(dt)
             self.private['facets']['free_text_search'].append(dt)
 
+    def to_json(self, skip_zero_scores=False):
+        """if skip_zero_scores is True, datasources and datatypes without score or 
+        evidence are not written, nor are scoring methods without any score
+
+        the datatype, datasource and free text facets are sorted, so the same 
+        association is written the same whatever order its evidence was read in"""
+        def _non_zero(values):
+            return dict((k, v) for k, v in values.items() if v)
+
+        data = dict(self.__dict__)
+        facets = dict(self.private['facets'])
+        for facet in ['datatype', 'datasource', 'free_text_search']:
+            facets[facet] = sorted(facets[facet], key=str)
+        data['private'] = dict(self.private, facets=facets)
+        if not skip_zero_scores:
+            return json.dumps(data,
+                              default=json_serialize,
+                              sort_keys=True,
+                              cls=PipelineEncoder)
+
+        for method in ALL_SCORING_METHODS:
+            if method in data:
+                score = dict(data[method].__dict__)
+                score['datasources'] = _non_zero(score['datasources'])
+                score['datatypes'] = _non_zero(score['datatypes'])
+                if score['datasources'] or score['datatypes'] or score.get('overall'):
+                    data[method] = score
+                else:
+                    del data[method]
+        data['evidence_count'] = dict(self.evidence_count,
+            datasources=_non_zero(self.evidence_count['datasources']),
+            datatypes=_non_zero(self.evidence_count['datatypes']))
+
+        return json.dumps(data,
+                          default=json_serialize,
+                          sort_keys=True,
+                          cls=PipelineEncoder)
+
     def __bool__(self):
         return self.get_scoring_method(ScoringMethods.HARMONIC_SUM).overall != 0
         
@@ -228,55 +343,65 @@ class Association(JSONSerializable):
 
 
 class EvidenceScore(object):
-    def __init__(self, score, datatype, datasource, is_direct):
+    def __init__(self, score, datatype, datasource, is_direct, count=1):
+        """count is the number of evidence this stands for, see merge_evidence_runs"""
         self.score = score
         self.datatype = datatype
         self.datasource = datasource
         self.is_direct = is_direct
+        self.count = count
 
 
 class Scorer(object):
     '''
     Aggregates evidence for a given target-disease pair
     '''
-    def __init__(self):
-        pass
+    def __init__(self, scoring_methods=None):
+        self.scoring_methods = scoring_methods
 
     def score(self,target, disease, evidence_scores, is_direct, datasources_to_datatypes):
+        association = self.build(target, disease, evidence_scores, is_direct, 
+            datasources_to_datatypes)
+
+        # compute harmonic sum with quadratic (scale_factor) degradation
+        #limit to first 100 entries and scale with afactor of 2
+        self._harmonic_sum(evidence_scores, association, 100, 2, datasources_to_datatypes)
 
+        return association
 
+    def build(self, target, disease, evidence_scores, is_direct, datasources_to_datatypes):
+        """the association of a pair with its evidence counts and facets, before scoring"""
         datasources = list(datasources_to_datatypes.keys())
         datatypes = set(datasources_to_datatypes.values())
 
-        association = Association(target, disease, is_direct, datasources, datatypes)
+        association = Association(target, disease, is_direct, datasources, datatypes,
+            self.scoring_methods)
 
         # set evidence counts
         for e in evidence_scores:
             # make sure datatype is constrained
             if all([e.datatype in association.evidence_count['datatypes'],
                     e.datasource in association.evidence_count['datasources']]):
-                association.evidence_count['total']+=1
-                association.evidence_count['datatypes'][e.datatype]+=1
-                association.evidence_count['datasources'][e.datasource]+=1
+                association.evidence_count['total']+=e.count
+                association.evidence_count['datatypes'][e.datatype]+=e.count
+                association.evidence_count['datasources'][e.datasource]+=e.count
 
                 # set facet data
                 association.set_available_datatype(e.datatype)
                 association.set_available_datasource(e.datasource)
 
-        # compute harmonic sum with quadratic (scale_factor) degradation
-        #limit to first 100 entries and scale with afactor of 2
-        self._harmonic_sum(evidence_scores, association, 100, 2, datasources_to_datatypes)
-
         return association
 
     def _harmonic_sum(self, evidence_scores, association, 
             max_entries, scale_factor, datasources_to_datatypes):
         har_sum_score = association.get_scoring_method(ScoringMethods.HARMONIC_SUM)
-        datasource_scorers = {}
+        datasource_scores = defaultdict(list)
         for e in evidence_scores:
-            if e.datasource not in datasource_scorers:
-                datasource_scorers[e.datasource]= HarmonicSumScorer(buffer=max_entries)
-            datasource_scorers[e.datasource].add(e.score)
+            datasource_scores[e.datasource].append(e.score)
+        datasource_scorers = {}
+        for datasource in datasource_scores:
+            datasource_scorers[datasource]= HarmonicSumScorer(buffer=max_entries)
+            datasource_scorers[datasource].add_many(datasource_scores[datasource])
         '''compute datasource scores'''
         overall_scorer = HarmonicSumScorer(buffer=max_entries)
         for datasource in datasource_scorers:
@@ -298,25 +423,529 @@ class Scorer(object):
 
         return association
 
-def produce_evidence_local_init(es_hosts, es_index_val_right,
-        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes):
-    es = new_es_client(es_hosts)
-    return (es, es_index_val_right, scoring_weights, 
+
+class ColumnarScorer(object):
+    '''
+    Aggregates all the evidence of a given target at once
+
+    Evidence is loaded into arrays of disease, datasource and score and the
+    harmonic sums are computed for all diseases together, so only the final
+    associations are built as objects. Scores match those of Scorer
+    '''
+    def __init__(self, max_entries=100, scale_factor=2, scoring_methods=None):
+        self.max_entries = max_entries
+        self.scale_factor = scale_factor
+        self.scoring_methods = scoring_methods
+
+    def score_target(self, target, evidences, scoring_weights, 
+            is_direct_do_not_propagate, datasources_to_datatypes):
+        datasources = list(datasources_to_datatypes.keys())
+        datatypes = set(datasources_to_datatypes.values())
+        datasource_index = dict((ds, i) for i, ds in enumerate(datasources))
+        datatypes_list = list(datatypes)
+        datatype_index = dict((dt, i) for i, dt in enumerate(datatypes_list))
+        datasource_datatype = np.array([datatype_index[datasources_to_datatypes[ds]] 
+            for ds in datasources], dtype=int)
+
+        #one row for each evidence and disease it is propagated to
+        diseases = []
+        disease_index = {}
+        disease_col = []
+        datasource_col = []
+        score_col = []
+        direct_col = []
+        for evidence in evidences:
+            data_source = evidence['sourceID']
+            if data_source in is_direct_do_not_propagate:
+                efo_list = [evidence['disease']['id']]
+            else:
+                efo_list = evidence['private']['efo_codes']
+
+            score = evidence['scores']['association_score']
+            if data_source in scoring_weights:
+                score = score * scoring_weights[data_source]
+
+            for efo in efo_list:
+                if efo not in disease_index:
+                    disease_index[efo] = len(diseases)
+                    diseases.append(efo)
+                disease_col.append(disease_index[efo])
+                datasource_col.append(datasource_index[data_source])
+                score_col.append(score)
+                direct_col.append(efo == evidence['disease']['id'])
+
+        if not diseases:
+            return []
+
+        n_diseases = len(diseases)
+        n_datasources = len(datasources)
+        n_datatypes = len(datatypes_list)
+        disease_col = np.array(disease_col, dtype=int)
+        datasource_col = np.array(datasource_col, dtype=int)
+        score_col = np.array(score_col, dtype=float)
+        row_col = np.arange(len(disease_col))
+
+        #datasource level, capped so very big scores do not take over
+        pair_col = disease_col * n_datasources + datasource_col
+        pair_counts = np.bincount(pair_col, minlength=n_diseases*n_datasources)
+        pair_scores_uncapped = HarmonicSumScorer.grouped_harmonic_sum(pair_col, score_col,
+            n_diseases*n_datasources, self.max_entries, self.scale_factor)
+        pair_scores = np.minimum(pair_scores_uncapped, 1)
+        pairs = np.flatnonzero(pair_counts)
+        pair_diseases = pairs // n_datasources
+        pair_datatypes = datasource_datatype[pairs % n_datasources]
+
+        #datatype and overall levels, from the datasource scores
+        datatype_scores = HarmonicSumScorer.grouped_harmonic_sum(
+            pair_diseases * n_datatypes + pair_datatypes, pair_scores[pairs],
+            n_diseases*n_datatypes, self.max_entries, self.scale_factor)
+        overall_scores = HarmonicSumScorer.grouped_harmonic_sum(
+            pair_diseases, pair_scores[pairs], 
+            n_diseases, self.max_entries, self.scale_factor)
+
+        is_direct = np.bincount(disease_col, weights=direct_col, minlength=n_diseases) > 0
+
+        #first evidence of each datasource and datatype, for ordering facets
+        pair_first = np.full(n_diseases*n_datasources, len(row_col), dtype=int)
+        np.minimum.at(pair_first, pair_col, row_col)
+        datatype_col = disease_col * n_datatypes + datasource_datatype[datasource_col]
+        datatype_counts = np.bincount(datatype_col, minlength=n_diseases*n_datatypes)
+        datatype_first = np.full(n_diseases*n_datatypes, len(row_col), dtype=int)
+        np.minimum.at(datatype_first, datatype_col, row_col)
+
+        associations = []
+        for d, disease in enumerate(diseases):
+            # skip associations only with data with score 0
+            if overall_scores[d] == 0:
+                continue
+
+            association = Association(target, disease, bool(is_direct[d]), 
+                datasources, datatypes, self.scoring_methods)
+            har_sum_score = association.get_scoring_method(ScoringMethods.HARMONIC_SUM)
+
+            facets = []
+            for ds in range(n_datasources):
+                pair = d * n_datasources + ds
+                if pair_counts[pair]:
+                    datasource = datasources[ds]
+                    association.evidence_count['datasources'][datasource] = float(pair_counts[pair])
+                    #match the cap of HarmonicSumScorer.harmonic_sum
+                    har_sum_score.datasources[datasource] = 1 \
+                        if pair_scores_uncapped[pair] > 1 else float(pair_scores[pair])
+                    facets.append((2 * pair_first[pair] + 1, False, datasource))
+            for dt in range(n_datatypes):
+                datatype = datatypes_list[dt]
+                har_sum_score.datatypes[datatype] = float(datatype_scores[d * n_datatypes + dt])
+                if datatype_counts[d * n_datatypes + dt]:
+                    association.evidence_count['datatypes'][datatype] = \
+                        float(datatype_counts[d * n_datatypes + dt])
+                    #datatype facet is set before the datasource of the same evidence
+                    facets.append((2 * datatype_first[d * n_datatypes + dt], True, datatype))
+            har_sum_score.overall = float(overall_scores[d])
+            association.evidence_count['total'] = \
+                float(sum(association.evidence_count['datasources'].values()))
+
+            for _, is_datatype, facet in sorted(facets):
+                if is_datatype:
+                    association.set_available_datatype(facet)
+                else:
+                    association.set_available_datasource(facet)
+
+            associations.append(association)
+
+        return associations
+
+class RollupScorer(object):
+    '''
+    Aggregates all the evidence of a given target in two phases
+
+    First the top scores of each datasource are kept for each disease with
+    direct evidence, then those partial scores are merged into every ancestor
+    of the disease. This gives the same associations as expanding each evidence
+    to all of its diseases, without handling each evidence for each ancestor
+    '''
+    def __init__(self, ancestors, max_entries=100, scale_factor=2, scoring_methods=None):
+        """ancestors is a dict of disease id to a collection of its ancestors
+        including itself, as in the efo_codes of the evidence"""
+        self.ancestors = ancestors
+        self.max_entries = max_entries
+        self.scale_factor = scale_factor
+        self.scoring_methods = scoring_methods
+
+    def score_target(self, target, evidences, scoring_weights, 
+            is_direct_do_not_propagate, datasources_to_datatypes):
+        datasources = list(datasources_to_datatypes.keys())
+        datatypes = set(datasources_to_datatypes.values())
+
+        #first phase, the partial scores of the direct diseases
+        #each partial is a scorer, an evidence count, and the first evidence position
+        direct_partials = OrderedDict()
+        ancestors = {}
+        for position, evidence in enumerate(evidences):
+            data_source = evidence['sourceID']
+            disease = evidence['disease']['id']
+
+            score = evidence['scores']['association_score']
+            if data_source in scoring_weights:
+                score = score * scoring_weights[data_source]
+
+            key = (disease, data_source)
+            if key not in direct_partials:
+                direct_partials[key] = [HarmonicSumScorer(buffer=self.max_entries), 0, position]
+            direct_partials[key][0].add(score)
+            direct_partials[key][1] += 1
+
+            if disease not in ancestors and data_source not in is_direct_do_not_propagate:
+                #fall back to the evidence if the disease was not preloaded
+                ancestors[disease] = self.ancestors.get(disease, 
+                    evidence['private']['efo_codes'])
+
+        #second phase, merge the partial scores up to each ancestor
+        partials = OrderedDict()
+        for (disease, data_source), (scorer, count, first) in direct_partials.items():
+            if data_source in is_direct_do_not_propagate:
+                efo_list = [disease]
+            else:
+                efo_list = ancestors[disease]
+            for efo in efo_list:
+                if efo not in partials:
+                    partials[efo] = OrderedDict()
+                if data_source not in partials[efo]:
+                    partials[efo][data_source] = [HarmonicSumScorer(buffer=self.max_entries), 0, first]
+                partial = partials[efo][data_source]
+                partial[0].add_many(scorer.data)
+                partial[1] += count
+                partial[2] = min(partial[2], first)
+
+        direct_diseases = set(disease for disease, _ in direct_partials)
+
+        associations = []
+        for efo in partials:
+            association = Association(target, efo, efo in direct_diseases, 
+                datasources, datatypes, self.scoring_methods)
+            har_sum_score = association.get_scoring_method(ScoringMethods.HARMONIC_SUM)
+
+            facets = []
+            datatypes_first = {}
+            overall_scorer = HarmonicSumScorer(buffer=self.max_entries)
+            for data_source, (scorer, count, first) in partials[efo].items():
+                data_type = datasources_to_datatypes[data_source]
+                association.evidence_count['total'] += count
+                association.evidence_count['datasources'][data_source] += count
+                association.evidence_count['datatypes'][data_type] += count
+                facets.append((2 * first + 1, False, data_source))
+                datatypes_first[data_type] = min(first, datatypes_first.get(data_type, first))
+
+                #cap datasource scores at this level so very big scores
+                #do not take over smaller score around the range of 1
+                har_sum_score.datasources[data_source] = scorer.score(
+                    scale_factor=self.scale_factor, cap=1)
+                overall_scorer.add(har_sum_score.datasources[data_source])
+
+            datatypes_scorers = dict()
+            for ds in har_sum_score.datasources:
+                dt = datasources_to_datatypes[ds]
+                if dt not in datatypes_scorers:
+                    datatypes_scorers[dt] = HarmonicSumScorer(buffer=self.max_entries)
+                datatypes_scorers[dt].add(har_sum_score.datasources[ds])
+            for datatype in datatypes_scorers:
+                har_sum_score.datatypes[datatype] = datatypes_scorers[datatype].score(
+                    scale_factor=self.scale_factor)
+            har_sum_score.overall = overall_scorer.score(scale_factor=self.scale_factor)
+
+            # skip associations only with data with score 0
+            if not association:
+                continue
+
+            #datatype facet is set before the datasource of the same evidence
+            for data_type in datatypes_first:
+                facets.append((2 * datatypes_first[data_type], True, data_type))
+            for _, is_datatype, facet in sorted(facets):
+                if is_datatype:
+                    association.set_available_datatype(facet)
+                else:
+                    association.set_available_datasource(facet)
+
+            associations.append(association)
+
+        return associations
+
+def get_disease_ancestors(es, index):
+    """
+    Read the ancestors of every disease, including itself
+
+    Returns a dict of disease id to a set of disease ids
+    """
+    ancestors = {}
+    for efo in Search().using(es).index(index).query(MatchAll()).source(
+            includes=['path_codes']).params(scroll='4h', size=1000).scan():
+        ancestors[efo.meta.id] = set(itertools.chain.from_iterable(efo.to_dict()['path_codes']))
+    return ancestors
+
+def produce_evidence_local_init(es_hosts, es_index_val_right, es_index_efo,
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes,
+        engine, scoring_methods, spill_threshold, raw_scores_dir, raw_scores_buffer):
+    es = new_es_client(es_hosts, "scan")
+    #the columnar and rollup engines score all the evidence of a target at once
+    #otherwise produce evidence for each pair to be scored separately
+    if engine == 'columnar':
+        produce_target = ColumnarScorer(scoring_methods=scoring_methods).score_target
+    elif engine == 'rollup':
+        produce_target = RollupScorer(get_disease_ancestors(es, es_index_efo),
+            scoring_methods=scoring_methods).score_target
+    else:
+        produce_target = functools.partial(produce_evidence_pairs, 
+            spill_threshold=spill_threshold)
+
+    #keep the raw scores of each target for reweighting later
+    if raw_scores_dir:
+        raw_file = open_raw_scores(raw_scores_dir)
+        produce_scored_target = produce_target
+        def produce_target(target, evidence, *args, **kwargs):
+            #the per-target reader gives a generator, which is read twice here
+            evidence = list(evidence)
+            raw_scores = get_raw_scores(evidence, is_direct_do_not_propagate, 
+                raw_scores_buffer)
+            if raw_scores is not None:
+                write_raw_scores(raw_file, target, raw_scores)
+            return produce_scored_target(target, evidence, *args, **kwargs)
+
+    return (es, es_index_val_right, produce_target, scoring_weights, 
         is_direct_do_not_propagate, datasources_to_datatypes)
 
 def get_evidence_for_target_simple(es, target, index):
-    fields = ['target.id', 'private.efo_codes', 'disease.id','scores.association_score','sourceID','id']
     evidence = Search().using(es).index(index).query(
         ConstantScore(filter=Q('term', target__id=target))
-    ).source(includes=fields).params(scroll='4h', size=1000).scan()
+    ).source(includes=EVIDENCE_SOURCE_INCLUDES).params(scroll='4h', size=1000).scan()
     for ev in evidence:
         yield ev.to_dict()
 
-def produce_evidence(target, es, es_index_val_right,
+def get_evidence_by_target(es, index, targets=None):
+    """
+    Read the whole evidence index in a single scroll sorted by target
+
+    Yields a (target, evidence list) tuple for each target that has evidence,
+    so the number of scroll contexts does not grow with the number of targets.
+    If targets is given, only the evidence of those targets is read, with a
+    scroll for each TARGETS_BATCH_SIZE of them
+    """
+    if targets is None:
+        queries = [MatchAll()]
+    else:
+        targets = sorted(targets)
+        queries = [ConstantScore(filter=Q('terms', **{'target.id': targets[i:i+TARGETS_BATCH_SIZE]}))
+            for i in range(0, len(targets), TARGETS_BATCH_SIZE)]
+    for query in queries:
+        #preserve_order is needed otherwise the scan helper replaces the sort with _doc
+        evidence = Search().using(es).index(index).query(query).sort('target.id'
+        ).source(includes=EVIDENCE_SOURCE_INCLUDES).params(scroll='4h', size=1000, preserve_order=True).scan()
+        evidence = (ev.to_dict() for ev in evidence)
+        for target, target_evidence in itertools.groupby(evidence, 
+                key=lambda ev: ev['target']['id']):
+            yield target, list(target_evidence)
+
+def get_scored_targets(es, index, scoring_weights):
+    """
+    The targets that have evidence with a score, from a datasource that is 
+    not weighted 0, so that are expected to have associations
+    """
+    scored = Range(**{'scores.association_score': {'gt': 0}})
+    zero_weighted = sorted(source for source, weight in scoring_weights.items() if weight == 0)
+    if zero_weighted:
+        scored = scored & ~Q('terms', **{'sourceID.keyword': zero_weighted})
+    return get_keys(es, index, 'target.id', scored)
+
+def evidence_digest(evidences):
+    """
+    Digest of the evidence of a target, independent of the order it was read in
+
+    Only the fields that are used for scoring are read, so anything that
+    changes the associations of a target also changes its digest
+    """
+    lines = sorted(json.dumps(ev, sort_keys=True) for ev in evidences)
+    digest = hashlib.sha1()
+    for line in lines:
+        digest.update(line.encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+def read_manifest(uri):
+    """read a manifest of target to evidence digest written by write_manifest"""
+    digests = {}
+    with URLZSource(uri).open() as manifest_file:
+        for line in manifest_file:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            line = line.strip()
+            if line and not line.startswith('#'):
+                target, digest = line.split('\t')
+                digests[target] = digest
+    return digests
+
+def read_manifest_build(uri):
+    """the build of the index a manifest was written for, or None if unknown"""
+    with URLZSource(uri).open() as manifest_file:
+        for line in manifest_file:
+            if isinstance(line, bytes):
+                line = line.decode('utf-8')
+            if line.startswith('#build\t'):
+                return line.strip().split('\t')[1]
+            return None
+    return None
+
+def write_manifest(filename, digests, build=None):
+    """write a manifest of target to evidence digest as tab-separated lines, 
+    gzipped if the filename ends with .gz, after the build of the index they
+    were written into if given"""
+    if filename.endswith('.gz'):
+        manifest_file = gzip.open(filename, 'wt')
+    else:
+        manifest_file = open(filename, 'w')
+    with manifest_file:
+        if build is not None:
+            manifest_file.write('#build\t%s\n' % build)
+        for target in sorted(digests):
+            manifest_file.write('%s\t%s\n' % (target, digests[target]))
+
+def get_current_build(es, index):
+    """the index readers of a name see, the current build if it is an alias"""
+    current = get_alias_indexes(es, index)
+    return current[0] if len(current) == 1 else index
+
+def delete_target_associations(es, index, targets):
+    """remove all the associations of the given targets"""
+    es.delete_by_query(index=index, 
+        body={'query': {'terms': {'target.id': list(targets)}}},
+        conflicts='proceed', refresh=True)
+
+def get_changed_evidence_by_target(evidence_by_target, digests, 
+        previous_digests, es, index, dry_run):
+    """
+    Filter (target, evidence list) tuples down to the targets whose evidence
+    differs from the previous manifest
+
+    The digest of every target is stored in digests. The existing associations of
+    changed targets are removed before they are passed on to be rescored, and 
+    the associations of targets that no longer have any evidence are removed at 
+    the end. When previous_digests is None every target is passed on
+    """
+    batch = []
+    changed = 0
+    for target, evidence in evidence_by_target:
+        digest = evidence_digest(evidence)
+        digests[target] = digest
+        if previous_digests is not None:
+            if previous_digests.get(target) == digest:
+                continue
+            changed += 1
+            batch.append((target, evidence))
+            if len(batch) >= INCREMENTAL_BATCH_SIZE:
+                if not dry_run:
+                    delete_target_associations(es, index, [t for t, _ in batch])
+                for data in batch:
+                    yield data
+                batch = []
+        else:
+            yield target, evidence
+
+    if previous_digests is not None:
+        if batch:
+            if not dry_run:
+                delete_target_associations(es, index, [t for t, _ in batch])
+            for data in batch:
+                yield data
+
+        removed = sorted(set(previous_digests) - set(digests))
+        logger = logging.getLogger(__name__)
+        logger.info("incremental scoring of %d changed targets, %d removed targets",
+            changed, len(removed))
+        if not dry_run:
+            for i in range(0, len(removed), INCREMENTAL_BATCH_SIZE):
+                delete_target_associations(es, index, removed[i:i+INCREMENTAL_BATCH_SIZE])
+
+def content_hash(source):
+    """short stable hash of a serialized association document, as str or bytes"""
+    if not isinstance(source, bytes):
+        source = source.encode('utf-8')
+    return hashlib.blake2b(source, digest_size=8).hexdigest()
+
+def get_diff_actions(actions, index, previous_hashes, hashes):
+    """
+    Filter elasticsearch index actions down to the documents that changed
+
+    The content hash of every document is stored in hashes. Documents with
+    the same hash as in previous_hashes are dropped, and delete actions are 
+    added at the end for documents that are no longer produced. When 
+    previous_hashes is None every action is passed on
+    """
+    for action in actions:
+        digest = content_hash(action["_source"])
+        hashes[action["_id"]] = digest
+        if previous_hashes is None or previous_hashes.get(action["_id"]) != digest:
+            yield action
+
+    if previous_hashes is not None:
+        for element_id in previous_hashes:
+            if element_id not in hashes:
+                yield {"_op_type": "delete", "_index": index, "_id": element_id}
+
+def produce_evidence(target, es, es_index_val_right, produce_target,
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes):
+    evidence = get_evidence_for_target_simple(es, target, es_index_val_right)
+    return produce_target(target, evidence, scoring_weights, 
+        is_direct_do_not_propagate, datasources_to_datatypes)
+
+def produce_evidence_part(task, es, es_index_val_right, produce_target,
         scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes):
+    """task is a (target, part, parts) tuple from get_scheduled_targets, where
+    a target split into several parts only produces the diseases of its part"""
+    target, part, parts = task
+    evidence = get_evidence_for_target_simple(es, target, es_index_val_right)
+    if parts > 1:
+        return produce_target(target, evidence, scoring_weights, 
+            is_direct_do_not_propagate, datasources_to_datatypes,
+            disease_filter=lambda efo: in_part(efo, part, parts))
+    return produce_target(target, evidence, scoring_weights, 
+        is_direct_do_not_propagate, datasources_to_datatypes)
+
+def get_scheduled_targets(target_counts, split_threshold, split_parts):
+    """
+    Order (target, evidence count) tuples by their amount of evidence, heaviest
+    first, as ((target, part, parts), evidence count) tuples
+
+    Targets with more than split_threshold evidence are split into split_parts
+    tasks that each produce a separate part of the diseases, and the evidence
+    count is shared between them
+    """
+    for target, cost in sorted(target_counts, key=lambda c: c[1], reverse=True):
+        if split_parts > 1 and cost > split_threshold:
+            for part in range(split_parts):
+                part_cost = cost // split_parts + (cost % split_parts if part == 0 else 0)
+                yield (target, part, split_parts), part_cost
+        else:
+            yield (target, 0, 1), cost
+
+def produce_evidence_grouped(data, es, es_index_val_right, produce_target,
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes):
+    target, evidence = data
+    return produce_target(target, evidence, scoring_weights, 
+        is_direct_do_not_propagate, datasources_to_datatypes)
+
+def produce_evidence_pairs(target, evidences, 
+        scoring_weights, is_direct_do_not_propagate, datasources_to_datatypes,
+        spill_threshold=0, max_entries=100, disease_filter=None):
+    """
+    If spill_threshold is more than zero, once that many evidence have been 
+    expanded to diseases they are written to disk and merged back at the end, 
+    see merge_evidence_runs
+
+    If disease_filter is given, only the diseases it returns True for are produced
+    """
     data_cache = {}
     return_values = []
-    for evidence in get_evidence_for_target_simple(es, target, es_index_val_right):
+    runs = []
+    cached = 0
+    for evidence in evidences:
 
         
 
@@ -327,6 +956,8 @@ def produce_evidence(target, es, es_index_val_right,
 
 
         for efo in efo_list:
+            if disease_filter is not None and not disease_filter(efo):
+                continue
             key = (evidence['target']['id'], efo)
 
             if key not in data_cache:
@@ -343,6 +974,17 @@ def produce_evidence(target, es, es_index_val_right,
 
             row = EvidenceScore(score, data_type, data_source, is_direct)
             data_cache[key].append(row)
+            cached += 1
+
+        if spill_threshold > 0 and cached >= spill_threshold:
+            runs.append(spill_evidence_run(data_cache))
+            data_cache = {}
+            cached = 0
+
+    if runs:
+        if data_cache:
+            runs.append(spill_evidence_run(data_cache))
+        return merge_evidence_runs(target, runs, max_entries)
 
     for key,evidence in list(data_cache.items()):
         #if any of the evidence is direct, the assication is direct
@@ -356,23 +998,80 @@ def produce_evidence(target, es, es_index_val_right,
 
     return return_values
 
+def spill_evidence_run(data_cache):
+    """
+    Write the expanded evidence of a target to a temporary file as a run
+    sorted by disease, keeping the evidence order within each disease
+    """
+    run = tempfile.TemporaryFile(mode='w+')
+    for key in sorted(data_cache):
+        for e in data_cache[key]:
+            run.write('%s\t%s\t%s\t%r\t%d\n' % (key[1], e.datasource, e.datatype, 
+                e.score, e.is_direct))
+    run.seek(0)
+    return run
+
+def read_evidence_run(run):
+    with run:
+        for line in run:
+            disease, datasource, datatype, score, is_direct = line.rstrip('\n').split('\t')
+            yield disease, datasource, datatype, float(score), is_direct == '1'
+
+def merge_evidence_runs(target, runs, max_entries):
+    """
+    Merge runs from spill_evidence_run back into (target, disease, evidence, is_direct)
+
+    Only the top max_entries scores of each datasource are kept as evidence, 
+    the rest is summarized by a single zero score evidence that carries their 
+    count. This gives the same association as the full evidence, but the memory
+    used for a disease no longer depends on how much evidence it has
+    """
+    rows = heapq.merge(*[read_evidence_run(run) for run in runs], key=lambda row: row[0])
+    for disease, disease_rows in itertools.groupby(rows, key=lambda row: row[0]):
+        #keep datasources in the order they are first seen for the facets
+        datasources = OrderedDict()
+        is_direct = False
+        for _, datasource, datatype, score, direct in disease_rows:
+            is_direct = is_direct or direct
+            if datasource not in datasources:
+                datasources[datasource] = [datatype, [], 0]
+            top = datasources[datasource]
+            top[2] += 1
+            if len(top[1]) < max_entries:
+                heapq.heappush(top[1], score)
+            elif score > top[1][0]:
+                heapq.heapreplace(top[1], score)
+
+        evidence = []
+        for datasource, (datatype, scores, count) in datasources.items():
+            for score in sorted(scores, reverse=True):
+                evidence.append(EvidenceScore(score, datatype, datasource, False))
+            if count > len(scores):
+                evidence.append(EvidenceScore(0.0, datatype, datasource, False,
+                    count - len(scores)))
+
+        yield target, disease, evidence, is_direct
+
 def score_producer_local_init(datasources_to_datatypes, dry_run, es_hosts,
         es_index_gene, es_index_hpa, es_index_efo,
         gene_cache_size, hpa_cache_size,
-        efo_cache_size, ):
-    scorer = Scorer()
-    lookup_data = LookUpDataRetriever(new_es_client(es_hosts), 
+        efo_cache_size, scoring_methods, skip_zero_scores):
+    scorer = Scorer(scoring_methods)
+    lookup_data = LookUpDataRetriever(new_es_client(es_hosts, "lookup"), 
         gene_index=es_index_gene,
         gene_cache_size = gene_cache_size,
+        gene_source_includes = GENE_SOURCE_INCLUDES,
         hpa_index=es_index_hpa,
         hpa_cache_size = hpa_cache_size,
         efo_index=es_index_efo,
-        efo_cache_size = efo_cache_size
+        efo_cache_size = efo_cache_size,
+        efo_source_includes = EFO_SOURCE_INCLUDES
         ).lookup
-    return scorer, lookup_data, datasources_to_datatypes, dry_run
+    enricher = AssociationEnricher(lookup_data, efo_cache_size)
+    return scorer, enricher, datasources_to_datatypes, dry_run, skip_zero_scores
 
 def score_producer(data, 
-        scorer, lookup_data, datasources_to_datatypes, dry_run):
+        scorer, enricher, datasources_to_datatypes, dry_run, skip_zero_scores):
     target, disease, evidence, is_direct = data
 
     if evidence:
@@ -380,45 +1079,141 @@ def score_producer(data,
             datasources_to_datatypes)
         # skip associations only with data with score 0
         if score: 
+            return enrich_association(score, enricher, skip_zero_scores)
 
-            gene_data = Gene()
-            gene_data_index = lookup_data.available_genes.get_gene(target)
-            if gene_data_index != None:
-                gene_data.load_json(gene_data_index)
-            score.set_target_data(gene_data)
-
-            # create a hpa expression empty jsonserializable class
-            hpa_data = HPAExpression()
-            try:
-                hpa_index = lookup_data.available_hpa.get_hpa(target)
-                if hpa_index is not None:
-                    hpa_data.update(hpa_index)
-            except KeyError:
-                pass
-            except Exception as e:
-                raise e
-            try:
-                score.set_hpa_data(hpa_data)
-            except KeyError:
-                pass
-            except Exception as e:
-                raise e
-
-
-            disease_data = EFO()
-            disease_data.load_json(
-                lookup_data.available_efos.get_efo(disease))
+        return None
 
-            score.set_disease_data(disease_data)
+def association_producer(association, 
+        scorer, enricher, datasources_to_datatypes, dry_run, skip_zero_scores):
+    #already scored by the columnar engine
+    return enrich_association(association, enricher, skip_zero_scores)
+
+class AssociationEnricher(object):
+    """adds the target and disease data to scored associations
+
+    the target and disease blocks are built once and then attached by 
+    reference to every association that shares them. The evidence arrives 
+    grouped by target so only a few target blocks need to be kept, while
+    the disease blocks are memoized for the whole process"""
+
+    def __init__(self, lookup_data, disease_cache_size,
+            target_cache_size=TARGET_BLOCK_CACHE_SIZE):
+        self.lookup_data = lookup_data
+        self.target_blocks = cachetools.LRUCache(target_cache_size)
+        self.disease_blocks = cachetools.LRUCache(disease_cache_size, 
+            getsizeof=sys.getsizeof)
+
+    def get_target_block(self, target):
+        if target in self.target_blocks:
+            return self.target_blocks[target]
+
+        gene_data = Gene()
+        gene_data_index = self.lookup_data.available_genes.get_gene(target)
+        if gene_data_index != None:
+            gene_data.load_json(gene_data_index)
+
+        # create a hpa expression empty jsonserializable class
+        hpa_data = HPAExpression()
+        try:
+            hpa_index = self.lookup_data.available_hpa.get_hpa(target)
+            if hpa_index is not None:
+                hpa_data.update(hpa_index)
+        except KeyError:
+            pass
+
+        block = get_target_block(gene_data, hpa_data)
+        self.target_blocks[target] = block
+        return block
+
+    def get_disease_block(self, disease):
+        if disease in self.disease_blocks:
+            return self.disease_blocks[disease]
+
+        disease_data = EFO()
+        disease_data.load_json(
+            self.lookup_data.available_efos.get_efo(disease))
+
+        block = get_disease_block(disease_data)
+        try:
+            self.disease_blocks[disease] = block
+        except ValueError:
+            #too large for the cache, don't memoize
+            pass
+        return block
+
+    def enrich(self, score):
+        score.set_target_block(self.get_target_block(score.target['id']))
+        score.set_disease_block(self.get_disease_block(score.disease['id']))
+        return score
+
+def enrich_association(score, enricher, skip_zero_scores):
+    enricher.enrich(score)
+
+    element_id = '%s-%s' % (score.target['id'], score.disease['id'])
+
+    #convert the score into encoded JSON
+    #otherwise Python serialization consumes too much memory
+    #and the writing process doesn't have to encode it again
+    return (element_id, score.to_json(skip_zero_scores).encode('utf-8'), 
+        get_association_summary(score))
+
+
+def get_association_summary(score):
+    """
+    Small summary of a scored association for AssociationQC, a tuple of 
+    is_direct, overall score, the non-zero datatype scores and the datasources
+    with evidence
+    """
+    har_sum_score = score.get_scoring_method(ScoringMethods.HARMONIC_SUM)
+    datatypes = dict((dt, v) for dt, v in har_sum_score.datatypes.items() if v)
+    datasources = [ds for ds, count in score.evidence_count['datasources'].items() if count]
+    return score.is_direct, har_sum_score.overall, datatypes, datasources
 
 
-            element_id = '%s-%s' % (target, disease)
+class AssociationQC(object):
+    """
+    QC statistics of associations accumulated while they are written, so the
+    index does not need to be read again afterwards
+    """
 
-            #convert the score into a JSON-compatible object
-            #otherwise Python serialization consumes too much memory
-            return (element_id, score.to_json())
+    def __init__(self):
+        self.count = 0
+        self.direct_count = 0
+        self.datasource_counts = defaultdict(int)
+        self.datatype_counts = defaultdict(int)
+        self.overall = TDigest()
+        self.datatype_scores = defaultdict(TDigest)
+
+    def add(self, summary):
+        is_direct, overall, datatypes, datasources = summary
+        self.count += 1
+        if is_direct:
+            self.direct_count += 1
+        self.overall.add(overall)
+        for datatype, datatype_score in datatypes.items():
+            self.datatype_counts[datatype] += 1
+            self.datatype_scores[datatype].add(datatype_score)
+        for datasource in datasources:
+            self.datasource_counts[datasource] += 1
 
-        return None
+    def metrics(self):
+        metrics = dict()
+        metrics["association.count"] = self.count
+        metrics["association.direct.count"] = self.direct_count
+        metrics["association.indirect.count"] = self.count - self.direct_count
+        for datasource in self.datasource_counts:
+            metrics["association.datasource.%s.count" % datasource] = self.datasource_counts[datasource]
+        for datatype in self.datatype_counts:
+            metrics["association.datatype.%s.count" % datatype] = self.datatype_counts[datatype]
+
+        digests = [("association.overall", self.overall)]
+        digests.extend(("association.datatype.%s" % dt, self.datatype_scores[dt]) 
+            for dt in self.datatype_scores)
+        for name, digest in digests:
+            if digest.count:
+                for quantile in QC_QUANTILES:
+                    metrics["%s.p%02d" % (name, quantile*100)] = digest.quantile(quantile)
+        return metrics
 
 
 class ScoringProcess(object):
@@ -429,7 +1224,10 @@ class ScoringProcess(object):
             queue_score, queue_produce, queue_write, 
             cache_hpa, cache_efo, cache_target, 
             scoring_weights, is_direct_do_not_propagate,
-            datasources_to_datatypes):
+            datasources_to_datatypes, evidence_reader, engine,
+            scoring_methods, skip_zero_scores, manifest, incremental, diff_hashes,
+            spill_threshold, schedule, split_threshold, split_parts, shard,
+            raw_scores_dir, raw_scores_buffer, dead_letter=None):
 
         self.logger = logging.getLogger(__name__)
 
@@ -448,6 +1246,8 @@ class ScoringProcess(object):
         self.queue_write = queue_write
         self.queue_produce = queue_produce
         self.queue_score = queue_score
+        #directory to keep documents that could not be written in
+        self.dead_letter = dead_letter
 
         self.cache_hpa = cache_hpa
         self.cache_efo = cache_efo
@@ -456,101 +1256,285 @@ class ScoringProcess(object):
         self.scoring_weights = scoring_weights
         self.is_direct_do_not_propagate = is_direct_do_not_propagate
         self.datasources_to_datatypes = datasources_to_datatypes
+        self.evidence_reader = evidence_reader
+        self.engine = engine
+        self.scoring_methods = scoring_methods
+        self.skip_zero_scores = skip_zero_scores
+        self.manifest = manifest
+        self.incremental = incremental
+        self.diff_hashes = diff_hashes
+        self.spill_threshold = spill_threshold
+        self.schedule = schedule
+        self.split_threshold = split_threshold
+        self.split_parts = split_parts
+        #None or a (i, N) tuple to only score the i-th of N partitions of the targets
+        self.shard = shard
+        self.raw_scores_dir = raw_scores_dir
+        self.raw_scores_buffer = raw_scores_buffer
+        #filled in while writing if all of the associations are written
+        self.association_qc = None
+
+        #harmonic sum is used for the scores, so can't be skipped
+        if self.scoring_methods is not None \
+                and ScoringMethods.HARMONIC_SUM not in self.scoring_methods:
+            raise ValueError("scoring methods must include %s" % ScoringMethods.HARMONIC_SUM)
+
+        #digests are computed from the evidence as it is read in a single pass
+        if (self.manifest or self.incremental) and self.evidence_reader != 'single-pass':
+            raise ValueError("manifest and incremental scoring need the single-pass evidence reader")
+        #the diff writer needs every association to be produced to find deletions
+        if self.incremental and self.diff_hashes:
+            raise ValueError("incremental scoring can't be combined with the diff writer")
+        #targets can only be reordered if they are read separately
+        if self.schedule == 'heaviest-first' and self.evidence_reader != 'per-target':
+            raise ValueError("heaviest-first schedule needs the per-target evidence reader")
+        #only pairs can be produced for part of the diseases of a target
+        if self.split_parts > 1 and self.engine != 'objects':
+            raise ValueError("splitting targets needs the objects engine")
+        #the raw scores are of whole targets, and of all of them
+        if self.raw_scores_dir and (self.split_parts > 1 or self.shard is not None):
+            raise ValueError("raw scores can't be kept when splitting targets or sharding")
+        if self.raw_scores_dir and self.incremental:
+            raise ValueError("raw scores can't be kept with incremental scoring")
+        #a shard only sees its own targets, so can't tell which others were removed
+        if self.shard is not None and (self.manifest or self.incremental or self.diff_hashes):
+            raise ValueError("sharding can't be combined with a manifest, incremental scoring or the diff writer")
+
+
+    def get_target_counts(self, es):
+        """
+        List of (target, evidence count) tuples of the targets with evidence in
+        this shard, from an aggregation so targets without evidence are skipped
+        """
+        return [(target, count) for target, count 
+            in get_key_counts(es, self.es_index_val_right, 'target.id')
+            if self.in_shard(target)]
+
+    def in_shard(self, target):
+        return self.shard is None or in_part(target, self.shard[0], self.shard[1])
+
+    def get_settings_mappings(self):
+        with URLZSource(self.es_mappings).open() as mappings_file:
+            mappings = json.load(mappings_file)
 
-
-    def get_targets(self, es):
-        for target in Search().using(es).index(self.es_index_gene).query(MatchAll()).params(scroll = '4h').scan():
-            yield str(target.meta.id)
+        with URLZSource(self.es_settings).open() as settings_file:
+            settings = json.load(settings_file)
+        return settings, mappings
+
+    def prepare_shards(self, dry_run):
+        """
+        Create the empty index for the shards to write into, once before any
+        of them are run. It is finalized by verify_shards after they all are
+        """
+        if dry_run:
+            return
+        es = new_es_client(self.es_hosts)
+        settings, mappings = self.get_settings_mappings()
+        index = prepare_shared_index(es, self.es_index, settings, mappings)
+        self.logger.info("prepared %s for the shards to write into", index)
 
     def process_all(self, dry_run):
 
         # do not pass this es object to other processess, single process only!
         es = new_es_client(self.es_hosts)
+        if self.shard is not None:
+            self.logger.info("scoring shard %d of %d", self.shard[0], self.shard[1])
+
+        settings, mappings = self.get_settings_mappings()
+        #the previous manifest and hashes are only of use if they were written for
+        #the build readers see now, and not e.g. one that was rolled back from
+        build = get_current_build(es, self.es_index)
+        previous_digests = None
+        if self.incremental:
+            self.logger.info("reading previous manifest %s", self.incremental)
+            manifest_build = read_manifest_build(self.incremental)
+            if manifest_build is not None and manifest_build != build:
+                raise ValueError("manifest %s is of %s, but %s is now %s, a full run is needed" % (
+                    self.incremental, manifest_build, self.es_index, build))
+            previous_digests = read_manifest(self.incremental)
+        #the diff writer only writes the associations that changed since the 
+        #previous build, if there was one and its index is still there
+        previous_hashes = None
+        hashes = {}
+        if self.diff_hashes and os.path.exists(self.diff_hashes) \
+                and es.indices.exists(index=self.es_index):
+            hashes_build = read_manifest_build(self.diff_hashes)
+            if hashes_build is not None and hashes_build != build:
+                self.logger.warning("hashes %s are of %s, but %s is now %s, writing all associations",
+                    self.diff_hashes, hashes_build, self.es_index, build)
+            else:
+                self.logger.info("reading previous hashes %s", self.diff_hashes)
+                previous_hashes = read_manifest(self.diff_hashes)
+        append_data = bool(self.incremental) or previous_hashes is not None
+
+        #shards write into the index made by prepare_shards and leave it as it is
+        with open_index(es, self.es_index, settings, mappings,
+                append_data=append_data, force_merge=not append_data,
+                shared=self.shard is not None) as index_manager:
+
+            #either read all the evidence once in target order and send groups to
+            #the producers, or send target ids and have each producer read its evidence
+            #in incremental runs only the targets that changed since the previous 
+            #manifest are read and scored, into the index being written
+            digests = {}
+            if self.evidence_reader == 'single-pass':
+                shard_targets = None
+                if self.shard is not None:
+                    shard_targets = [t for t, _ in self.get_target_counts(es)]
+                targets = get_evidence_by_target(es, self.es_index_val_right, shard_targets)
+                if self.manifest or self.incremental:
+                    targets = get_changed_evidence_by_target(targets, digests,
+                        previous_digests, es, index_manager.write_index, dry_run)
+                producer = produce_evidence_grouped
+            elif self.schedule == 'heaviest-first':
+                tasks = list(get_scheduled_targets(self.get_target_counts(es), 
+                    self.split_threshold, self.split_parts))
+                targets = (task for task, _ in log_progress(tasks, self.logger, 'target tasks'))
+                producer = produce_evidence_part
+            else:
+                targets = (t for t, _ in log_progress(self.get_target_counts(es), 
+                    self.logger, 'targets'))
+                producer = produce_evidence
+
+            #raw scores are appended by each producer, so start from an empty directory
+            if self.raw_scores_dir and not dry_run:
+                if not os.path.isdir(self.raw_scores_dir):
+                    os.makedirs(self.raw_scores_dir)
+                for filename in glob.glob(os.path.join(self.raw_scores_dir, 'raw-*.npy')):
+                    os.remove(filename)
+
+            self.logger.info('setting up stages')
+
+            #bake the arguments for the setup into function objects
+            produce_evidence_local_init_baked = functools.partial(produce_evidence_local_init, 
+                self.es_hosts, self.es_index_val_right, self.es_index_efo,
+                self.scoring_weights, self.is_direct_do_not_propagate, 
+                self.datasources_to_datatypes, self.engine, self.scoring_methods,
+                self.spill_threshold, None if dry_run else self.raw_scores_dir, 
+                self.raw_scores_buffer)
+            score_producer_local_init_baked = functools.partial(score_producer_local_init,
+                self.datasources_to_datatypes, dry_run, self.es_hosts,
+                self.es_index_gene, self.es_index_hpa, self.es_index_efo,
+                self.cache_target, self.cache_hpa, self.cache_efo,
+                self.scoring_methods, self.skip_zero_scores)
+            
+            #pipeline stage for making the lists of the target/disease pairs and evidence
+            pipeline_stage1 = pr.flat_map(producer, targets, 
+                workers=self.workers_production,
+                maxsize=self.queue_produce,
+                on_start=produce_evidence_local_init_baked)
+
+            #pipeline stage for scoring the evidence sets
+            #includes writing to elasticsearch
+            #the columnar and rollup engines have already scored, so only add target and disease data
+            if self.engine in ('columnar', 'rollup'):
+                scorer = association_producer
+            else:
+                scorer = score_producer
+            pipeline_stage2 = pr.map(scorer, pipeline_stage1, 
+                workers=self.workers_score,
+                maxsize=self.queue_score,
+                on_start=score_producer_local_init_baked)
 
-        targets = self.get_targets(es)
-
-        self.logger.info('setting up stages')
-
-        #bake the arguments for the setup into function objects
-        produce_evidence_local_init_baked = functools.partial(produce_evidence_local_init, 
-            self.es_hosts, self.es_index_val_right,
-            self.scoring_weights, self.is_direct_do_not_propagate, 
-            self.datasources_to_datatypes)
-        score_producer_local_init_baked = functools.partial(score_producer_local_init,
-            self.datasources_to_datatypes, dry_run, self.es_hosts,
-            self.es_index_gene, self.es_index_hpa, self.es_index_efo,
-            self.cache_target, self.cache_hpa, self.cache_efo)
-        
-        #pipeline stage for making the lists of the target/disease pairs and evidence
-        pipeline_stage1 = pr.flat_map(produce_evidence, targets, 
-            workers=self.workers_production,
-            maxsize=self.queue_produce,
-            on_start=produce_evidence_local_init_baked)
-
-        #pipeline stage for scoring the evidence sets
-        #includes writing to elasticsearch
-        pipeline_stage2 = pr.map(score_producer, pipeline_stage1, 
-            workers=self.workers_score,
-            maxsize=self.queue_score,
-            on_start=score_producer_local_init_baked)
-
-        with URLZSource(self.es_mappings).open() as mappings_file:
-            mappings = json.load(mappings_file)
-
-        with URLZSource(self.es_settings).open() as settings_file:
-            settings = json.load(settings_file)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
             #load into elasticsearch
             self.logger.info('stages created, running scoring and writing')
-            client = es
-            chunk_size = 1000 #TODO make configurable
-            actions = self.elasticsearch_actions(pipeline_stage2, self.es_index)
-            failcount = 0
+            client = new_es_client(self.es_hosts, "bulk-write", self.workers_write)
+            #incremental and shard runs only see part of the associations
+            association_qc = None
+            if not dry_run and not self.incremental and self.shard is None:
+                association_qc = AssociationQC()
+            actions = self.elasticsearch_actions(pipeline_stage2, index_manager.write_index, 
+                association_qc)
+            #deleting an association that is already gone is not a failure
+            ignore_status = ()
+            if self.diff_hashes:
+                actions = get_diff_actions(actions, index_manager.write_index, 
+                    previous_hashes, hashes)
+                ignore_status = (404,)
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    self.logger.debug("Using parallel bulk writer for Elasticearch")
-                    results = elasticsearch.helpers.parallel_bulk(client, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    self.logger.debug("Using streaming bulk writer for Elasticearch")
-                    results = elasticsearch.helpers.streaming_bulk(client, actions,
-                            chunk_size=chunk_size)
-                for success, details in results:
-                    if not success:
-                        failcount += 1
+                writer = new_bulk_writer(client, self.workers_write, self.queue_write, self.dead_letter,
+                        ignore_status=ignore_status)
+                _, failcount = writer.write(actions)
 
                 if failcount:
                     raise RuntimeError("%s relations failed to index" % failcount)
 
+        #only record the digests once all the associations have been written,
+        #with the build they were written into
+        if self.manifest and not dry_run:
+            self.logger.info("writing manifest of %d targets to %s", len(digests), self.manifest)
+            write_manifest(self.manifest, digests, index_manager.write_index)
+        if self.diff_hashes and not dry_run:
+            self.logger.info("writing hashes of %d associations to %s", len(hashes), self.diff_hashes)
+            write_manifest(self.diff_hashes, hashes, index_manager.write_index)
+
+        self.association_qc = association_qc
+
         self.logger.info("DONE")
 
     """
     Generates elasticsearch action objects from the results iterator
 
-    Output suitable for use with elasticsearch.helpers 
+    Output suitable for use with BulkWriter
     """
-    def elasticsearch_actions(self, results, index):
+    def elasticsearch_actions(self, results, index, association_qc=None):
         for r in results:
             if r is not None:
-                element_id, score = r
+                element_id, score, summary = r
+                if association_qc is not None:
+                    association_qc.add(summary)
                 action = {}
                 action["_index"] = index
                 action["_id"] = element_id
-                #elasticsearch client uses https://github.com/elastic/elasticsearch-py/blob/master/elasticsearch/serializer.py#L24
-                #to turn objects into JSON bodies. This in turn calls json.dumps() using simplejson if present.
+                #already encoded by the scoring workers, so BulkWriter only
+                #concatenates it into the request body
                 action["_source"] = score
                 yield action
                     
+    def verify_shards(self, es):
+        """
+        Check that every target with scored evidence has associations in the
+        index made by prepare_shards, after all the shards have been run, and
+        if so finalize the index
+
+        Returns a dict of shard number to the list of targets missing from 
+        it, which is empty if the associations are complete
+        """
+        index = get_shared_index(es, self.es_index)
+        #the index is not refreshed while it is written to
+        es.indices.refresh(index=index)
+        expected = set(get_scored_targets(es, self.es_index_val_right, self.scoring_weights))
+        present = set(get_keys(es, index, 'target.id'))
+
+        parts = 1 if self.shard is None else self.shard[1]
+        missing = defaultdict(list)
+        for target in sorted(expected - present):
+            for part in range(parts):
+                if in_part(target, part, parts):
+                    missing[part].append(target)
+        for part in sorted(missing):
+            self.logger.error("shard %d/%d is missing associations for %d targets e.g. %s", 
+                part, parts, len(missing[part]), missing[part][0])
+        self.logger.info("%d of %d targets with evidence have associations",
+            len(expected & present), len(expected))
+        if not missing:
+            settings, _ = self.get_settings_mappings()
+            #force merging the whole index can take longer than the scan timeout
+            finish_shared_index(new_es_client(self.es_hosts, "bulk-write"), 
+                self.es_index, settings)
+        return dict(missing)
+
     """
     Run a series of QC tests on EFO elasticsearch index. Returns a dictionary
     of string test names and result objects
     """
     def qc(self, es, index):
 
+        #use the statistics from writing the whole index if there are some
+        if self.association_qc is not None:
+            return self.association_qc.metrics()
+
         #number of eco entries
         association_count = 0
         #Note: try to avoid doing this more than once!
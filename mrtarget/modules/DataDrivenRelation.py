@@ -24,7 +24,7 @@ from sklearn.feature_extraction import DictVectorizer
 from sklearn.feature_extraction.text import TfidfTransformer, _document_frequency
 from mrtarget.common.DataStructure import JSONSerializable
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import open_index, new_bulk_writer
 from mrtarget.common.DataStructure import SparseFloatDict
 
 class RelationType(object):
@@ -157,27 +157,16 @@ class OverlapDistance(object):
 Consumes the iterable passed in and loads into into provided loader
 whilst also respecting the dry run flag given
 
-Uses elasticsearch.helpers.parallel_bulk with multiple threads for high
-performance loading
+Uses a BulkWriter with multiple threads for high performance loading,
+keeping documents that failed in dead_letter
 """
-def store_in_elasticsearch(results, es, dry_run, workers_write, queue_write, index):
-    chunk_size = 1000 #TODO make configurable
+def store_in_elasticsearch(results, es, dry_run, workers_write, queue_write, index,
+        dead_letter=None):
     actions = elasticsearch_actions(results, dry_run, index)
-    failcount = 0
 
     if not dry_run:
-        results = None
-        if workers_write > 0:
-            results = elasticsearch.helpers.parallel_bulk(es, actions,
-                    thread_count=workers_write,
-                    queue_size=queue_write, 
-                    chunk_size=chunk_size)
-        else:
-            results = elasticsearch.helpers.streaming_bulk(es, actions,
-                    chunk_size=chunk_size)
-        for success, details in results:
-            if not success:
-                failcount += 1
+        writer = new_bulk_writer(es, workers_write, queue_write, dead_letter)
+        _, failcount = writer.write(actions)
 
         if failcount:
             raise RuntimeError("%s relations failed to index" % failcount)
@@ -324,7 +313,8 @@ used to standardize d2d and t2t code path
 def handle_pairs(type, subject_labels, subject_data, subject_ids, other_ids, 
         threshold, buckets_number, es, dry_run, 
         workers_production, workers_score, workers_write,
-        queue_production_score, queue_score_result, queue_write, index):
+        queue_production_score, queue_score_result, queue_write, index,
+        dead_letter=None):
 
     #do some initial setup
     vectorizer = DictVectorizer(sparse=True)
@@ -372,7 +362,7 @@ def handle_pairs(type, subject_labels, subject_data, subject_ids, other_ids,
     #store in elasticsearch
     #this could be multi process, but just use a single for now
     store_in_elasticsearch(pipeline_stage, es, dry_run, workers_write, queue_write,
-        index)
+        index, dead_letter)
 
 """
 Function to run in child processess
@@ -441,7 +431,8 @@ class DataDrivenRelationProcess(object):
             ddr_queue_score_result,
             ddr_queue_write,
             score_threshold,
-            evidence_count):
+            evidence_count,
+            dead_letter=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
@@ -457,6 +448,7 @@ class DataDrivenRelationProcess(object):
         self.ddr_queue_write = ddr_queue_write
         self.score_threshold = score_threshold
         self.evidence_count = evidence_count
+        self.dead_letter = dead_letter
 
         self.logger = logging.getLogger(__name__)
 
@@ -489,23 +481,24 @@ class DataDrivenRelationProcess(object):
         with URLZSource(self.es_settings).open() as settings_file:
             settings = json.load(settings_file)
 
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        es_write = new_es_client(self.es_hosts, "bulk-write", self.ddr_workers_write)
+        with open_index(es, self.es_index, settings, mappings) as index_manager:
 
             #calculate and store disease-to-disease in multiple processess
             self.logger.info('handling disease-to-disease')
             handle_pairs(RelationType.SHARED_TARGET, disease_labels, disease_data, disease_keys, 
-                target_keys, 0.19, 1024, es, dry_run, 
+                target_keys, 0.19, 1024, es_write, dry_run, 
                 self.ddr_workers_production, self.ddr_workers_score, self.ddr_workers_write,
                 self.ddr_queue_production_score, self.ddr_queue_score_result, self.ddr_queue_write, 
-                self.es_index)
+                index_manager.write_index, self.dead_letter)
             self.logger.info('handled disease-to-disease')
 
             #calculate and store target-to-target in multiple processess
             self.logger.info('handling target-to-target')
             handle_pairs(RelationType.SHARED_DISEASE, target_labels, target_data, target_keys, 
-                disease_keys, 0.19, 1024, es, dry_run, 
+                disease_keys, 0.19, 1024, es_write, dry_run, 
                 self.ddr_workers_production, self.ddr_workers_score, self.ddr_workers_write,
                 self.ddr_queue_production_score, self.ddr_queue_score_result, self.ddr_queue_write, 
-                self.es_index)
+                index_manager.write_index, self.dead_letter)
             self.logger.info('handled target-to-target')
 
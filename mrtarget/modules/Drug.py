@@ -5,12 +5,11 @@ from builtins import object
 import logging
 
 import simplejson as json
-import elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll
 
 from opentargets_urlzsource import URLZSource
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import open_index, new_bulk_writer
 from mrtarget.common.connection import new_es_client
 from mrtarget.common.LookupHelpers import LookUpDataRetriever
 
@@ -76,7 +75,8 @@ class DrugProcess(object):
                  chembl_molecule_uris,
                  chembl_indication_uris,
                  adverse_events_uris,
-                 drugbank_uris):
+                 drugbank_uris,
+                 dead_letter=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
@@ -85,6 +85,7 @@ class DrugProcess(object):
         self.es_index_efo = es_index_efo
         self.workers_write = workers_write
         self.queue_write = queue_write
+        self.dead_letter = dead_letter
 
         self.cache_efo = cache_efo
         self.cache_efo_contains = cache_efo_contains
@@ -1063,24 +1064,13 @@ class DrugProcess(object):
         with URLZSource(self.es_settings).open() as settings_file:
             settings = json.load(settings_file)
 
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with open_index(es, self.es_index, settings, mappings) as index_manager:
             # write into elasticsearch
-            chunk_size = 1000  # TODO make configurable
-            actions = elasticsearch_actions(list(data.items()), self.es_index)
-            failcount = 0
+            actions = elasticsearch_actions(list(data.items()), index_manager.write_index)
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                                                                  thread_count=self.workers_write,
-                                                                  queue_size=self.queue_write,
-                                                                  chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                                                                   chunk_size=chunk_size)
-                for success, details in results:
-                    if not success:
-                        failcount += 1
+                es_write = new_es_client(self.es_hosts, "bulk-write", self.workers_write)
+                writer = new_bulk_writer(es_write, self.workers_write, self.queue_write, self.dead_letter)
+                _, failcount = writer.write(actions)
 
                 if failcount:
                     raise RuntimeError("%s relations failed to index" % failcount)
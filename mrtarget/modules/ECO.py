@@ -8,10 +8,9 @@ from mrtarget.common.LookupTables import ECOLookUpTable
 from mrtarget.common.DataStructure import JSONSerializable
 from opentargets_ontologyutils.rdf_utils import OntologyClassReader
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import open_index, new_bulk_writer
 import opentargets_ontologyutils.eco_so
 import logging
-import elasticsearch
 import simplejson as json
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll
@@ -64,7 +63,7 @@ def elasticsearch_actions(items, index):
 class EcoProcess(object):
 
     def __init__(self, es_hosts, es_index, es_mappings, es_settings,
-            eco_uri, so_uri, workers_write, queue_write):
+            eco_uri, so_uri, workers_write, queue_write, dead_letter=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
@@ -73,6 +72,7 @@ class EcoProcess(object):
         self.so_uri = so_uri
         self.workers_write = workers_write
         self.queue_write = queue_write
+        self.dead_letter = dead_letter
 
         self.ecos = OrderedDict()
         self.evidence_ontology = OntologyClassReader()
@@ -104,26 +104,15 @@ class EcoProcess(object):
             settings = json.load(settings_file)
 
         es = new_es_client(self.es_hosts)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with open_index(es, self.es_index, settings, mappings) as index_manager:
 
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
-            actions = elasticsearch_actions(list(self.ecos.items()), self.es_index)
-            failcount = 0
+            actions = elasticsearch_actions(list(self.ecos.items()), index_manager.write_index)
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
-                for success, details in results:
-                    if not success:
-                        failcount += 1
+                es_write = new_es_client(self.es_hosts, "bulk-write", self.workers_write)
+                writer = new_bulk_writer(es_write, self.workers_write, self.queue_write, self.dead_letter)
+                _, failcount = writer.write(actions)
 
                 if failcount:
                     raise RuntimeError("%s relations failed to index" % failcount)
@@ -6,8 +6,7 @@ from opentargets_ontologyutils.rdf_utils import OntologyClassReader, DiseaseUtil
 import opentargets_ontologyutils.efo
 from rdflib import URIRef
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
-import elasticsearch
+from mrtarget.common.esutil import open_index, new_bulk_writer
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll
 import simplejson as json
@@ -109,7 +108,7 @@ class EfoProcess(object):
     def __init__(self, es_hosts, es_index, es_mappings, es_settings,
                  efo_uri, hpo_uri, mp_uri,
                  disease_phenotype_uris,
-                 workers_write, queue_write
+                 workers_write, queue_write, dead_letter=None
                  ):
         self.es_hosts = es_hosts
         self.es_index = es_index
@@ -121,6 +120,7 @@ class EfoProcess(object):
         self.disease_phenotype_uris = disease_phenotype_uris
         self.workers_write = workers_write
         self.queue_write = queue_write
+        self.dead_letter = dead_letter
 
         self.efos = OrderedDict()
         self.logger = logging.getLogger(__name__+".EfoProcess")
@@ -230,26 +230,15 @@ class EfoProcess(object):
             settings = json.load(settings_file)
 
         es = new_es_client(self.es_hosts)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with open_index(es, self.es_index, settings, mappings) as index_manager:
 
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
-            actions = elasticsearch_actions(list(self.efos.items()), self.es_index)
-            failcount = 0
+            actions = elasticsearch_actions(list(self.efos.items()), index_manager.write_index)
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
-                for success, details in results:
-                    if not success:
-                        failcount += 1
+                es_write = new_es_client(self.es_hosts, "bulk-write", self.workers_write)
+                writer = new_bulk_writer(es_write, self.workers_write, self.queue_write, self.dead_letter)
+                _, failcount = writer.write(actions)
 
                 if failcount:
                     raise RuntimeError("%s relations failed to index" % failcount)
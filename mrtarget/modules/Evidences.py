@@ -9,17 +9,24 @@ import codecs
 import functools
 import itertools
 
-import elasticsearch
 
 import opentargets_validator.helpers
 import mrtarget.common.IO as IO
 
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import open_index, new_bulk_writer, encode_action
 from mrtarget.common.EvidenceString import EvidenceManager, Evidence
 from mrtarget.common.LookupHelpers import LookUpDataRetriever
 from opentargets_urlzsource import URLZSource
 
+#fields of the gene and disease documents read when validating and extending
+#evidence, only these are fetched and cached by the lookup tables
+GENE_SOURCE_INCLUDES = ['id', 'approved_symbol', 'approved_name', 
+    'ensembl_external_name', 'ensembl_description', 'biotype', 'is_reference',
+    '_private.facets.reactome', 'go', 'uniprot_keywords', 'protein_classification']
+EFO_SOURCE_INCLUDES = ['code', 'label', 'path_codes', 
+    'therapeutic_codes', 'therapeutic_labels']
+
 def make_validated_evs_obj(filename, hash, line, line_n, is_valid=False, explanation_type='', explanation_str='',
                            target_id=None, efo_id=None, data_type=None, id=None):
     return addict.Dict(is_valid=is_valid, explanation_type=explanation_type, explanation_str=explanation_str,
@@ -72,6 +79,15 @@ def process_evidence(line, logger, validator, luts, datasources_to_datatypes, ev
     return left, right
 
 
+def process_evidence_action(line, logger, validator, luts, datasources_to_datatypes, 
+        evidence_manager, index_valid, index_invalid):
+    """process the evidence and encode it as a bulk action, or None, so that
+    the single writing process only has to concatenate them"""
+    (left, right) = process_evidence(line, logger, validator, luts, 
+        datasources_to_datatypes, evidence_manager)
+    return elasticsearch_action(left, right, index_valid, index_invalid)
+
+
 """
 This function is called once in each child process to do local setup for 
 validation
@@ -79,21 +95,23 @@ validation
 def validation_on_start(eco_scores_uri, schema_uri, excluded_biotypes, 
         datasources_to_datatypes, es_hosts, es_index_gene, es_index_eco, es_index_efo,
         cache_target, cache_target_u2e, cache_target_contains,
-        cache_eco, cache_efo, cache_efo_contains):
+        cache_eco, cache_efo, cache_efo_contains, index_valid, index_invalid):
     logger = logging.getLogger(__name__)
 
     validator = opentargets_validator.helpers.generate_validator_from_schema(schema_uri)
 
-    lookup_data = LookUpDataRetriever(new_es_client(es_hosts), 
+    lookup_data = LookUpDataRetriever(new_es_client(es_hosts, "lookup"), 
         gene_index=es_index_gene,
         gene_cache_size = cache_target,
         gene_cache_u2e_size = cache_target_u2e,
         gene_cache_contains_size = cache_target_contains,
+        gene_source_includes = GENE_SOURCE_INCLUDES,
         eco_index=es_index_eco,
         eco_cache_size = cache_efo_contains,
         efo_index=es_index_efo,
         efo_cache_size = cache_efo,
-        efo_cache_contains_size = cache_efo_contains
+        efo_cache_contains_size = cache_efo_contains,
+        efo_source_includes = EFO_SOURCE_INCLUDES
         ).lookup
 
 
@@ -101,7 +119,8 @@ def validation_on_start(eco_scores_uri, schema_uri, excluded_biotypes,
     evidence_manager = EvidenceManager(lookup_data, eco_scores_uri, 
         excluded_biotypes, datasources_to_datatypes)
 
-    return logger, validator, lookup_data, datasources_to_datatypes, evidence_manager
+    return logger, validator, lookup_data, datasources_to_datatypes, evidence_manager, \
+        index_valid, index_invalid
 
 def validate_evidence(line, logger, validator, luts, datasources_to_datatypes):
     """this function is called once per line until number of lines is exhausted. 
@@ -283,29 +302,27 @@ def validate_evidence(line, logger, validator, luts, datasources_to_datatypes):
         return validated_evs, None
 
 """
-Generates elasticsearch action objects from the results iterator
+Encodes the elasticsearch action of a valid or invalid evidence, or returns
+None if there is neither
 
-Output suitable for use with elasticsearch.helpers 
+Output suitable for use with BulkWriter
 """
-def elasticsearch_actions(lines, index_valid, index_invalid):
-    for line in lines:
-        (left, right) = line
-        if right is not None:
-            #valid
-            action = {}
-            action["_index"] = index_valid
-            action["_id"] = right['hash']
-            action["_source"] = right['line']
-            #print("  valid %s" % action["_id"])
-            yield action
-        elif left is not None:
-            #invalid
-            action = {}
-            action["_index"] = index_invalid
-            action["_id"] = left['id']
-            action["_source"] = left
-            #print("invalid %s" % action["_id"])
-            yield action
+def elasticsearch_action(left, right, index_valid, index_invalid):
+    if right is not None:
+        #valid, the line is already serialized
+        action = {}
+        action["_index"] = index_valid
+        action["_id"] = right['hash']
+        action["_source"] = right['line']
+        return encode_action(action)
+    elif left is not None:
+        #invalid
+        action = {}
+        action["_index"] = index_invalid
+        action["_id"] = left['id']
+        action["_source"] = left
+        return encode_action(action)
+    return None
 
 
 def process_evidences_pipeline(
@@ -320,7 +337,7 @@ def process_evidences_pipeline(
         cache_target, cache_target_u2e, cache_target_contains,
         cache_eco, cache_efo, cache_efo_contains,
         eco_scores_uri, schema_uri, excluded_biotypes, 
-        datasources_to_datatypes):
+        datasources_to_datatypes, dead_letter=None):
 
     logger = logging.getLogger(__name__)
 
@@ -346,20 +363,6 @@ def process_evidences_pipeline(
     #create a iterable of lines from all file handles
     evs = IO.make_iter_lines(checked_filenames, first_n)
 
-    #create functions with pre-baked arguments
-    validation_on_start_baked = functools.partial(validation_on_start, 
-        eco_scores_uri, schema_uri, excluded_biotypes, datasources_to_datatypes,
-        es_hosts, es_index_gene, es_index_eco, es_index_efo,
-        cache_target, cache_target_u2e, cache_target_contains,
-        cache_eco, cache_efo, cache_efo_contains)
-
-    #here is the pipeline definition
-    pl_stage = pr.map(process_evidence, evs, 
-        workers=workers_validation, maxsize=queue_validation,
-        on_start=validation_on_start_baked)
-
-    logger.info('stages created, running scoring and writing')
-
     with URLZSource(es_mappings_valid).open() as mappings_file:
         mappings_valid = json.load(mappings_file)
 
@@ -372,31 +375,32 @@ def process_evidences_pipeline(
     with URLZSource(es_settings_invalid).open() as settings_file:
         settings_invalid = json.load(settings_file)
 
-    with ElasticsearchBulkIndexManager(es, es_index_invalid, settings_invalid, mappings_invalid, append_data):
-        with ElasticsearchBulkIndexManager(es, es_index_valid, settings_valid, mappings_valid, append_data):
+    with open_index(es, es_index_invalid, settings_invalid, mappings_invalid, append_data) as invalid_manager:
+        with open_index(es, es_index_valid, settings_valid, mappings_valid, append_data) as valid_manager:
+            #create functions with pre-baked arguments
+            #the workers need the indexes actually written to
+            validation_on_start_baked = functools.partial(validation_on_start, 
+                eco_scores_uri, schema_uri, excluded_biotypes, datasources_to_datatypes,
+                es_hosts, es_index_gene, es_index_eco, es_index_efo,
+                cache_target, cache_target_u2e, cache_target_contains,
+                cache_eco, cache_efo, cache_efo_contains, 
+                valid_manager.write_index, invalid_manager.write_index)
+
+            #here is the pipeline definition
+            #actions are encoded by the workers, the writer only joins them
+            pl_stage = pr.map(process_evidence_action, evs, 
+                workers=workers_validation, maxsize=queue_validation,
+                on_start=validation_on_start_baked)
+
+            logger.info('stages created, running scoring and writing')
+
             #load into elasticsearch
-            chunk_size = 1000 #TODO make configurable
-            actions = elasticsearch_actions(pl_stage, 
-                es_index_valid, es_index_invalid)
-            failcount = 0
+            actions = (action for action in pl_stage if action is not None)
 
             if not dry_run:
-                results = None
-                if workers_write > 0:
-                    logger.debug("Using parallel bulk writer for Elasticearch")
-                    # this can silently crash ?
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=workers_write,
-                            queue_size=queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    logger.debug("Using streaming bulk writer for Elasticearch")
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
-
-                for success, details in results:
-                    if not success:
-                        failcount += 1
+                es_write = new_es_client(es_hosts, "bulk-write", workers_write)
+                writer = new_bulk_writer(es_write, workers_write, queue_write, dead_letter)
+                _, failcount = writer.write(actions)
 
                 if failcount:
                     raise RuntimeError("%s relations failed to index" % failcount)
@@ -6,12 +6,11 @@ import logging
 from collections import OrderedDict
 from mrtarget.common.DataStructure import JSONSerializable
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import open_index, new_bulk_writer
 from opentargets_urlzsource import URLZSource
 
 import simplejson as json
 from yapsy.PluginManager import PluginManager
-import elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll
 
@@ -250,7 +249,7 @@ class GeneManager(object):
     def __init__(self, es_hosts, es_index, es_mappings, 
             es_settings, plugin_paths, plugin_order, 
             data_config, es_config,
-            workers_write, queue_write):
+            workers_write, queue_write, dead_letter=None):
 
         self.es_hosts = es_hosts
         self.es_index = es_index
@@ -261,6 +260,7 @@ class GeneManager(object):
         self.es_config = es_config
         self.workers_write = workers_write
         self.queue_write = queue_write
+        self.dead_letter = dead_letter
 
         self.genes = GeneSet()
         self._logger = logging.getLogger(__name__)
@@ -301,26 +301,15 @@ class GeneManager(object):
             gene._create_suggestions()
             gene._create_facets()
 
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with open_index(es, self.es_index, settings, mappings) as index_manager:
 
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
-            actions = elasticsearch_actions(self.genes, self.es_index)
-            failcount = 0
+            actions = elasticsearch_actions(self.genes, index_manager.write_index)
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
-                for success, details in results:
-                    if not success:
-                        failcount += 1
+                es_write = new_es_client(self.es_hosts, "bulk-write", self.workers_write)
+                writer = new_bulk_writer(es_write, self.workers_write, self.queue_write, self.dead_letter)
+                _, failcount = writer.write(actions)
 
                 if failcount:
                     raise RuntimeError("%s relations failed to index" % failcount)
@@ -13,12 +13,11 @@ import codecs
 import petl
 import more_itertools
 from opentargets_urlzsource import URLZSource
-import elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll
 
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import open_index, new_bulk_writer
 from mrtarget.common.connection import new_es_client
 from addict import Dict
 from mrtarget.common.DataStructure import JSONSerializable, json_serialize, PipelineEncoder
@@ -506,7 +505,7 @@ class HPAProcess(object):
             tissue_curation_map_url,
             normal_tissue_url,
             rna_level_url, rna_value_url, rna_zscore_url, 
-            workers_write, queue_write):
+            workers_write, queue_write, dead_letter=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
@@ -514,6 +513,7 @@ class HPAProcess(object):
 
         self.workers_write = workers_write
         self.queue_write = queue_write
+        self.dead_letter = dead_letter
 
         self.downloader = HPADataDownloader(tissue_translation_map_url, 
             tissue_curation_map_url, normal_tissue_url,
@@ -552,32 +552,18 @@ class HPAProcess(object):
             settings = json.load(settings_file)
 
         es = new_es_client(self.es_hosts)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with open_index(es, self.es_index, settings, mappings) as index_manager:
   
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
-            actions = elasticsearch_actions(self.hpa_merged_table, dry_run, self.es_index)
-            failcount = 0
+            actions = elasticsearch_actions(self.hpa_merged_table, dry_run, index_manager.write_index)
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
-                for success, details in results:
-                    if not success:
-                        failcount += 1
+                es_write = new_es_client(self.es_hosts, "bulk-write", self.workers_write)
+                writer = new_bulk_writer(es_write, self.workers_write, self.queue_write, self.dead_letter)
+                _, failcount = writer.write(actions)
 
                 if failcount:
                     raise RuntimeError("%s relations failed to index" % failcount)
-        
-        if failcount:
-            raise RuntimeError("%s failed to index" % failcount)
 
         self.logger.info('missing tissues %s', str(_missing_tissues))
 
@@ -0,0 +1,222 @@
+import logging
+import os
+import gzip
+import glob
+
+import numpy as np
+
+from mrtarget.common.Scoring import HarmonicSumScorer
+
+#harmonic sum scale factor for datasource, datatype and overall scores, as in Scorer
+SCALE_FACTOR = 2
+
+
+def get_raw_scores(evidences, is_direct_do_not_propagate, max_entries):
+    """
+    Compute the raw partial scores of the evidence of one target
+
+    Returns a tuple of disease, datasource, evidence count and direct flag 
+    arrays with an entry for each disease and datasource, followed by their 
+    top max_entries unweighted scores in decreasing order as offset and score
+    arrays, so the scores of the i-th are scores[offsets[i]:offsets[i+1]].
+    Returns None if there is no evidence
+    """
+    diseases = []
+    datasources = []
+    scores = []
+    directs = []
+    for evidence in evidences:
+        datasource = evidence['sourceID']
+        disease = evidence['disease']['id']
+        if datasource in is_direct_do_not_propagate:
+            efo_list = [disease]
+        else:
+            efo_list = evidence['private']['efo_codes']
+        for efo in efo_list:
+            diseases.append(efo)
+            datasources.append(datasource)
+            scores.append(evidence['scores']['association_score'])
+            directs.append(efo == disease)
+
+    if not diseases:
+        return None
+
+    diseases = np.array(diseases)
+    datasources = np.array(datasources)
+    scores = np.array(scores, dtype=float)
+    directs = np.array(directs, dtype=bool)
+
+    #sort by disease, then datasource, then decreasing score
+    order = np.lexsort((-scores, datasources, diseases))
+    diseases = diseases[order]
+    datasources = datasources[order]
+    scores = scores[order]
+    directs = directs[order]
+
+    #start of each disease and datasource group
+    new_group = np.ones(len(diseases), dtype=bool)
+    new_group[1:] = (diseases[1:] != diseases[:-1]) | (datasources[1:] != datasources[:-1])
+    starts = np.flatnonzero(new_group)
+    groups = np.cumsum(new_group) - 1
+    ranks = np.arange(len(diseases)) - starts[groups]
+
+    keep = ranks < max_entries
+    counts = np.diff(np.append(starts, len(diseases)))
+    offsets = np.zeros(len(starts) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(np.minimum(counts, max_entries))
+    group_directs = np.logical_or.reduceat(directs, starts)
+
+    return (diseases[starts], datasources[starts], counts, group_directs, 
+        offsets, scores[keep].astype(np.float32))
+
+
+def write_raw_scores(raw_file, target, raw_scores):
+    """append the raw scores of a target to an open binary file"""
+    for array in (np.array([target]),) + tuple(raw_scores):
+        np.save(raw_file, array, allow_pickle=False)
+    #producers may exit without closing their file
+    raw_file.flush()
+
+
+def open_raw_scores(directory):
+    """open a file in directory to append raw scores to, one per process"""
+    return open(os.path.join(directory, 'raw-%d.npy' % os.getpid()), 'ab')
+
+
+def get_raw_scores_files(directory):
+    """the files raw scores were written to in a directory, one per process"""
+    filenames = sorted(glob.glob(os.path.join(directory, 'raw-*.npy')))
+    if not filenames:
+        raise ValueError("no raw scores in %s" % directory)
+    return filenames
+
+
+def read_raw_scores(filename):
+    """
+    Read the raw scores written to one file, which has all the raw scores of
+    the targets in it as each target is scored by one process
+
+    Returns a tuple of target, disease, datasource, count, direct, offset and
+    score arrays as from get_raw_scores, for every target in the file, or 
+    None if there are none
+    """
+    parts = [[] for _ in range(5)]
+    lengths = []
+    scores = []
+    with open(filename, 'rb') as raw_file:
+        size = os.fstat(raw_file.fileno()).st_size
+        while raw_file.tell() < size:
+            target = np.load(raw_file, allow_pickle=False)[0]
+            diseases = np.load(raw_file, allow_pickle=False)
+            parts[0].append(np.full(len(diseases), target))
+            parts[1].append(diseases)
+            for i in range(2, 5):
+                parts[i].append(np.load(raw_file, allow_pickle=False))
+            lengths.append(np.diff(np.load(raw_file, allow_pickle=False)))
+            scores.append(np.load(raw_file, allow_pickle=False))
+
+    if not lengths:
+        return None
+    lengths = np.concatenate(lengths)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    return tuple(np.concatenate(part) for part in parts) + (offsets, np.concatenate(scores))
+
+
+def reweight(raw_scores, datasources_to_datatypes, scoring_weights, buffer=100):
+    """
+    Recompute the association scores from raw scores with the given weights
+    and harmonic sum buffer, which can't be more than the number of scores
+    that were stored, for the targets of one file from read_raw_scores
+
+    Returns a tuple of target, disease, direct, evidence count and overall
+    score arrays for each target and disease, and a dict of datatype to its
+    array of scores
+    """
+    targets, diseases, datasources, counts, directs, offsets, scores = raw_scores
+    lengths = np.diff(offsets)
+    if np.any(lengths < np.minimum(counts, buffer)):
+        raise ValueError("buffer %d is more than the raw scores stored" % buffer)
+
+    #datasource scores are the capped harmonic sums of the weighted raw scores
+    rows = np.repeat(np.arange(len(lengths)), lengths)
+    ranks = np.arange(len(scores)) - offsets[rows]
+    keep = ranks < buffer
+    weights = np.array([scoring_weights.get(ds, 1.) for ds in datasources])
+    datasource_scores = np.bincount(rows[keep], 
+        weights=scores[keep].astype(float) / (ranks[keep] + 1.) ** SCALE_FACTOR,
+        minlength=len(lengths)) * weights
+    datasource_scores = np.minimum(datasource_scores, 1.)
+
+    #index of the target and disease pair of each row
+    pair_keys = np.char.add(np.char.add(targets, '\t'), diseases)
+    pair_keys, pairs = np.unique(pair_keys, return_inverse=True)
+    pairs_count = len(pair_keys)
+
+    overall = HarmonicSumScorer.grouped_harmonic_sum(pairs, datasource_scores,
+        pairs_count, buffer, SCALE_FACTOR)
+
+    datatypes = sorted(set(datasources_to_datatypes.values()))
+    row_datatypes = np.array([datatypes.index(datasources_to_datatypes[ds]) for ds in datasources])
+    datatype_scores = HarmonicSumScorer.grouped_harmonic_sum(
+        pairs * len(datatypes) + row_datatypes, datasource_scores,
+        pairs_count * len(datatypes), buffer, SCALE_FACTOR).reshape(pairs_count, len(datatypes))
+
+    pair_targets = np.empty(pairs_count, dtype=targets.dtype)
+    pair_targets[pairs] = targets
+    pair_diseases = np.empty(pairs_count, dtype=diseases.dtype)
+    pair_diseases[pairs] = diseases
+    pair_directs = np.zeros(pairs_count, dtype=bool)
+    np.logical_or.at(pair_directs, pairs, directs)
+    pair_counts = np.bincount(pairs, weights=counts, minlength=pairs_count).astype(int)
+
+    return (pair_targets, pair_diseases, pair_directs, pair_counts, overall,
+        dict((dt, datatype_scores[:, i]) for i, dt in enumerate(datatypes)))
+
+
+class ReweightProcess(object):
+
+    def __init__(self, raw_scores_dir, output,
+            datasources_to_datatypes, scoring_weights, buffer):
+        self.logger = logging.getLogger(__name__)
+        self.raw_scores_dir = raw_scores_dir
+        self.output = output
+        self.datasources_to_datatypes = datasources_to_datatypes
+        self.scoring_weights = scoring_weights
+        self.buffer = buffer
+
+    def process_all(self, dry_run):
+        filenames = get_raw_scores_files(self.raw_scores_dir)
+        datatypes = sorted(set(self.datasources_to_datatypes.values()))
+        output = None
+        if not dry_run:
+            opener = gzip.open if self.output.endswith('.gz') else open
+            output = opener(self.output, 'wt')
+            output.write('\t'.join(['target', 'disease', 'is_direct', 'evidence_count',
+                'overall'] + datatypes) + '\n')
+
+        #each file is reweighted separately so only one is in memory at a time
+        written = 0
+        try:
+            for filename in filenames:
+                self.logger.info("reading raw scores from %s", filename)
+                raw_scores = read_raw_scores(filename)
+                if raw_scores is None:
+                    continue
+                self.logger.info("reweighting %d raw scores", len(raw_scores[0]))
+                targets, diseases, directs, counts, overall, datatype_scores = reweight(
+                    raw_scores, self.datasources_to_datatypes, self.scoring_weights, self.buffer)
+
+                #associations without any score are not written, as with --as
+                keep = np.flatnonzero(overall > 0)
+                written += len(keep)
+                if output is None:
+                    continue
+                for i in keep:
+                    output.write('\t'.join([targets[i], diseases[i], str(bool(directs[i])).lower(),
+                        str(counts[i]), repr(float(overall[i]))] +
+                        [repr(float(datatype_scores[dt][i])) for dt in datatypes]) + '\n')
+        finally:
+            if output is not None:
+                output.close()
+        self.logger.info("reweighted %d associations into %s", written, self.output)
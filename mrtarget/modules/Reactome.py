@@ -8,10 +8,9 @@ from networkx.algorithms import all_simple_paths
 
 from mrtarget.common.DataStructure import TreeNode, JSONSerializable
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import open_index, new_bulk_writer
 from opentargets_urlzsource import URLZSource
 
-import elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll
 
@@ -124,7 +123,7 @@ def elasticsearch_actions(reactions, index):
 class ReactomeProcess(object):
     def __init__(self, es_hosts, es_index, es_mappings, es_settings,
             pathway_data_url, pathway_relation_url,
-            workers_write, queue_write):
+            workers_write, queue_write, dead_letter=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
@@ -136,6 +135,7 @@ class ReactomeProcess(object):
         self.data = {}
         self.workers_write = workers_write
         self.queue_write = queue_write
+        self.dead_letter = dead_letter
 
     def process_all(self, dry_run):
 
@@ -160,26 +160,15 @@ class ReactomeProcess(object):
             settings = json.load(settings_file)
 
         es = new_es_client(self.es_hosts)
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        with open_index(es, self.es_index, settings, mappings) as index_manager:
             #write into elasticsearch
-            chunk_size = 1000 #TODO make configurable
             docs = generate_documents(self.g)
-            actions = elasticsearch_actions(docs, self.es_index)
-            failcount = 0
+            actions = elasticsearch_actions(docs, index_manager.write_index)
 
             if not dry_run:
-                results = None
-                if self.workers_write > 0:
-                    results = elasticsearch.helpers.parallel_bulk(es, actions,
-                            thread_count=self.workers_write,
-                            queue_size=self.queue_write, 
-                            chunk_size=chunk_size)
-                else:
-                    results = elasticsearch.helpers.streaming_bulk(es, actions,
-                            chunk_size=chunk_size)
-                for success, _ in results:
-                    if not success:
-                        failcount += 1
+                es_write = new_es_client(self.es_hosts, "bulk-write", self.workers_write)
+                writer = new_bulk_writer(es_write, self.workers_write, self.queue_write, self.dead_letter)
+                _, failcount = writer.write(actions)
 
                 if failcount:
                     raise RuntimeError("%s failed to index" % failcount)
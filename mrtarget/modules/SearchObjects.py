@@ -8,11 +8,10 @@ from collections import defaultdict
 from mrtarget.common.DataStructure import JSONSerializable
 from mrtarget.common.chembl_lookup import ChEMBLLookup
 from mrtarget.common.connection import new_es_client
-from mrtarget.common.esutil import ElasticsearchBulkIndexManager
+from mrtarget.common.esutil import open_index, new_bulk_writer
 
 from opentargets_urlzsource import URLZSource
 
-import elasticsearch
 from elasticsearch_dsl import Search
 from elasticsearch_dsl.query import MatchAll,ConstantScore
 
@@ -184,25 +183,14 @@ def elasticsearch_actions(items, dry_run, index):
 
             yield action
 
-def store_in_elasticsearch(so_it, dry_run, es, index, workers_write, queue_write):
+def store_in_elasticsearch(so_it, dry_run, es, index, workers_write, queue_write,
+        dead_letter=None):
         #write into elasticsearch
-        chunk_size = 1000 #TODO make configurable
         actions = elasticsearch_actions(so_it, dry_run, index)
-        failcount = 0
 
         if not dry_run:
-            results = None
-            if workers_write > 0:
-                results = elasticsearch.helpers.parallel_bulk(es, actions,
-                        thread_count=workers_write,
-                        queue_size=queue_write, 
-                        chunk_size=chunk_size)
-            else:
-                results = elasticsearch.helpers.streaming_bulk(es, actions,
-                        chunk_size=chunk_size)
-            for success, details in results:
-                if not success:
-                    failcount += 1
+            writer = new_bulk_writer(es, workers_write, queue_write, dead_letter)
+            _, failcount = writer.write(actions)
 
             if failcount:
                 raise RuntimeError("%s relations failed to index" % failcount)
@@ -215,7 +203,8 @@ class SearchObjectProcess(object):
             chembl_mechanism_uri, 
             chembl_component_uri, 
             chembl_protein_uri, 
-            chembl_molecule_set_uri_pattern):
+            chembl_molecule_set_uri_pattern,
+            dead_letter=None):
         self.es_hosts = es_hosts
         self.es_index = es_index
         self.es_mappings = es_mappings
@@ -226,6 +215,7 @@ class SearchObjectProcess(object):
         self.es_index_assoc = es_index_assoc
         self.workers_write = workers_write
         self.queue_write = queue_write
+        self.dead_letter = dead_letter
         self.chembl_target_uri = chembl_target_uri
         self.chembl_mechanism_uri = chembl_mechanism_uri
         self.chembl_component_uri = chembl_component_uri
@@ -269,20 +259,21 @@ class SearchObjectProcess(object):
         with URLZSource(self.es_settings).open() as settings_file:
             settings = json.load(settings_file)
 
-        with ElasticsearchBulkIndexManager(es, self.es_index, settings, mappings):
+        es_write = new_es_client(self.es_hosts, "bulk-write", self.workers_write)
+        with open_index(es, self.es_index, settings, mappings) as index_manager:
             #process targets
             self.logger.info('handling targets')
             targets = self.get_targets(es)
             so_it = self.handle_search_object(targets, es, SearchObjectTypes.TARGET)
-            store_in_elasticsearch(so_it, dry_run, es, self.es_index, 
-                self.workers_write, self.queue_write)
+            store_in_elasticsearch(so_it, dry_run, es_write, index_manager.write_index, 
+                self.workers_write, self.queue_write, self.dead_letter)
 
             #process diseases
             self.logger.info('handling diseases')
             diseases = self.get_diseases(es)
             so_it = self.handle_search_object(diseases, es, SearchObjectTypes.DISEASE)
-            store_in_elasticsearch(so_it, dry_run, es, self.es_index, 
-                self.workers_write, self.queue_write)
+            store_in_elasticsearch(so_it, dry_run, es_write, index_manager.write_index, 
+                self.workers_write, self.queue_write, self.dead_letter)
 
 
     def get_targets(self, es):
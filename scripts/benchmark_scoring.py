@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# Benchmark association scoring on synthetic evidence, without elasticsearch
+#
+# Evidence is generated for a number of targets with a power-law skew in the
+# amount of evidence per target, disease and datasource, similar to real data.
+# Expanding evidence to pairs, building Association objects, scoring and JSON
+# serialization are timed separately, for each number of workers given. Every
+# engine reports the number of associations with a score, which are written.
+#
+# Usage: benchmark_scoring.py [--targets N] [--workers 1,2,4] [--engine objects]
+
+from __future__ import print_function
+import argparse
+import functools
+import multiprocessing
+import time
+
+import numpy as np
+
+from mrtarget.modules.Association import Scorer, ColumnarScorer, RollupScorer, \
+    produce_evidence_pairs
+
+DATASOURCES_TO_DATATYPES = {
+    'europepmc': 'literature',
+    'eva': 'genetic_association',
+    'gwas_catalog': 'genetic_association',
+    'ot_genetics_portal': 'genetic_association',
+    'uniprot': 'genetic_association',
+    'expression_atlas': 'rna_expression',
+    'chembl': 'known_drug',
+    'phenodigm': 'animal_model',
+    'reactome': 'affected_pathway',
+    'intogen': 'somatic_mutation',
+}
+SCORING_WEIGHTS = {'europepmc': 0.2, 'expression_atlas': 0.2, 'phenodigm': 0.2}
+IS_DIRECT_DO_NOT_PROPAGATE = ['expression_atlas']
+#datasources in order of decreasing amount of evidence
+DATASOURCES = ['europepmc', 'expression_atlas', 'ot_genetics_portal', 'eva', 'phenodigm',
+    'gwas_catalog', 'chembl', 'uniprot', 'reactome', 'intogen']
+
+
+def make_ontology(diseases, max_depth, rng):
+    """a random disease tree, as a dict of disease to itself and its ancestors"""
+    ancestors = {'EFO_0': ['EFO_0']}
+    for i in range(1, diseases):
+        parent = 'EFO_%d' % rng.randint(0, i)
+        path = ancestors[parent]
+        if len(path) >= max_depth:
+            path = path[-max_depth + 1:]
+        ancestors['EFO_%d' % i] = ['EFO_%d' % i] + path
+    return ancestors
+
+
+def make_evidence_groups(targets, mean_evidence, diseases, seed):
+    """
+    Generate a list of (target, evidence list) tuples
+
+    The amount of evidence per target follows a Pareto distribution, and the
+    diseases and datasources of the evidence follow Zipf distributions
+    """
+    rng = np.random.RandomState(seed)
+    ancestors = make_ontology(diseases, 12, rng)
+    disease_ids = sorted(ancestors, key=lambda d: int(d[4:]))
+
+    counts = np.maximum(1, (rng.pareto(1.2, targets) * mean_evidence * 0.2)).astype(int)
+    groups = []
+    for t, count in enumerate(counts):
+        target = 'ENSG%011d' % t
+        disease_idx = np.minimum(rng.zipf(1.5, count), diseases) - 1
+        datasource_idx = np.minimum(rng.zipf(1.8, count), len(DATASOURCES)) - 1
+        scores = rng.beta(0.5, 2, count)
+        evidence = []
+        for i in range(count):
+            disease = disease_ids[disease_idx[i]]
+            evidence.append({
+                'id': '%s-%d' % (target, i),
+                'target': {'id': target},
+                'disease': {'id': disease},
+                'private': {'efo_codes': ancestors[disease]},
+                'sourceID': DATASOURCES[datasource_idx[i]],
+                'scores': {'association_score': float(scores[i])},
+            })
+        groups.append((target, evidence))
+    return groups, ancestors
+
+
+def benchmark_objects(group):
+    """time each part of the objects engine for one target"""
+    target, evidence = group
+    times = dict(produce=0., construct=0., score=0., serialize=0.)
+    scorer = Scorer()
+
+    start = time.time()
+    pairs = produce_evidence_pairs(target, evidence, SCORING_WEIGHTS,
+        IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES)
+    times['produce'] += time.time() - start
+
+    associations = 0
+    for target, disease, evidence_scores, is_direct in pairs:
+        start = time.time()
+        association = scorer.build(target, disease, evidence_scores, is_direct,
+            DATASOURCES_TO_DATATYPES)
+        times['construct'] += time.time() - start
+
+        #the same as Scorer.score, on the association that was already built
+        start = time.time()
+        scorer._harmonic_sum(evidence_scores, association, 100, 2, DATASOURCES_TO_DATATYPES)
+        times['score'] += time.time() - start
+
+        start = time.time()
+        if association:
+            association.to_json()
+            associations += 1
+        times['serialize'] += time.time() - start
+    return associations, times
+
+
+def benchmark_engine(group, engine):
+    """time a columnar or rollup engine for one target"""
+    target, evidence = group
+    times = dict(score=0., serialize=0.)
+
+    start = time.time()
+    associations = engine.score_target(target, evidence, SCORING_WEIGHTS,
+        IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES)
+    times['score'] += time.time() - start
+
+    start = time.time()
+    for association in associations:
+        association.to_json()
+    times['serialize'] += time.time() - start
+    return len(associations), times
+
+
+def run(groups, workers, benchmark):
+    start = time.time()
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(benchmark, groups, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [benchmark(group) for group in groups]
+    wall = time.time() - start
+
+    associations = sum(r[0] for r in results)
+    times = {}
+    for _, result_times in results:
+        for phase in result_times:
+            times[phase] = times.get(phase, 0.) + result_times[phase]
+    return associations, wall, times
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark association scoring on synthetic evidence')
+    parser.add_argument('--targets', type=int, default=200, help='number of targets')
+    parser.add_argument('--mean-evidence', type=int, default=200, help='mean evidence per target')
+    parser.add_argument('--diseases', type=int, default=2000, help='number of diseases')
+    parser.add_argument('--workers', default='1,2,4', help='comma separated numbers of workers')
+    parser.add_argument('--engine', default='objects', choices=['objects', 'columnar', 'rollup'])
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    groups, ancestors = make_evidence_groups(args.targets, args.mean_evidence,
+        args.diseases, args.seed)
+    #heaviest targets first so the pool isn't waiting on them at the end
+    groups.sort(key=lambda g: len(g[1]), reverse=True)
+    sizes = [len(g[1]) for g in groups]
+    print('%d targets, %d evidence, largest target %d evidence, median %d' % (
+        len(groups), sum(sizes), sizes[0], sizes[len(sizes) // 2]))
+
+    if args.engine == 'objects':
+        benchmark = benchmark_objects
+    elif args.engine == 'columnar':
+        benchmark = functools.partial(benchmark_engine, engine=ColumnarScorer())
+    else:
+        benchmark = functools.partial(benchmark_engine, engine=RollupScorer(ancestors))
+
+    for workers in [int(w) for w in args.workers.split(',')]:
+        associations, wall, times = run(groups, workers, benchmark)
+        phases = ' '.join('%s %.2fs' % (phase, times[phase]) for phase in sorted(times))
+        print('%s workers %d: %d associations in %.2fs wall (%.0f/s), cpu time %s' % (
+            args.engine, workers, associations, wall, associations / wall, phases))
+
+
+if __name__ == '__main__':
+    main()
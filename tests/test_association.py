@@ -0,0 +1,376 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import mock
+import simplejson as json
+
+from mrtarget.common.connection import new_es_client
+from mrtarget.common.esutil import BulkWriter
+from mrtarget.common.scheduling import in_part
+from mrtarget.modules.Association import Scorer, ColumnarScorer, RollupScorer, \
+    AssociationEnricher, produce_evidence_pairs, evidence_digest, read_manifest, \
+    write_manifest, get_changed_evidence_by_target, get_diff_actions, get_scheduled_targets, \
+    AssociationQC, get_association_summary, produce_evidence, produce_evidence_grouped, \
+    get_evidence_by_target, content_hash, read_manifest_build, get_scored_targets
+
+
+DATASOURCES_TO_DATATYPES = {
+    'europepmc': 'literature',
+    'eva': 'genetic_association',
+    'gwas_catalog': 'genetic_association',
+    'expression_atlas': 'rna_expression',
+    'chembl': 'known_drug',
+}
+SCORING_WEIGHTS = {'europepmc': 0.2, 'expression_atlas': 0.2}
+IS_DIRECT_DO_NOT_PROPAGATE = ['expression_atlas']
+ANCESTORS = {
+    'EFO_1': ['EFO_1'],
+    'EFO_2': ['EFO_2', 'EFO_1'],
+    'EFO_3': ['EFO_3', 'EFO_2', 'EFO_1'],
+    'EFO_4': ['EFO_4', 'EFO_1'],
+}
+
+
+def make_evidence(target, count, seed):
+    """synthetic evidence for one target, propagated up a small disease tree"""
+    rng = random.Random(seed)
+    evidences = []
+    for i in range(count):
+        disease = rng.choice(sorted(ANCESTORS))
+        datasource = rng.choice(sorted(DATASOURCES_TO_DATATYPES))
+        evidences.append({
+            'id': str(i),
+            'target': {'id': target},
+            'disease': {'id': disease},
+            'private': {'efo_codes': ANCESTORS[disease]},
+            'sourceID': datasource,
+            'scores': {'association_score': rng.choice([0., 1., rng.random()])},
+        })
+    return evidences
+
+
+def rounded(obj):
+    if isinstance(obj, float):
+        return round(obj, 12)
+    if isinstance(obj, dict):
+        return dict((k, rounded(v)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [rounded(v) for v in obj]
+    return obj
+
+
+class AssociationEnginesTestCase(unittest.TestCase):
+
+    def score_objects(self, target, evidences):
+        scorer = Scorer()
+        associations = {}
+        for target, disease, evidence, is_direct in produce_evidence_pairs(target, evidences,
+                SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES):
+            association = scorer.score(target, disease, evidence, is_direct, DATASOURCES_TO_DATATYPES)
+            if association:
+                associations[association.id] = json.loads(association.to_json())
+        return associations
+
+    def assertSameAsScorer(self, engine):
+        for seed, count in enumerate([1, 10, 500]):
+            evidences = make_evidence('ENSG1', count, seed)
+            expected = self.score_objects('ENSG1', evidences)
+
+            associations = engine.score_target('ENSG1', evidences,
+                SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES)
+            result = dict((a.id, json.loads(a.to_json())) for a in associations)
+
+            self.assertEqual(sorted(result), sorted(expected))
+            for association_id in expected:
+                self.assertEqual(rounded(result[association_id]), rounded(expected[association_id]))
+
+    def test_spill_same_as_in_memory(self):
+        evidences = make_evidence('ENSG1', 2000, 9)
+        expected = self.score_objects('ENSG1', evidences)
+
+        scorer = Scorer()
+        pairs = list(produce_evidence_pairs('ENSG1', evidences, SCORING_WEIGHTS, 
+            IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES, spill_threshold=300))
+        #the root disease has more evidence than kept per datasource
+        self.assertTrue(any(e.count > 1 for _, _, evidence, _ in pairs for e in evidence))
+        result = {}
+        for target, disease, evidence, is_direct in pairs:
+            association = scorer.score(target, disease, evidence, is_direct, DATASOURCES_TO_DATATYPES)
+            if association:
+                result[association.id] = json.loads(association.to_json())
+
+        self.assertEqual(sorted(result), sorted(expected))
+        for association_id in expected:
+            self.assertEqual(rounded(result[association_id]), rounded(expected[association_id]))
+
+    def test_split_parts(self):
+        evidences = make_evidence('ENSG1', 200, 13)
+        expected = [(t, d, len(e), i) for t, d, e, i in produce_evidence_pairs('ENSG1', evidences, 
+            SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES)]
+        result = []
+        for part in range(3):
+            result.extend((t, d, len(e), i) for t, d, e, i in produce_evidence_pairs('ENSG1', 
+                evidences, SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES,
+                disease_filter=lambda efo: in_part(efo, part, 3)))
+        self.assertEqual(sorted(result), sorted(expected))
+
+    def test_scheduled_targets(self):
+        tasks = list(get_scheduled_targets([('A', 5), ('B', 50), ('C', 10)], 20, 3))
+        self.assertEqual(tasks, [(('B', 0, 3), 18), (('B', 1, 3), 16), (('B', 2, 3), 16),
+            (('C', 0, 1), 10), (('A', 0, 1), 5)])
+
+    def test_columnar_same_as_scorer(self):
+        self.assertSameAsScorer(ColumnarScorer())
+
+    def test_rollup_same_as_scorer(self):
+        self.assertSameAsScorer(RollupScorer(ANCESTORS))
+
+    def test_rollup_small_buffer(self):
+        evidences = make_evidence('ENSG1', 500, 3)
+        expected = {}
+        for association in ColumnarScorer(max_entries=3).score_target('ENSG1', evidences,
+                SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES):
+            expected[association.id] = rounded(json.loads(association.to_json()))
+        for association in RollupScorer(ANCESTORS, max_entries=3).score_target('ENSG1', evidences,
+                SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES):
+            self.assertEqual(rounded(json.loads(association.to_json())), expected[association.id])
+
+    def test_no_evidence(self):
+        for engine in [ColumnarScorer(), RollupScorer(ANCESTORS)]:
+            self.assertEqual(engine.score_target('ENSG1', [],
+                SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES), [])
+
+    def test_lean_serialization(self):
+        evidences = make_evidence('ENSG1', 50, 7)
+        full = dict((a.id, json.loads(a.to_json())) for a in ColumnarScorer().score_target('ENSG1',
+            evidences, SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES))
+        associations = ColumnarScorer(scoring_methods=['harmonic-sum']).score_target('ENSG1',
+            evidences, SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES)
+        self.assertEqual(sorted(a.id for a in associations), sorted(full))
+
+        for association in associations:
+            lean = json.loads(association.to_json(skip_zero_scores=True))
+            expected = full[association.id]
+            self.assertNotIn('sum', lean)
+            self.assertNotIn('max', lean)
+            hs = lean['harmonic-sum']
+            self.assertEqual(hs['overall'], expected['harmonic-sum']['overall'])
+            self.assertEqual(hs['datasources'], dict((k, v) for k, v in 
+                expected['harmonic-sum']['datasources'].items() if v))
+            self.assertTrue(all(lean['evidence_count']['datasources'].values()))
+            self.assertEqual(lean['evidence_count']['total'], expected['evidence_count']['total'])
+
+
+class EvidenceReaderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.evidences = []
+        for i, target in enumerate(['ENSG3', 'ENSG1', 'ENSG2']):
+            self.evidences.extend(make_evidence(target, 20 + i, i))
+        random.Random(1).shuffle(self.evidences)
+
+    def scan(self, search):
+        """stand-in for Search.scan over the evidence, for the queries of both readers"""
+        body = search.to_dict()
+        evidences = self.evidences
+        if 'constant_score' in body['query']:
+            targets = list(body['query']['constant_score']['filter'].values())[0]['target.id']
+            if not isinstance(targets, list):
+                targets = [targets]
+            evidences = [ev for ev in evidences if ev['target']['id'] in targets]
+        if body.get('sort'):
+            evidences = sorted(evidences, key=lambda ev: ev['target']['id'])
+        return [mock.Mock(**{'to_dict.return_value': ev}) for ev in evidences]
+
+    def pairs(self, results):
+        return sorted((t, d, sorted((e.score, e.datasource) for e in evidence), is_direct)
+            for t, d, evidence, is_direct in results)
+
+    def test_single_pass_same_as_per_target(self):
+        args = (produce_evidence_pairs, SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, 
+            DATASOURCES_TO_DATATYPES)
+        with mock.patch('mrtarget.modules.Association.Search.scan', autospec=True, 
+                side_effect=self.scan):
+            expected = []
+            for target in ['ENSG1', 'ENSG2', 'ENSG3']:
+                expected.extend(produce_evidence(target, None, 'evidence', *args))
+            self.assertTrue(len(expected) > 3)
+
+            grouped = list(get_evidence_by_target(None, 'evidence'))
+            self.assertEqual([target for target, _ in grouped], ['ENSG1', 'ENSG2', 'ENSG3'])
+            result = []
+            for data in grouped:
+                result.extend(produce_evidence_grouped(data, None, 'evidence', *args))
+
+            self.assertEqual(self.pairs(result), self.pairs(expected))
+            #only the evidence of the given targets is read, in batches
+            self.assertEqual([target for target, _ in 
+                get_evidence_by_target(None, 'evidence', ['ENSG2'])], ['ENSG2'])
+            with mock.patch('mrtarget.modules.Association.TARGETS_BATCH_SIZE', 1):
+                batched = list(get_evidence_by_target(None, 'evidence', ['ENSG3', 'ENSG1']))
+            self.assertEqual(batched, [data for data in grouped if data[0] != 'ENSG2'])
+
+    def test_scored_targets(self):
+        es = new_es_client(["sqlite://"])
+        evidences = [dict(ev, target={'id': 'ENSG4'}, sourceID='eva') for ev in self.evidences
+            if ev['scores']['association_score'] > 0]
+        BulkWriter(es).write({"_index": "evidence", "_id": str(i), "_source": ev} 
+            for i, ev in enumerate(self.evidences + evidences))
+        try:
+            self.assertEqual(sorted(get_scored_targets(es, 'evidence', SCORING_WEIGHTS)),
+                ['ENSG1', 'ENSG2', 'ENSG3', 'ENSG4'])
+            #evidence of datasources weighted 0 doesn't make associations
+            self.assertEqual(sorted(get_scored_targets(es, 'evidence', {'eva': 0})),
+                ['ENSG1', 'ENSG2', 'ENSG3'])
+        finally:
+            es.indices.delete(index='evidence')
+
+
+class AssociationEnricherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lookup_data = mock.Mock()
+        self.lookup_data.available_genes.get_gene.return_value = {
+            'id': 'ENSG1', 'approved_symbol': 'ABC', 'approved_name': 'a gene',
+            'go': [{'id': 'GO:1', 'value': {'term': 'P:a process'}}],
+            'uniprot_keywords': ['kw']}
+        self.lookup_data.available_hpa.get_hpa.return_value = None
+        self.lookup_data.available_efos.get_efo.side_effect = lambda code: {
+            'code': code, 'label': 'label ' + code, 'path_codes': [[code]],
+            'therapeutic_codes': ['EFO_1'], 'therapeutic_labels': ['area']}
+
+    def test_enrich_once_per_target(self):
+        enricher = AssociationEnricher(self.lookup_data, 1024*1024)
+        evidences = make_evidence('ENSG1', 100, 11)
+        associations = ColumnarScorer().score_target('ENSG1', evidences,
+            SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES)
+        self.assertTrue(len(associations) > 1)
+
+        for association in associations:
+            enricher.enrich(association)
+            data = json.loads(association.to_json())
+            self.assertEqual(data['target']['gene_info']['symbol'], 'ABC')
+            self.assertEqual(data['disease']['efo_info']['label'], 'label ' + association.disease['id'])
+            self.assertEqual(data['private']['facets']['go']['biological_process'],
+                [{'code': 'GO:1', 'term': 'a process'}])
+            free_text = data['private']['facets']['free_text_search']
+            self.assertEqual(free_text.count('ABC'), 1)
+            self.assertEqual(free_text.count('label ' + association.disease['id']), 1)
+
+        self.assertEqual(self.lookup_data.available_genes.get_gene.call_count, 1)
+        self.assertEqual(self.lookup_data.available_hpa.get_hpa.call_count, 1)
+        self.assertEqual(self.lookup_data.available_efos.get_efo.call_count, len(associations))
+
+        #the target block is shared, the free text is not
+        self.assertIs(associations[0].target['gene_info'], associations[1].target['gene_info'])
+        self.assertIsNot(associations[0].private['facets']['free_text_search'],
+            associations[1].private['facets']['free_text_search'])
+
+
+class IncrementalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_digest_order_independent(self):
+        evidences = make_evidence('ENSG1', 20, 5)
+        self.assertEqual(evidence_digest(evidences), evidence_digest(list(reversed(evidences))))
+        changed = [dict(ev) for ev in evidences]
+        changed[0]['scores'] = {'association_score': 0.123}
+        self.assertNotEqual(evidence_digest(evidences), evidence_digest(changed))
+
+    def test_manifest_roundtrip(self):
+        digests = {'ENSG1': 'a'*40, 'ENSG2': 'b'*40}
+        for filename in ['manifest.tsv', 'manifest.tsv.gz']:
+            filename = os.path.join(self.tmpdir, filename)
+            write_manifest(filename, digests)
+            self.assertEqual(read_manifest(filename), digests)
+            self.assertEqual(read_manifest_build(filename), None)
+            #the build the associations were written into is recorded
+            write_manifest(filename, digests, 'associations-20260101000000')
+            self.assertEqual(read_manifest(filename), digests)
+            self.assertEqual(read_manifest_build(filename), 'associations-20260101000000')
+
+    def test_changed_targets(self):
+        evidence = dict((target, make_evidence(target, 10, i)) 
+            for i, target in enumerate(['ENSG1', 'ENSG2', 'ENSG3']))
+        previous = {}
+        list(get_changed_evidence_by_target(sorted(evidence.items()), previous, 
+            None, None, 'index', False))
+        self.assertEqual(sorted(previous), ['ENSG1', 'ENSG2', 'ENSG3'])
+
+        #ENSG2 changes, ENSG3 is gone and ENSG4 is new
+        evidence['ENSG2'] = make_evidence('ENSG2', 11, 1)
+        del evidence['ENSG3']
+        evidence['ENSG4'] = make_evidence('ENSG4', 3, 4)
+
+        es = mock.Mock()
+        digests = {}
+        changed = list(get_changed_evidence_by_target(sorted(evidence.items()), digests,
+            previous, es, 'index', False))
+        self.assertEqual([target for target, _ in changed], ['ENSG2', 'ENSG4'])
+        self.assertEqual(sorted(digests), ['ENSG1', 'ENSG2', 'ENSG4'])
+
+        deleted = [sorted(c[1]['body']['query']['terms']['target.id']) 
+            for c in es.delete_by_query.call_args_list]
+        self.assertEqual(deleted, [['ENSG2', 'ENSG4'], ['ENSG3']])
+
+    def test_hash_order_independent(self):
+        evidences = make_evidence('ENSG1', 100, 19)
+        hashes = []
+        for ordered in [evidences, list(reversed(evidences))]:
+            associations = ColumnarScorer().score_target('ENSG1', ordered,
+                SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES)
+            hashes.append(dict((a.id, content_hash(a.to_json(skip_zero_scores=True)))
+                for a in associations))
+        self.assertTrue(any(len(json.loads(a.to_json())['private']['facets']['datasource']) > 1
+            for a in associations))
+        self.assertEqual(hashes[0], hashes[1])
+
+    def test_diff_actions(self):
+        def actions(docs):
+            return [{'_index': 'index', '_id': k, '_source': json.dumps(v, sort_keys=True)}
+                for k, v in sorted(docs.items())]
+
+        docs = {'A-1': {'score': 1}, 'A-2': {'score': 0.5}, 'B-1': {'score': 0.1}}
+        previous = {}
+        self.assertEqual(len(list(get_diff_actions(actions(docs), 'index', None, previous))), 3)
+
+        docs['A-2'] = {'score': 0.6}
+        del docs['B-1']
+        docs['C-1'] = {'score': 0.2}
+        hashes = {}
+        result = list(get_diff_actions(actions(docs), 'index', previous, hashes))
+        self.assertEqual([(a.get('_op_type', 'index'), a['_id']) for a in result],
+            [('index', 'A-2'), ('index', 'C-1'), ('delete', 'B-1')])
+        self.assertEqual(sorted(hashes), ['A-1', 'A-2', 'C-1'])
+        self.assertEqual(hashes['A-1'], previous['A-1'])
+
+
+class AssociationQCTestCase(unittest.TestCase):
+
+    def test_metrics(self):
+        associations = ColumnarScorer().score_target('ENSG1', make_evidence('ENSG1', 200, 17),
+            SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES)
+        association_qc = AssociationQC()
+        for association in associations:
+            association_qc.add(get_association_summary(association))
+        metrics = association_qc.metrics()
+
+        self.assertEqual(metrics['association.count'], len(associations))
+        self.assertEqual(metrics['association.direct.count'], 
+            len([a for a in associations if a.is_direct]))
+        self.assertEqual(metrics['association.direct.count'] + metrics['association.indirect.count'],
+            len(associations))
+        self.assertEqual(metrics['association.datasource.europepmc.count'],
+            len([a for a in associations if a.evidence_count['datasources']['europepmc']]))
+        overall = sorted(a.get_scoring_method('harmonic-sum').overall for a in associations)
+        self.assertTrue(overall[0] <= metrics['association.overall.p05'] <= metrics['association.overall.p50'] 
+            <= metrics['association.overall.p95'] <= overall[-1])
+        self.assertIn('association.datatype.literature.p50', metrics)
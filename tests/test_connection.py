@@ -0,0 +1,46 @@
+import unittest
+
+import mrtarget.common.connection
+from mrtarget.common.connection import new_es_client, configure_transport, \
+    PooledRequestsHttpConnection
+from elasticsearch import Urllib3HttpConnection
+
+
+def get_connection(es):
+    return es.transport.connection_pool.connections[0]
+
+
+class ConnectionTestCase(unittest.TestCase):
+
+    def tearDown(self):
+        configure_transport()
+
+    def test_profiles(self):
+        connection = get_connection(new_es_client(["http://localhost:9200"], "bulk-write"))
+        self.assertTrue(isinstance(connection, PooledRequestsHttpConnection))
+        self.assertEqual(connection.timeout, 1800)
+        self.assertTrue(connection.http_compress)
+
+        connection = get_connection(new_es_client(["http://localhost:9200"], "lookup"))
+        self.assertEqual(connection.timeout, 60)
+        self.assertFalse(connection.http_compress)
+
+    def test_workers_pool(self):
+        configure_transport("urllib3")
+        connection = get_connection(new_es_client(["http://localhost:9200"], "bulk-write", 8))
+        self.assertTrue(isinstance(connection, Urllib3HttpConnection))
+        self.assertEqual(connection.pool.pool.maxsize, 9)
+
+        connection = get_connection(new_es_client(["http://localhost:9200"], "scan"))
+        self.assertEqual(connection.pool.pool.maxsize,
+            mrtarget.common.connection.TRANSPORT_PROFILES["scan"]["maxsize"])
+
+    def test_configure_transport(self):
+        configure_transport("requests", compress=False)
+        connection = get_connection(new_es_client(["http://localhost:9200"], "bulk-write"))
+        self.assertFalse(connection.http_compress)
+        self.assertRaises(ValueError, configure_transport, "curl")
+
+
+if __name__ == '__main__':
+    unittest.main()
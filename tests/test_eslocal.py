@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+import elasticsearch.helpers
+from elasticsearch import NotFoundError
+from elasticsearch_dsl import Search
+from elasticsearch_dsl.query import Match, Bool, MatchAll, ConstantScore, Q
+
+from mrtarget.common.connection import new_es_client
+from mrtarget.common.eslocal import LocalElasticsearch
+from mrtarget.common.esutil import BulkWriter, ElasticsearchBulkIndexManager, rollback_alias, \
+    prepare_shared_index, finish_shared_index
+from mrtarget.common.scheduling import get_key_counts, get_keys
+
+
+def associations(index="test"):
+    for i in range(30):
+        yield {"_index": index, "_id": "T%d-D%d" % (i % 3, i), "_source": {
+            "target": {"id": "T%d" % (i % 3)}, "disease": {"id": "D%d" % i},
+            "is_direct": i % 2 == 0, "harmonic-sum": {"overall": i / 30.}}}
+
+
+class LocalElasticsearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.es = new_es_client(["sqlite:///%s" % os.path.join(self.folder, "es.db")])
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    def write(self, sleep, **kwargs):
+        with ElasticsearchBulkIndexManager(self.es, "test", {"number_of_shards": 2},
+                {"properties": {}}, **kwargs) as index_manager:
+            actions = associations(index_manager.write_index)
+            self.assertEqual(BulkWriter(self.es).write(actions), (30, 0))
+        return index_manager
+
+    def test_write(self):
+        self.assertTrue(isinstance(self.es, LocalElasticsearch))
+        self.write()
+        settings = self.es.indices.get_settings(index="test")["test"]["settings"]["index"]
+        self.assertEqual(settings["number_of_shards"], "2")
+        #settings are restored on exit
+        self.assertNotIn("refresh_interval", settings)
+        self.assertTrue(self.es.cat.indices(index="test").startswith("green"))
+
+        #other clients of the same file see the documents
+        es = new_es_client(["sqlite:///%s" % os.path.join(self.folder, "es.db")], "lookup")
+        self.assertEqual(es.count(index="test")["count"], 30)
+        self.assertEqual(es.get(index="test", id="T0-D3")["_source"]["disease"]["id"], "D3")
+        self.assertRaises(NotFoundError, es.get, index="test", id="missing")
+
+    def test_search(self):
+        self.write()
+        response = Search().using(self.es).index("test").extra(track_total_hits=True).query(
+            Match(_id="T1-D4"))[0:1].source(includes=["disease.id"]).execute()
+        self.assertEqual(response.hits.total.value, 1)
+        self.assertEqual(response.hits[0].to_dict(), {"disease": {"id": "D4"}})
+
+        response = Search().using(self.es).index("test").query(Bool(should=[
+            Match(**{"disease.id": "D1"}), Match(**{"disease.id": "D2"})])).execute()
+        self.assertEqual(sorted(hit.meta.id for hit in response), ["T1-D1", "T2-D2"])
+
+        #sorted scan, as when reading evidence by target
+        hits = Search().using(self.es).index("test").query(
+            ConstantScore(filter=Q("terms", target__id=["T0", "T2"]))).sort("target.id").params(
+            scroll="1m", size=4, preserve_order=True).scan()
+        targets = [hit.target.id for hit in hits]
+        self.assertEqual(targets, ["T0"] * 10 + ["T2"] * 10)
+
+        hits = elasticsearch.helpers.scan(self.es, index="test", size=7,
+            query={"query": {"term": {"is_direct": True}}, "_source": {"includes": ["disease.id"]}})
+        self.assertEqual(len(list(hits)), 15)
+
+    def test_aggregations(self):
+        self.write()
+        self.assertEqual(sorted(get_key_counts(self.es, "test", "target.id", page_size=2)),
+            [("T0", 10), ("T1", 10), ("T2", 10)])
+        self.assertEqual(list(get_keys(self.es, "test", "target.id",
+            Q("term", **{"disease.id": "D4"}))), ["T1"])
+
+        s = Search().using(self.es).index("test")[:0].query(
+            ConstantScore(filter={"term": {"target.id": "T0"}}))
+        s.aggs.bucket("direct", "filter", term={"is_direct": "true"}).bucket(
+            "top", "top_hits", sort={"harmonic-sum.overall": {"order": "desc"}}, size=2,
+            _source=["disease.id"])
+        direct = s.execute().aggregations.direct
+        self.assertEqual(direct.doc_count, 5)
+        self.assertEqual([hit["_source"]["disease"]["id"] for hit in direct.top.hits.hits],
+            ["D24", "D18"])
+
+    def test_aliases(self):
+        with mock.patch("mrtarget.common.esutil.time.strftime") as strftime:
+            for build in ("20260101000000", "20260102000000"):
+                strftime.return_value = build
+                index_manager = self.write(use_alias=True)
+        self.assertEqual(index_manager.write_index, "test-20260102000000")
+        self.assertEqual(Search().using(self.es).index("test").query(MatchAll()).count(), 30)
+        self.assertEqual(rollback_alias(self.es, "test"), "test-20260101000000")
+        self.assertEqual(list(self.es.indices.get_alias(name="test")), ["test-20260101000000"])
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    def test_append_alias(self, sleep):
+        with mock.patch("mrtarget.common.esutil.time.strftime") as strftime:
+            strftime.return_value = "20260101000000"
+            self.write(use_alias=True)
+            strftime.return_value = "20260102000000"
+            with ElasticsearchBulkIndexManager(self.es, "test", {}, {}, append_data=True,
+                    use_alias=True) as index_manager:
+                self.assertEqual(index_manager.write_index, "test-20260102000000")
+                BulkWriter(self.es).write([{"_op_type": "delete", 
+                    "_index": index_manager.write_index, "_id": "T0-D0"}])
+                #readers do not see the changes until the new build is finalized
+                self.assertEqual(self.es.count(index="test")["count"], 30)
+        self.assertEqual(list(self.es.indices.get_alias(name="test")), ["test-20260102000000"])
+        self.assertEqual(self.es.count(index="test")["count"], 29)
+        self.assertEqual(self.es.count(index="test-20260101000000")["count"], 30)
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    def test_shared(self, sleep):
+        settings = {"index": {"number_of_shards": 2, "refresh_interval": "1s"}}
+        #shards can only write into a prepared index
+        self.assertRaises(ValueError, ElasticsearchBulkIndexManager(self.es, "test",
+            shared=True, use_alias=True).__enter__)
+        with mock.patch("mrtarget.common.esutil.time.strftime") as strftime:
+            strftime.return_value = "20260101000000"
+            self.write(use_alias=True)
+            strftime.return_value = "20260102000000"
+            self.assertEqual(prepare_shared_index(self.es, "test", settings, use_alias=True),
+                "test-20260102000000")
+
+        actions = list(associations("test-20260102000000"))
+        for shard in range(2):
+            with ElasticsearchBulkIndexManager(self.es, "test", settings, shared=True,
+                    use_alias=True) as index_manager:
+                self.assertEqual(index_manager.write_index, "test-20260102000000")
+                BulkWriter(self.es).write(actions[shard::2])
+        #readers see the previous build until the shared one is finished
+        self.assertEqual(list(self.es.indices.get_alias(name="test")), ["test-20260101000000"])
+
+        finish_shared_index(self.es, "test", settings, use_alias=True)
+        self.assertEqual(list(self.es.indices.get_alias(name="test")), ["test-20260102000000"])
+        self.assertEqual(self.es.count(index="test")["count"], 30)
+        index_settings = self.es.indices.get_settings(index="test")["test-20260102000000"]
+        self.assertEqual(index_settings["settings"]["index"]["refresh_interval"], "1s")
+        self.assertRaises(ValueError, finish_shared_index, self.es, "test", settings, use_alias=True)
+
+    def test_bulk(self):
+        self.write()
+        self.es.delete_by_query(index="test", body={"query": {"terms": {"target.id": ["T0"]}}})
+        response = self.es.bulk(body="\n".join([
+            '{"delete": {"_index": "test", "_id": "T1-D1"}}',
+            '{"delete": {"_index": "test", "_id": "T0-D0"}}',
+            '{"create": {"_index": "test", "_id": "T1-D4"}}', '{}',
+            '{"update": {"_index": "test", "_id": "T1-D7"}}', '{"doc": {"target": {"label": "one"}}}',
+            '{"index": {"_index": "other"}}', '{"value": 1}']) + "\n")
+        self.assertEqual([list(item.values())[0]["status"] for item in response["items"]],
+            [200, 404, 409, 200, 201])
+        self.assertEqual(self.es.get(index="test", id="T1-D7")["_source"]["target"],
+            {"id": "T1", "label": "one"})
+        self.assertEqual(self.es.count(index="test")["count"], 19)
+        #indexes are created when written to
+        self.assertTrue(self.es.indices.exists(index="other"))
+
+    def test_memory(self):
+        es = new_es_client(["sqlite://"])
+        es.indices.create(index="memory")
+        self.assertTrue(new_es_client(["sqlite://"]).indices.exists(index="memory"))
+        self.assertFalse(self.es.indices.exists(index="memory"))
+        es.indices.delete(index="memory")
+
+        #forked workers would see an empty database
+        with mock.patch("mrtarget.common.eslocal.os.getpid", return_value=-1):
+            self.assertRaises(RuntimeError, es.indices.exists, index="memory")
+            self.assertTrue(isinstance(self.es.indices.exists(index="memory"), bool))
+
+
+if __name__ == '__main__':
+    unittest.main()
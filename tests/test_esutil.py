@@ -0,0 +1,494 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import mock
+import simplejson as json
+
+from elasticsearch import TransportError
+
+import threading
+import time
+
+from mrtarget.common.esutil import BulkWriter, encode_action, ElasticsearchBulkIndexManager, \
+    wait_for_indexes, wait_for_all_indexes, rollback_alias, murmur3_32, get_shard, \
+    FolderIndexManager, FolderWriter, load_folder
+
+
+def bulk_response(statuses):
+    return {"errors": any(s >= 300 for s in statuses),
+        "items": [{"index": {"status": s, "error": None if s < 300 else {"type": "error %d" % s}}}
+            for s in statuses]}
+
+
+def get_bulk_lines(body):
+    return [json.loads(line) for line in body.decode("utf-8").splitlines()]
+
+
+def get_bulk_ids(es):
+    """ids of the documents sent in each call to bulk"""
+    ids = []
+    for call in es.bulk.call_args_list:
+        lines = get_bulk_lines(call[1]["body"])
+        ids.append([line["index"]["_id"] for line in lines if "index" in line])
+    return ids
+
+
+class BulkWriterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dead_letter = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dead_letter)
+
+    def actions(self, count):
+        return [{"_index": "test", "_id": str(i), "_source": {"value": i}} for i in range(count)]
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    def test_retry_rejected(self, sleep):
+        es = mock.Mock()
+        es.bulk.side_effect = [bulk_response([201, 429, 201, 429]), bulk_response([201, 201])]
+        writer = BulkWriter(es, dead_letter=self.dead_letter)
+
+        self.assertEqual(writer.write(self.actions(4)), (4, 0))
+        #only the rejected documents are sent again
+        self.assertEqual(get_bulk_ids(es), [["0", "1", "2", "3"], ["1", "3"]])
+        self.assertEqual(writer.retried, 2)
+        sleep.assert_called_once_with(2)
+        self.assertEqual(os.listdir(self.dead_letter), [])
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    def test_dead_letter(self, sleep):
+        es = mock.Mock()
+        es.bulk.side_effect = [bulk_response([201, 400, 429]), bulk_response([429]),
+            bulk_response([429])]
+        writer = BulkWriter(es, dead_letter=self.dead_letter, max_retries=2)
+
+        self.assertEqual(writer.write(self.actions(3)), (1, 2))
+        self.assertEqual((writer.written, writer.failed), (1, 2))
+        #backoff doubles on each retry
+        self.assertEqual([c[0][0] for c in sleep.call_args_list], [2, 4])
+
+        with open(os.path.join(self.dead_letter, "test.ndjson")) as dead_letter_file:
+            failed = [json.loads(line) for line in dead_letter_file]
+        self.assertEqual([(f["action"]["_id"], f["status"], f["source"]) for f in failed],
+            [("1", 400, {"value": 1}), ("2", 429, {"value": 2})])
+
+    def test_dead_letter_separators(self):
+        es = mock.Mock()
+        es.bulk.return_value = bulk_response([400])
+        writer = BulkWriter(es, dead_letter=self.dead_letter)
+        source = {"value": u"a\u2028b\x1cc\rd"}
+        self.assertEqual(writer.write([{"_index": "test", "_id": "0", "_source": source}]), (0, 1))
+        with open(os.path.join(self.dead_letter, "test.ndjson")) as dead_letter_file:
+            self.assertEqual(json.loads(dead_letter_file.read())["source"], source)
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    def test_request_rejected(self, sleep):
+        es = mock.Mock()
+        es.bulk.side_effect = [TransportError(429, "es_rejected_execution_exception", {}),
+            bulk_response([201, 201])]
+        writer = BulkWriter(es, dead_letter=self.dead_letter)
+        self.assertEqual(writer.write(self.actions(2)), (2, 0))
+
+        es.bulk.side_effect = [TransportError(400, "parse_exception", {})]
+        self.assertEqual(writer.write(self.actions(2)), (0, 2))
+        self.assertEqual((writer.written, writer.failed), (2, 2))
+
+    def test_ignore_status(self):
+        es = mock.Mock()
+        es.bulk.return_value = {"errors": True,
+            "items": [{"delete": {"status": 404}}, {"delete": {"status": 200}}]}
+        writer = BulkWriter(es, ignore_status=(404,))
+        actions = [{"_op_type": "delete", "_index": "test", "_id": str(i)} for i in range(2)]
+        self.assertEqual(writer.write(actions), (2, 0))
+        #deletes don't have a source line
+        self.assertEqual(len(get_bulk_lines(es.bulk.call_args[1]["body"])), 2)
+
+    def test_workers(self):
+        es = mock.Mock()
+        es.bulk.side_effect = lambda body: bulk_response([201] * (len(get_bulk_lines(body)) // 2))
+        actions = [{"_index": "test", "_id": "%03d" % i, "_source": {"value": "%03d" % i}}
+            for i in range(95)]
+        #10 actions fit in a request
+        size = 10 * len(encode_action(actions[0]))
+        writer = BulkWriter(es, workers=3, queue_size=2, target_bytes=size, min_bytes=size,
+            max_bytes=size)
+        self.assertEqual(writer.write(actions), (95, 0))
+        self.assertEqual(es.bulk.call_count, 10)
+        self.assertEqual(sorted(sum(get_bulk_ids(es), [])), ["%03d" % i for i in range(95)])
+
+    def test_workers_bounded(self):
+        es = mock.Mock()
+        sending = threading.Event()
+        release = threading.Event()
+        def bulk(body):
+            sending.set()
+            release.wait(10)
+            return bulk_response([201] * (len(get_bulk_lines(body)) // 2))
+        es.bulk.side_effect = bulk
+        read = []
+        def actions():
+            for i in range(200):
+                read.append(i)
+                yield {"_index": "test", "_id": "%03d" % i, "_source": {"value": "%03d" % i}}
+        size = 10 * len(encode_action(next(actions())))
+        del read[:]
+        writer = BulkWriter(es, workers=2, queue_size=3, target_bytes=size, min_bytes=size,
+            max_bytes=size)
+        thread = threading.Thread(target=writer.write, args=(actions(),))
+        thread.start()
+        sending.wait(10)
+        time.sleep(0.2)
+        #only the chunks that fit in the queue are read while the workers are busy
+        self.assertTrue(len(read) <= 4 * 10 + 1)
+        release.set()
+        thread.join()
+        self.assertEqual(len(read), 200)
+        self.assertEqual(writer.written, 200)
+
+    def test_chunk_bytes(self):
+        es = mock.Mock()
+        es.bulk.side_effect = lambda body: bulk_response([201] * (len(get_bulk_lines(body)) // 2))
+        actions = [{"_index": "test", "_id": str(i), "_source": {"text": "x" * size}}
+            for i, size in enumerate([100, 100, 1000, 100, 100])]
+        writer = BulkWriter(es, target_bytes=400, min_bytes=400, max_bytes=400)
+        self.assertEqual(writer.write(actions), (5, 0))
+        #a document larger than the target is sent on its own
+        self.assertEqual(get_bulk_ids(es), [["0", "1"], ["2"], ["3", "4"]])
+        for call in es.bulk.call_args_list:
+            self.assertTrue(call[1]["body"].endswith(b"\n"))
+
+    def test_adapt_bytes(self):
+        writer = BulkWriter(mock.Mock(), target_bytes=1000, min_bytes=500, max_bytes=1500,
+            target_latency=10)
+
+        #fast requests grow up to the maximum
+        writer._adapt(1, False)
+        self.assertEqual(writer.target_bytes, 1250)
+        writer._adapt(1, False)
+        writer._adapt(1, False)
+        self.assertEqual(writer.target_bytes, 1500)
+
+        #requests close to the target latency don't change it
+        writer._adapt(8, False)
+        self.assertEqual(writer.target_bytes, 1500)
+
+        #slow or rejected requests shrink down to the minimum
+        writer._adapt(11, False)
+        self.assertEqual(writer.target_bytes, 750)
+        writer._adapt(1, True)
+        self.assertEqual(writer.target_bytes, 500)
+
+    def test_encode_action(self):
+        lines = encode_action({"_index": "test", "_id": "1", "_source": {"a": 1}})
+        self.assertEqual(get_bulk_lines(lines), 
+            [{"index": {"_index": "test", "_id": "1"}}, {"a": 1}])
+        #serialized sources are only concatenated
+        for source in ['{"a": 1}', b'{"a": 1}']:
+            lines = encode_action({"_index": "test", "_id": "1", "_source": source})
+            self.assertTrue(lines.endswith(b'\n{"a": 1}\n'))
+        lines = encode_action({"_op_type": "delete", "_index": "test", "_id": "1"})
+        self.assertEqual(get_bulk_lines(lines), [{"delete": {"_index": "test", "_id": "1"}}])
+
+    def test_write_encoded(self):
+        es = mock.Mock()
+        es.bulk.return_value = bulk_response([201, 400])
+        writer = BulkWriter(es, dead_letter=self.dead_letter)
+        actions = [encode_action({"_index": "test", "_id": str(i), "_source": b'{"value": %d}' % i})
+            for i in range(2)]
+        self.assertEqual(writer.write(actions), (1, 1))
+        self.assertEqual(es.bulk.call_args[1]["body"], b"".join(actions))
+
+        with open(os.path.join(self.dead_letter, "test.ndjson")) as dead_letter_file:
+            failed = json.loads(dead_letter_file.read())
+        self.assertEqual((failed["op_type"], failed["action"]["_id"], failed["source"]),
+            ("index", "1", {"value": 1}))
+
+    def test_route_shards(self):
+        es = mock.Mock()
+        es.bulk.side_effect = lambda body: bulk_response([201] * (len(get_bulk_lines(body)) // 2))
+        es.indices.get_settings.return_value = {"test-20260101000000": {"settings": {"index": {
+            "number_of_shards": "3"}}}}
+        actions = self.actions(30)
+        size = 4 * len(encode_action(actions[0]))
+        writer = BulkWriter(es, target_bytes=size, min_bytes=size, max_bytes=size, 
+            route_shards=True)
+        #encoded actions carry their index and routing, so are not parsed again
+        with mock.patch("mrtarget.common.esutil.get_action_meta") as get_action_meta:
+            self.assertEqual(writer.write(actions), (30, 0))
+        self.assertFalse(get_action_meta.called)
+
+        ids = get_bulk_ids(es)
+        self.assertEqual(sorted(sum(ids, []), key=int), [str(i) for i in range(30)])
+        for chunk in ids:
+            self.assertTrue(len(chunk) <= 4)
+            self.assertEqual(len(set(get_shard(i, 3) for i in chunk)), 1)
+        #settings are only read once per index
+        es.indices.get_settings.assert_called_once_with(index="test")
+
+    def test_encoded_action_pickle(self):
+        encoded = encode_action({"_index": "test", "_id": "1", "_source": {"a": 1}})
+        self.assertEqual((encoded.index_name, encoded.routing), ("test", "1"))
+        unpickled = pickle.loads(pickle.dumps(encoded))
+        self.assertEqual(unpickled, encoded)
+        self.assertEqual((unpickled.index_name, unpickled.routing), ("test", "1"))
+        routed = encode_action({"_index": "test", "_id": "1", "_routing": "T1", "_source": {}})
+        self.assertEqual(routed.routing, "T1")
+
+    def test_get_shard(self):
+        #elasticsearch hashes the UTF-16 code units of the routing
+        self.assertEqual(murmur3_32("hello".encode("utf-16-le")), 0xd7c31989)
+        self.assertEqual(murmur3_32("The quick brown fox jumps over the lazy dog".encode("utf-16-le")),
+            0xe07db09c)
+        self.assertEqual(murmur3_32(b"hello"), 0x248bfa47)
+
+        shards = [get_shard(str(i), 5) for i in range(1000)]
+        self.assertEqual(set(shards), set(range(5)))
+        #5 shards can be split into 640 by default
+        self.assertEqual(shards, [get_shard(str(i), 5, 640) for i in range(1000)])
+        self.assertEqual(get_shard("1", 1), 0)
+
+
+class IndexManagerTestCase(unittest.TestCase):
+
+    def client(self):
+        es = mock.Mock()
+        es.indices.exists.return_value = False
+        es.indices.get_settings.return_value = {}
+        es.cat.indices.return_value = "green open test"
+        return es
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    def test_finalize_sync(self, sleep):
+        es = self.client()
+        with ElasticsearchBulkIndexManager(es, "test"):
+            pass
+        es.indices.forcemerge.assert_called_once_with(index="test", max_num_segments=1)
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    def test_finalize_async(self, sleep):
+        es = self.client()
+        merging = threading.Event()
+        es.indices.forcemerge.side_effect = lambda **kwargs: merging.wait(5)
+        with ElasticsearchBulkIndexManager(es, "test", finalize_async=True):
+            pass
+        #the manager has exited, but the index is still being merged
+        self.assertFalse(es.cat.indices.called)
+
+        merging.set()
+        wait_for_indexes(["test", "other"])
+        self.assertTrue(es.cat.indices.called)
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    def test_finalize_async_error(self, sleep):
+        es = self.client()
+        es.indices.forcemerge.side_effect = TransportError(500, "merge failed", {})
+        with ElasticsearchBulkIndexManager(es, "test", finalize_async=True):
+            pass
+        self.assertRaises(TransportError, wait_for_all_indexes)
+        #the error is only raised once
+        wait_for_all_indexes()
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    def test_finalize_async_errors(self, sleep):
+        es = self.client()
+        merging = threading.Event()
+        def forcemerge(index, max_num_segments):
+            if index == "slow":
+                merging.wait(5)
+            raise TransportError(500, "merge of %s failed" % index, {})
+        es.indices.forcemerge.side_effect = forcemerge
+        for index in ["fast", "slow"]:
+            with ElasticsearchBulkIndexManager(es, index, finalize_async=True):
+                pass
+        merging.set()
+        with self.assertLogs("mrtarget.common.esutil", "ERROR") as logs:
+            self.assertRaises(TransportError, wait_for_indexes, ["fast", "slow"])
+        #every index is waited for before raising, and every error is logged
+        self.assertEqual(len([line for line in logs.output if "finalizing" in line]), 2)
+        wait_for_all_indexes()
+
+
+class FakeIndices(object):
+    """the index and alias calls of a client used by ElasticsearchBulkIndexManager"""
+
+    def __init__(self):
+        self.indexes = {}
+
+    def exists(self, index):
+        return index in self.indexes or self.exists_alias(index)
+
+    def exists_alias(self, name):
+        return any(name in aliases for aliases in self.indexes.values())
+
+    def get_alias(self, name):
+        return dict((index, {}) for index, aliases in self.indexes.items() if name in aliases)
+
+    def get(self, index, ignore=()):
+        prefix = index.rstrip("*")
+        return dict((name, {}) for name in self.indexes if name.startswith(prefix))
+
+    def create(self, index, body):
+        self.indexes[index] = set()
+
+    def delete(self, index, ignore=()):
+        self.indexes.pop(index, None)
+
+    def update_aliases(self, body):
+        for action in body["actions"]:
+            op, args = list(action.items())[0]
+            if op == "add":
+                self.indexes[args["index"]].add(args["alias"])
+            elif op == "remove":
+                self.indexes[args["index"]].remove(args["alias"])
+            elif op == "remove_index":
+                del self.indexes[args["index"]]
+
+    def get_settings(self, index):
+        return {}
+
+    def put_settings(self, index, body):
+        pass
+
+    def forcemerge(self, index, max_num_segments):
+        pass
+
+
+class AliasTestCase(unittest.TestCase):
+
+    def client(self):
+        es = mock.Mock()
+        es.indices = FakeIndices()
+        es.cat.indices.return_value = "green open test"
+        return es
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    @mock.patch("mrtarget.common.esutil.time.strftime")
+    def test_builds(self, strftime, sleep):
+        es = self.client()
+        #an index from before aliases were used is replaced
+        es.indices.create("test", {})
+        builds = ["20260101000000", "20260102000000", "20260103000000"]
+        for build in builds:
+            strftime.return_value = build
+            with ElasticsearchBulkIndexManager(es, "test", use_alias=True) as manager:
+                self.assertEqual(manager.write_index, "test-" + build)
+                #readers still see the previous build while writing
+                self.assertNotIn("test", es.indices.indexes.get(manager.write_index))
+
+        #one previous build is kept
+        self.assertEqual(es.indices.indexes,
+            {"test-20260102000000": set(), "test-20260103000000": set(["test"])})
+
+        self.assertEqual(rollback_alias(es, "test"), "test-20260102000000")
+        self.assertEqual(es.indices.get_alias("test"), {"test-20260102000000": {}})
+        self.assertRaises(ValueError, rollback_alias, es, "test")
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    @mock.patch("mrtarget.common.esutil.time.strftime")
+    def test_failed_build(self, strftime, sleep):
+        es = self.client()
+        strftime.return_value = "20260101000000"
+        with ElasticsearchBulkIndexManager(es, "test", use_alias=True):
+            pass
+
+        strftime.return_value = "20260102000000"
+        try:
+            with ElasticsearchBulkIndexManager(es, "test", use_alias=True):
+                raise RuntimeError("failed")
+        except RuntimeError:
+            pass
+        self.assertEqual(es.indices.indexes, {"test-20260101000000": set(["test"])})
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    @mock.patch("mrtarget.common.esutil.time.strftime")
+    def test_append(self, strftime, sleep):
+        es = self.client()
+        es.reindex.return_value = {"failures": []}
+        es.indices.create("test-20260101000000", {})
+        es.indices.update_aliases({"actions": [{"add": {"index": "test-20260101000000", "alias": "test"}}]})
+        strftime.return_value = "20260102000000"
+        with ElasticsearchBulkIndexManager(es, "test", append_data=True, use_alias=True) as manager:
+            #appending writes into a copy of the current build
+            self.assertEqual(manager.write_index, "test-20260102000000")
+            self.assertEqual(es.reindex.call_args[1]["body"], {"source": {"index": "test-20260101000000"},
+                "dest": {"index": "test-20260102000000"}})
+            self.assertEqual(es.indices.get_alias("test"), {"test-20260101000000": {}})
+        self.assertEqual(es.indices.get_alias("test"), {"test-20260102000000": {}})
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    @mock.patch("mrtarget.common.esutil.time.strftime")
+    def test_newer_builds_kept(self, strftime, sleep):
+        es = self.client()
+        es.indices.create("test-20260101000000", {})
+        es.indices.create("test-20260105000000", {})
+        strftime.return_value = "20260103000000"
+        with ElasticsearchBulkIndexManager(es, "test", use_alias=True):
+            pass
+        #a newer build, e.g. prepared for shards, is not an old build
+        self.assertEqual(sorted(es.indices.indexes), ["test-20260101000000", 
+            "test-20260103000000", "test-20260105000000"])
+
+
+class FolderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    @mock.patch("mrtarget.common.esutil.time.sleep")
+    def test_write_load(self, sleep):
+        actions = [{"_index": "test", "_id": str(i), "_source": {"value": i}} for i in range(20)]
+        actions.append({"_op_type": "delete", "_index": "test", "_id": "gone"})
+        actions.append({"_index": "other", "_id": "0", "_source": {"value": 0}})
+        with FolderIndexManager(self.folder, "test", {"number_of_shards": 1}, {"properties": {}}):
+            with FolderIndexManager(self.folder, "other"):
+                writer = FolderWriter(self.folder, workers=2, part_bytes=100)
+                writer.target_bytes = 150
+                self.assertEqual(writer.write(actions), (22, 0))
+        #a later writer appends, and its actions replace the earlier ones
+        with FolderIndexManager(self.folder, "test", {"number_of_shards": 1}, {"properties": {}},
+                append_data=True):
+            self.assertEqual(FolderWriter(self.folder).write([
+                {"_op_type": "delete", "_index": "test", "_id": "3"},
+                {"_index": "test", "_id": "4", "_source": {"value": 40}}]), (2, 0))
+        self.assertTrue(len(os.listdir(os.path.join(self.folder, "test"))) > 3)
+        with open(os.path.join(self.folder, "test", "settings.json")) as settings_file:
+            self.assertEqual(json.load(settings_file), {"number_of_shards": 1})
+
+        es = mock.Mock()
+        es.indices.exists.return_value = False
+        es.indices.get_settings.return_value = {}
+        es.cat.indices.return_value = "green open test"
+        #deletes find nothing in the new index
+        es.bulk.side_effect = lambda body: bulk_response([404 if "delete" in line else 201
+            for line in get_bulk_lines(body) if "index" in line or "delete" in line])
+        self.assertEqual(load_folder(es, self.folder, workers=2), (22, 0))
+        es.indices.create.assert_any_call(index="test", 
+            body={"settings": {"number_of_shards": 1}, "mappings": {"properties": {}}})
+
+        lines = sum([get_bulk_lines(call[1]["body"]) for call in es.bulk.call_args_list], [])
+        self.assertEqual(len(lines), 42)
+        indexed = [(line["index"]["_id"], source) for line, source in zip(lines, lines[1:])
+            if "index" in line and line["index"]["_index"] == "test"]
+        self.assertEqual(sorted(doc_id for doc_id, _ in indexed),
+            sorted(str(i) for i in range(20) if i != 3))
+        self.assertIn(("4", {"value": 40}), indexed)
+        self.assertIn({"delete": {"_index": "test", "_id": "gone"}}, lines)
+        self.assertIn({"delete": {"_index": "test", "_id": "3"}}, lines)
+
+    def test_replace(self):
+        for append_data, parts in ((False, 1), (True, 2)):
+            with FolderIndexManager(self.folder, "test", append_data=append_data):
+                FolderWriter(self.folder).write([{"_index": "test", "_id": "1", "_source": {}}])
+            self.assertEqual(len([f for f in os.listdir(os.path.join(self.folder, "test"))
+                if f.startswith("part-")]), parts)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+import mock
+
+from mrtarget.common.LookupTables import GeneLookUpTable, EFOLookUpTable
+
+
+def _hit_response(source):
+    return {"hits": {"total": {"value": 1, "relation": "eq"},
+                     "hits": [{"_id": "X", "_source": source}]}}
+
+
+def _request(es):
+    #depending on the version, elasticsearch-dsl sends a body or keyword arguments
+    kwargs = dict(es.search.call_args[1])
+    kwargs.update(kwargs.pop("body", {}))
+    return kwargs
+
+
+class LookupTablesTestCase(unittest.TestCase):
+
+    def test_gene_source_includes(self):
+        es = mock.Mock()
+        es.search.return_value = _hit_response({"id": "ENSG1", "approved_symbol": "ABC"})
+        table = GeneLookUpTable(es, "gene", 1024, 0, 0, source_includes=["id", "approved_symbol"])
+
+        gene = table.get_gene("ENSG1")
+        self.assertEqual(gene, {"id": "ENSG1", "approved_symbol": "ABC"})
+        body = _request(es)
+        self.assertEqual(body["_source"], {"includes": ["id", "approved_symbol"]})
+
+        #second lookup comes from the cache
+        table.get_gene("ENSG1")
+        self.assertEqual(es.search.call_count, 1)
+
+    def test_efo_full_source_by_default(self):
+        es = mock.Mock()
+        es.search.return_value = _hit_response({"code": "EFO_1", "label": "a disease"})
+        table = EFOLookUpTable(es, "efo", 1024, 0)
+
+        table.get_efo("EFO_1")
+        body = _request(es)
+        self.assertNotIn("_source", body)
@@ -0,0 +1,102 @@
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from mrtarget.modules.Association import Scorer, produce_evidence_pairs, \
+    produce_evidence_local_init
+from mrtarget.modules.RawScores import get_raw_scores, open_raw_scores, \
+    write_raw_scores, read_raw_scores, get_raw_scores_files, reweight, ReweightProcess
+
+from tests.test_association import make_evidence, DATASOURCES_TO_DATATYPES, \
+    SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE
+
+
+class RawScoresTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def score_objects(self, evidences, scoring_weights):
+        scorer = Scorer()
+        associations = {}
+        for target, evidence in evidences.items():
+            for target, disease, evidence, is_direct in produce_evidence_pairs(target, evidence,
+                    scoring_weights, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES):
+                association = scorer.score(target, disease, evidence, is_direct, DATASOURCES_TO_DATATYPES)
+                associations[(target, disease)] = association
+        return associations
+
+    def test_reweight_same_as_scorer(self):
+        evidences = {'ENSG1': make_evidence('ENSG1', 300, 1), 'ENSG2': make_evidence('ENSG2', 20, 2)}
+        with open_raw_scores(self.tmpdir) as raw_file:
+            for target, evidence in evidences.items():
+                write_raw_scores(raw_file, target, 
+                    get_raw_scores(evidence, IS_DIRECT_DO_NOT_PROPAGATE, 100))
+        filenames = get_raw_scores_files(self.tmpdir)
+        self.assertEqual(len(filenames), 1)
+        raw_scores = read_raw_scores(filenames[0])
+        #only the scores that are kept are stored
+        self.assertEqual(len(raw_scores[6]), sum(min(count, 100) for count in raw_scores[3]))
+
+        for scoring_weights in [SCORING_WEIGHTS, {'eva': 0.5, 'chembl': 2.}]:
+            expected = self.score_objects(evidences, scoring_weights)
+            targets, diseases, directs, counts, overall, datatypes = reweight(raw_scores,
+                DATASOURCES_TO_DATATYPES, scoring_weights)
+
+            self.assertEqual(sorted(zip(targets, diseases)), sorted(expected))
+            for i, key in enumerate(zip(targets, diseases)):
+                association = expected[key]
+                hs = association.get_scoring_method('harmonic-sum')
+                self.assertAlmostEqual(overall[i], hs.overall, places=5)
+                for datatype in datatypes:
+                    self.assertAlmostEqual(datatypes[datatype][i], hs.datatypes[datatype], places=5)
+                self.assertEqual(directs[i], association.is_direct)
+                self.assertEqual(counts[i], association.evidence_count['total'])
+
+    @mock.patch("mrtarget.modules.Association.new_es_client")
+    def test_keep_raw_scores(self, new_es_client):
+        evidence = make_evidence('ENSG1', 30, 1)
+        expected = list(produce_evidence_pairs('ENSG1', evidence,
+            SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES))
+        _, _, produce_target, _, _, _ = produce_evidence_local_init(None, None, None,
+            SCORING_WEIGHTS, IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES,
+            'objects', None, 0, self.tmpdir, 100)
+        #as read by the per-target evidence reader
+        pairs = list(produce_target('ENSG1', iter(evidence), SCORING_WEIGHTS,
+            IS_DIRECT_DO_NOT_PROPAGATE, DATASOURCES_TO_DATATYPES))
+        key = lambda pair: (pair[0], pair[1], len(pair[2]), pair[3])
+        self.assertTrue(expected)
+        self.assertEqual([key(pair) for pair in pairs], [key(pair) for pair in expected])
+
+    def test_buffer_too_large(self):
+        with open_raw_scores(self.tmpdir) as raw_file:
+            write_raw_scores(raw_file, 'ENSG1', 
+                get_raw_scores(make_evidence('ENSG1', 100, 1), IS_DIRECT_DO_NOT_PROPAGATE, 5))
+        raw_scores = read_raw_scores(get_raw_scores_files(self.tmpdir)[0])
+        self.assertRaises(ValueError, reweight, raw_scores, DATASOURCES_TO_DATATYPES, {}, 10)
+        reweight(raw_scores, DATASOURCES_TO_DATATYPES, {}, 5)
+
+    def test_reweight_process(self):
+        evidences = {'ENSG1': make_evidence('ENSG1', 50, 1), 'ENSG2': make_evidence('ENSG2', 20, 2)}
+        #each producer writes its own file, which can be empty
+        for i, target in enumerate(sorted(evidences) + [None]):
+            with open(os.path.join(self.tmpdir, 'raw-%d.npy' % i), 'ab') as raw_file:
+                if target is not None:
+                    write_raw_scores(raw_file, target, 
+                        get_raw_scores(evidences[target], IS_DIRECT_DO_NOT_PROPAGATE, 100))
+
+        output = os.path.join(self.tmpdir, 'reweighted.tsv.gz')
+        ReweightProcess(self.tmpdir, output, DATASOURCES_TO_DATATYPES, 
+            SCORING_WEIGHTS, 100).process_all(False)
+        with gzip.open(output, 'rt') as output_file:
+            lines = [line.rstrip('\n').split('\t') for line in output_file]
+        expected = self.score_objects(evidences, SCORING_WEIGHTS)
+        self.assertEqual(sorted((line[0], line[1]) for line in lines[1:]),
+            sorted(key for key, association in expected.items() if association))
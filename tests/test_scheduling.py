@@ -0,0 +1,44 @@
+import unittest
+import mock
+
+from mrtarget.common.scheduling import in_part, get_keys, get_key_counts, log_progress, parse_shard
+
+
+class SchedulingTestCase(unittest.TestCase):
+
+    def test_in_part(self):
+        keys = ["EFO_%d" % i for i in range(100)]
+        parts = [[k for k in keys if in_part(k, part, 3)] for part in range(3)]
+        self.assertEqual(sorted(sum(parts, [])), sorted(keys))
+        self.assertTrue(all(parts))
+
+    def test_get_keys_pages(self):
+        def page(keys, after):
+            agg = {"buckets": [{"key": {"entity": k}, "doc_count": 1} for k in keys]}
+            if after:
+                agg["after_key"] = {"entity": after}
+            return {"hits": {"total": {"value": 0, "relation": "eq"}, "hits": []},
+                "aggregations": {"entities": agg}}
+
+        es = mock.Mock()
+        es.search.side_effect = [page(["A", "B"], "B"), page(["C"], "C")]
+        self.assertEqual(list(get_key_counts(es, "evidence", "target.id", page_size=2)), 
+            [("A", 1), ("B", 1), ("C", 1)])
+        self.assertEqual(es.search.call_count, 2)
+
+        kwargs = dict(es.search.call_args[1])
+        kwargs.update(kwargs.pop("body", {}))
+        self.assertEqual(kwargs["aggs"]["entities"]["composite"]["after"], {"entity": "B"})
+
+    def test_parse_shard(self):
+        self.assertEqual(parse_shard("0/1"), (0, 1))
+        self.assertEqual(parse_shard("3/4"), (3, 4))
+        for value in ["4/4", "-1/2", "1", "a/b", "0/0"]:
+            self.assertRaises(ValueError, parse_shard, value)
+
+    def test_log_progress(self):
+        logger = mock.Mock()
+        counts = [("A", 3), ("B", 2), ("C", 1)]
+        self.assertEqual(list(log_progress(counts, logger, "targets", every=2)), counts)
+        self.assertEqual([c[0][1:] for c in logger.info.call_args_list],
+            [(2, 3, "targets", 5, 6), (3, 3, "targets", 6, 6)])
@@ -1,4 +1,5 @@
 from builtins import range
+import random
 import unittest
 
 from mrtarget.common.Scoring import HarmonicSumScorer
@@ -59,6 +60,29 @@ class HarmonicSumTestCase(unittest.TestCase):
         self.assertEqual(harmonic_sum_scorer.score(scale_factor=2.), 2.1349839001848925)
         self.assertEqual(harmonic_sum_scorer.score(cap=2), 2)
 
+    def test_harmonic_sum_add_many(self):
+
+        '''test batch and single adds keep the same values'''
+        random.seed(42)
+        for buffer in [1, 10, 100]:
+            data = [random.random() for i in range(250)]
+            single_scorer = HarmonicSumScorer(buffer=buffer)
+            for i in data:
+                single_scorer.add(i)
+            batch_scorer = HarmonicSumScorer(buffer=buffer)
+            batch_scorer.add_many(data[:5])
+            batch_scorer.add_many(data[5:])
+            self.assertEqual(sorted(batch_scorer.data), sorted(single_scorer.data))
+            self.assertEqual(batch_scorer.min, single_scorer.min)
+            self.assertEqual(batch_scorer.score(scale_factor=2), single_scorer.score(scale_factor=2))
+
+        '''test scoring does not disturb later adds'''
+        harmonic_sum_scorer = HarmonicSumScorer(buffer=3)
+        harmonic_sum_scorer.add_many([0.1, 0.5, 0.3])
+        harmonic_sum_scorer.score()
+        harmonic_sum_scorer.add(0.4)
+        self.assertEqual(sorted(harmonic_sum_scorer.data), [0.3, 0.4, 0.5])
+
     def test_renormalize(self):
         value = DataNormaliser.renormalize(0.2,[0.,.9],[.5,1])
         self.assertEqual(value,0.6111111111111112)
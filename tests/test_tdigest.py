@@ -0,0 +1,41 @@
+import random
+import unittest
+
+import numpy as np
+
+from mrtarget.common.tdigest import TDigest
+
+
+class TDigestTestCase(unittest.TestCase):
+
+    def test_quantiles(self):
+        rng = random.Random(1)
+        values = [rng.betavariate(0.5, 2) for _ in range(20000)]
+        digest = TDigest()
+        for value in values:
+            digest.add(value)
+
+        self.assertEqual(digest.count, len(values))
+        self.assertTrue(len(digest.means) < 200)
+        self.assertEqual(digest.quantile(0), min(values))
+        self.assertEqual(digest.quantile(1), max(values))
+        for q in [0.01, 0.1, 0.5, 0.9, 0.99]:
+            self.assertAlmostEqual(digest.quantile(q), np.quantile(values, q), delta=0.01)
+
+    def test_update(self):
+        values = [float(i) for i in range(5000)]
+        first = TDigest()
+        second = TDigest()
+        for value in values[::2]:
+            first.add(value)
+        for value in values[1::2]:
+            second.add(value)
+        first.update(second)
+        self.assertEqual(first.count, 5000)
+        self.assertAlmostEqual(first.quantile(0.5), 2499.5, delta=25)
+
+    def test_empty(self):
+        self.assertIsNone(TDigest().quantile(0.5))
+        digest = TDigest()
+        digest.add(3)
+        self.assertEqual(digest.quantile(0.5), 3.)